@@ -0,0 +1,404 @@
+"""
+Offline benchmark for Teachable-dl.
+
+Serves a stand-in school on localhost: course pages for the three templates pick_course_downloader detects
+(__next, course-mainbar and .block__curriculum), lecture pages with embed-player iframes whose embed page carries
+__NEXT_DATA__, file attachments, drip-locked sections and locked lectures, and an HLS endpoint. Latency, bandwidth and
+injected errors of the media and attachment endpoints are configurable.
+
+The http mode (default) runs the browserless part of the download path: curriculum parsing, embed resolution, native
+HLS segment download and attachments. The browser mode runs pick_course_downloader end to end with Chrome (and ffmpeg
+for the remux) against the same fixtures.
+
+    python benchmark.py --lectures 30 --segments 20 --latency 0.05 --bandwidth 5M --error-rate 0.02
+"""
+import argparse
+import json
+import logging
+import os
+import random
+import shutil
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urljoin, urlparse
+
+from bs4 import BeautifulSoup
+
+import main
+
+TEMPLATES = ["simple", "classic", "colossal"]
+PARSERS = {
+    "simple": main.parse_curriculum_simple,
+    "classic": main.parse_curriculum_classic,
+    "colossal": main.parse_curriculum_colossal,
+}
+
+
+class FixtureSchool:
+    """
+    The content of the stand-in school. Every template serves the same curriculum: sections of lectures with one
+    embedded video and one attachment each. The last section is drip-locked and every seventh lecture is locked.
+    """
+
+    def __init__(self, lectures=20, sections=4, segments=10, segment_size=256 * 1024, attachment_size=512 * 1024,
+                 latency=0.0, bandwidth=0, error_rate=0.0, seed=0):
+        self.lectures = lectures
+        self.sections = sections
+        self.segments = segments
+        self.segment_size = segment_size
+        self.attachment_size = attachment_size
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.random_lock = threading.Lock()
+        self.payload = os.urandom(max(segment_size, attachment_size))
+
+    def curriculum(self):
+        per_section = max(1, self.lectures // self.sections)
+        sections = []
+        for section_idx in range(self.sections):
+            lectures = []
+            for n in range(section_idx * per_section, min(self.lectures, (section_idx + 1) * per_section)):
+                lectures.append({"id": n + 1, "title": "Lecture {}".format(n + 1), "locked": (n + 1) % 7 == 0})
+            sections.append({"title": "Section {}".format(section_idx + 1), "lectures": lectures,
+                             "drip": section_idx == self.sections - 1 and self.sections > 1})
+        return sections
+
+    def available_lectures(self):
+        return sum(1 for section in self.curriculum() if not section["drip"]
+                   for lecture in section["lectures"] if not lecture["locked"])
+
+    def course_page(self, template):
+        sections = self.curriculum()
+        title = "Benchmark Course " + template
+        prefix = "/courses/" + template
+
+        def link(lecture):
+            return "{}/lectures/{}".format(prefix, lecture["id"])
+
+        body = []
+        if template == "simple":
+            body.append('<div id="__next"><div class="wrap"><h2 class="heading">{}</h2>'.format(title))
+            for section in sections:
+                body.append('<div class="slim-section"><h3 class="heading">{}</h3>'.format(section["title"]))
+                if section["drip"]:
+                    body.append('<span class="drip-tag">Available in 7 days</span>')
+                for lecture in section["lectures"]:
+                    if lecture["locked"]:
+                        body.append('<div class="bar"><span class="text">{}</span></div>'.format(lecture["title"]))
+                    else:
+                        body.append('<div class="bar"><a class="text" href="{}">{}</a></div>'.format(
+                            link(lecture), lecture["title"]))
+                body.append('</div>')
+            body.append('</div></div>')
+        elif template == "classic":
+            body.append('<section><div class="course-sidebar"><div><h2>{}</h2>'
+                        '<img class="course-image" src="/images/resize=width:100/course.jpg"></div></div>'
+                        '<div class="course-mainbar">'.format(title))
+            for section in sections:
+                # The classic template hides drip sections and locked lectures entirely
+                if section["drip"]:
+                    continue
+                body.append('<div class="course-section"><div class="section-title">{}</div>'.format(
+                    section["title"]))
+                for lecture in section["lectures"]:
+                    if not lecture["locked"]:
+                        body.append('<div class="section-item"><a class="item" href="{}">'
+                                    '<span class="lecture-name">{}</span></a></div>'.format(link(lecture),
+                                                                                           lecture["title"]))
+                body.append('</div>')
+            body.append('</div></section>')
+        else:
+            body.append('<h1 class="lecture_heading">{}</h1><div class="block__curriculum">'.format(title))
+            for section in sections:
+                if section["drip"]:
+                    continue
+                body.append('<div class="block__curriculum__section">'
+                            '<div class="block__curriculum__section__title">{}</div>'.format(section["title"]))
+                for lecture in section["lectures"]:
+                    if not lecture["locked"]:
+                        body.append('<a class="block__curriculum__section__list__item__link" href="{}">'
+                                    '<span class="block__curriculum__section__list__item__lecture-name">{}</span>'
+                                    '</a>'.format(link(lecture), lecture["title"]))
+                body.append('</div>')
+            body.append('</div>')
+        return "<html><head><title>{}</title></head><body>{}</body></html>".format(title, "".join(body))
+
+    def lecture_page(self, template, lecture_id):
+        return ('<html><head><title>Lecture {0}</title></head><body><h2>Lecture {0}</h2>'
+                '<iframe data-testid="embed-player-0" src="/embed/{0}"></iframe>'
+                '<div class="lecture-attachment-type-file"><a href="/files/{0}/notes-{0}.pdf">notes-{0}.pdf</a></div>'
+                '</body></html>').format(lecture_id)
+
+    def embed_page(self, base_url, lecture_id):
+        data = {"props": {"pageProps": {"applicationData": {"mediaAssets": [
+            {"url": "{}/hls/{}/master.m3u8".format(base_url, lecture_id)}]}}}}
+        return ('<html><body><div id="player"></div><script id="__NEXT_DATA__" type="application/json">{}</script>'
+                '</body></html>').format(json.dumps(data))
+
+    def master_playlist(self):
+        return ("#EXTM3U\n#EXT-X-STREAM-INF:BANDWIDTH=800000,RESOLUTION=640x360\nlow.m3u8\n"
+                "#EXT-X-STREAM-INF:BANDWIDTH=2400000,RESOLUTION=1280x720\nhigh.m3u8\n")
+
+    def media_playlist(self):
+        lines = ["#EXTM3U", "#EXT-X-VERSION:3", "#EXT-X-TARGETDURATION:4", "#EXT-X-MEDIA-SEQUENCE:0"]
+        for n in range(self.segments):
+            lines += ["#EXTINF:4.0,", "seg{}.ts".format(n)]
+        lines.append("#EXT-X-ENDLIST")
+        return "\n".join(lines) + "\n"
+
+    def inject_error(self):
+        with self.random_lock:
+            return self.random.random() < self.error_rate
+
+
+class FixtureHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    school = None
+
+    def log_message(self, format, *args):
+        logging.debug("fixture: " + format % args)
+
+    def send_body(self, body, content_type="text/html; charset=utf-8", throttle=False):
+        if isinstance(body, str):
+            body = body.encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("ETag", '"{}"'.format(len(body)))
+        self.end_headers()
+        if self.command == "HEAD":
+            return
+        if not throttle or not self.school.bandwidth:
+            self.wfile.write(body)
+            return
+        # Paced per connection in 64 KiB steps
+        step = 64 * 1024
+        for offset in range(0, len(body), step):
+            started = time.monotonic()
+            self.wfile.write(body[offset:offset + step])
+            delay = min(step, len(body) - offset) / self.school.bandwidth - (time.monotonic() - started)
+            if delay > 0:
+                time.sleep(delay)
+
+    def do_HEAD(self):
+        self.do_GET()
+
+    def do_GET(self):
+        school = self.school
+        path = urlparse(self.path).path
+        parts = [part for part in path.split("/") if part]
+        media = parts[:1] in (["hls"], ["files"])
+        if media:
+            if school.latency:
+                time.sleep(school.latency)
+            if school.inject_error():
+                self.send_error(503, "Injected error")
+                return
+
+        if len(parts) == 2 and parts[0] == "courses" and parts[1] in TEMPLATES:
+            self.send_body(school.course_page(parts[1]))
+        elif len(parts) == 4 and parts[0] == "courses" and parts[2] == "lectures":
+            self.send_body(school.lecture_page(parts[1], int(parts[3])))
+        elif len(parts) == 2 and parts[0] == "embed":
+            self.send_body(school.embed_page("http://{}:{}".format(*self.server.server_address), int(parts[1])))
+        elif len(parts) == 3 and parts[0] == "hls" and parts[2] == "master.m3u8":
+            self.send_body(school.master_playlist(), "application/vnd.apple.mpegurl")
+        elif len(parts) == 3 and parts[0] == "hls" and parts[2].endswith(".m3u8"):
+            self.send_body(school.media_playlist(), "application/vnd.apple.mpegurl")
+        elif len(parts) == 3 and parts[0] == "hls":
+            self.send_body(school.payload[:school.segment_size], "video/mp2t", throttle=True)
+        elif parts[:1] == ["files"]:
+            self.send_body(school.payload[:school.attachment_size], "application/pdf", throttle=True)
+        elif parts[:1] == ["images"]:
+            self.send_body(school.payload[:16 * 1024], "image/jpeg")
+        else:
+            self.send_error(404)
+
+
+def start_server(school, port=0):
+    handler = type("Handler", (FixtureHandler,), {"school": school})
+    server = ThreadingHTTPServer(("127.0.0.1", port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="fixture-server", daemon=True).start()
+    return server, "http://127.0.0.1:{}".format(server.server_address[1])
+
+
+def bench_http(downloader, base_url, template, output_dir, workers):
+    """
+    Runs the browserless download path for one template: parse the curriculum, fetch every lecture page, resolve its
+    embeds over HTTP and download the HLS segments and attachments with the downloader's shared components.
+
+    :return: dict with the measurements
+    """
+    session = downloader.session_bridge.session
+    course_url = base_url + "/courses/" + template
+    course_path = os.path.join(output_dir, template)
+    os.makedirs(course_path, exist_ok=True)
+    manifest = downloader.get_manifest(course_path)
+
+    started = time.monotonic()
+    page_source = session.get(course_url, timeout=30).text
+    video_list = PARSERS[template](page_source, course_url, course_path)
+    enumeration = time.monotonic() - started
+
+    downloaded = {"bytes": 0}
+    lock = threading.Lock()
+
+    def download_video(media_url, output_file):
+        hls = main.HlsDownloader(session, downloader.headers, downloader.fragment_controller, downloader.bandwidth,
+                                 downloader.retry_policy, course=course_path)
+        downloader.fragment_controller.register(hls)
+        failed = True
+        try:
+            playlist = hls.load_playlist(media_url)
+            video_url, _ = hls.select_variant(playlist) if playlist.is_variant else (media_url, None)
+            # The remux needs ffmpeg and real media, the benchmark stops at the segment download
+            size = hls.download_playlist(video_url, output_file)
+            failed = False
+        finally:
+            downloader.fragment_controller.unregister(hls, failed=failed)
+        with lock:
+            downloaded["bytes"] += size
+
+    downloads_started = time.monotonic()
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        futures = []
+        for video in video_list:
+            lecture_html = session.get(video["link"], timeout=30).text
+            soup = BeautifulSoup(lecture_html, "html.parser")
+            embed_urls = [urljoin(video["link"], iframe["src"])
+                          for iframe in soup.select("iframe[data-testid^='embed-player']")]
+            for n, media_url in enumerate(downloader.resolve_media_urls(embed_urls, video["link"], session)):
+                output_file = os.path.join(video["download_path"], "{:02d}-{}-{}.ts".format(
+                    video["idx"], video["title"], n))
+                futures.append(executor.submit(download_video, media_url, output_file))
+            for link in soup.select(".lecture-attachment-type-file a"):
+                downloader.queue_attachment_download(urljoin(video["link"], link["href"]),
+                                                     link.get_text().strip(), video["download_path"], manifest)
+        errors = 0
+        for future in futures:
+            try:
+                future.result()
+            except Exception as e:
+                errors += 1
+                logging.warning("Video download failed: " + str(e))
+    downloader.wait_for_downloads()
+    elapsed = time.monotonic() - downloads_started
+
+    attachment_bytes = sum(entry.get("size") or 0 for key, entry in manifest.entries.items()
+                           if key.startswith("attachment:") and entry.get("status") == "complete")
+    return result_row(template, enumeration, len(video_list), downloaded["bytes"] + attachment_bytes,
+                      elapsed + enumeration, errors)
+
+
+def bench_browser(downloader, base_url, template, output_dir):
+    """
+    Runs pick_course_downloader end to end with Chrome for one template.
+
+    :return: dict with the measurements
+    """
+    cwd = os.getcwd()
+    os.chdir(output_dir)
+    try:
+        report = downloader.report
+        before = {name: dict(totals) for name, totals in report.phases.items()}
+        bytes_before = report.downloaded_bytes
+        started = time.monotonic()
+        downloader.pick_course_downloader(base_url + "/courses/" + template)
+        downloader.wait_for_downloads()
+        elapsed = time.monotonic() - started
+    finally:
+        os.chdir(cwd)
+
+    def delta(name, field):
+        return report.phases.get(name, {}).get(field, 0) - before.get(name, {}).get(field, 0)
+
+    return result_row(template, delta("enumerate", "total"), delta("lecture", "count"),
+                      report.downloaded_bytes - bytes_before, elapsed, delta("download", "errors"))
+
+
+def result_row(template, enumeration, lectures, nbytes, elapsed, errors):
+    return {
+        "template": template,
+        "enumeration_seconds": round(enumeration, 3),
+        "lectures": lectures,
+        "lectures_per_minute": round(lectures / elapsed * 60, 1) if elapsed else None,
+        "megabytes": round(nbytes / 1024 ** 2, 2),
+        "megabytes_per_second": round(nbytes / 1024 ** 2 / elapsed, 2) if elapsed else None,
+        "seconds": round(elapsed, 3),
+        "errors": errors,
+    }
+
+
+def print_results(rows):
+    print("{:<10} {:>10} {:>9} {:>13} {:>10} {:>8} {:>9} {:>7}".format(
+        "template", "enum (s)", "lectures", "lectures/min", "MB", "MB/s", "time (s)", "errors"))
+    for row in rows:
+        print("{template:<10} {enumeration_seconds:>10.3f} {lectures:>9} {lectures_per_minute:>13} "
+              "{megabytes:>10.2f} {megabytes_per_second:>8} {seconds:>9.2f} {errors:>7}".format(**row))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog='Teachable-Dl benchmark', description='Benchmark against local fixtures')
+    parser.add_argument("--mode", choices=["http", "browser"], default="http",
+                        help='http runs the download path without a browser, browser runs pick_course_downloader '
+                             'with Chrome and ffmpeg')
+    parser.add_argument("--templates", default=",".join(TEMPLATES),
+                        help='Comma separated course templates to run: ' + ", ".join(TEMPLATES))
+    parser.add_argument("--lectures", type=int, default=20, help='Lectures per course')
+    parser.add_argument("--sections", type=int, default=4, help='Sections per course, the last one is drip-locked')
+    parser.add_argument("--segments", type=int, default=10, help='HLS segments per video')
+    parser.add_argument("--segment-size", default="256K", help='Size of each HLS segment')
+    parser.add_argument("--attachment-size", default="512K", help='Size of each attachment')
+    parser.add_argument("--latency", type=float, default=0.0,
+                        help='Seconds added to every media and attachment request')
+    parser.add_argument("--bandwidth", default="0",
+                        help='Bytes per second of each media and attachment connection, e.g. 5M (0 = no limit)')
+    parser.add_argument("--error-rate", type=float, default=0.0,
+                        help='Share of media and attachment requests answered with 503')
+    parser.add_argument("--workers", type=int, default=4, help='Concurrent video downloads in http mode')
+    parser.add_argument("--download-workers", type=int, default=2, help='--download-workers of browser mode')
+    parser.add_argument("--port", type=int, default=0, help='Port of the fixture server (default: any free port)')
+    parser.add_argument("--json", metavar="FILE", help='Also write the results to this JSON file')
+    parser.add_argument("--keep", action='store_true', default=False, help='Keep the downloaded files')
+    parser.add_argument('-v', '--verbose', action='count', default=0,
+                        help='Increase verbosity level (repeat for more verbosity)')
+    args = parser.parse_args()
+    logging.basicConfig(level=[logging.WARNING, logging.INFO, logging.DEBUG][min(args.verbose, 2)],
+                        format='%(levelname)s: %(message)s')
+
+    school = FixtureSchool(lectures=args.lectures, sections=args.sections, segments=args.segments,
+                           segment_size=main.parse_rate(args.segment_size),
+                           attachment_size=main.parse_rate(args.attachment_size), latency=args.latency,
+                           bandwidth=main.parse_rate(args.bandwidth), error_rate=args.error_rate)
+    server, base_url = start_server(school, args.port)
+    logging.info("Serving fixtures on " + base_url)
+    output_dir = tempfile.mkdtemp(prefix="teachable-dl-bench-")
+
+    downloader = main.TeachableDownloader(verbose_arg=args.verbose > 1, timeout_arg=30,
+                                          download_workers_arg=args.download_workers if args.mode == "browser" else 0,
+                                          attachments_arg=True, browser_arg=args.mode == "browser",
+                                          headless_arg=True, cookie_file_arg=os.path.join(output_dir, "cookies.txt"))
+    rows = []
+    try:
+        for template in args.templates.split(","):
+            if args.mode == "browser":
+                rows.append(bench_browser(downloader, base_url, template, output_dir))
+            else:
+                rows.append(bench_http(downloader, base_url, template, output_dir, args.workers))
+    finally:
+        downloader.clean_up()
+        server.shutdown()
+        if not args.keep:
+            shutil.rmtree(output_dir, ignore_errors=True)
+
+    print("Available lectures per course: " + str(school.available_lectures()))
+    print_results(rows)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump({"config": vars(args), "results": rows}, f, indent=2)
@@ -1,22 +1,44 @@
 import argparse
+import calendar
+import collections
+import contextlib
+import functools
+import hashlib
 import json
 import logging
+import multiprocessing
 import os
+import queue
+import random
 import re
+import shutil
+import socket
+import sqlite3
 import string
+import subprocess
 import sys
+import tempfile
+import threading
 import time
-from urllib.parse import urljoin, urlparse, urlunparse
+import zlib
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, parse_qsl, urlencode, urljoin, urlparse, urlunparse
 
+import m3u8
 import requests
 import selenium.webdriver.support.expected_conditions as EC
-import wget
 import yt_dlp
+from Crypto.Cipher import AES
+from bs4 import BeautifulSoup, Comment, NavigableString
+from requests.adapters import HTTPAdapter
 from selenium.common import TimeoutException
 from selenium.common.exceptions import NoSuchElementException
 from selenium.webdriver.remote.webdriver import By
 from selenium.webdriver.support.wait import WebDriverWait
 from seleniumbase import Driver
+from urllib3.exceptions import MaxRetryError, ResponseError
+from urllib3.util.retry import Retry
 
 from dotenv import load_dotenv
 load_dotenv(verbose=True)
@@ -53,9 +75,2411 @@ def truncate_title_to_fit_file_name(title, max_file_name_length=250):
     return title
 
 
+RATE_UNITS = {"": 1, "K": 1024, "M": 1024 ** 2, "G": 1024 ** 3}
+
+
+def parse_rate(rate):
+    """
+    Parses a bytes per second rate like 500K, 2M or 1.5G. 0 means unlimited.
+    """
+    match = re.fullmatch(r"\s*(\d+(?:\.\d+)?)\s*([KMG]?)(?:i?B)?(?:/s)?\s*", rate, re.IGNORECASE)
+    if not match:
+        raise ValueError("Invalid rate: " + rate)
+    return int(float(match.group(1)) * RATE_UNITS[match.group(2).upper()])
+
+
+def parse_bandwidth_profile(profile):
+    """
+    Parses a time of day profile like "08:00=1M,18:00=0" into a sorted list of (minute of day, bytes per second).
+    Each rate applies from its time until the next one, the last one wraps around midnight.
+    """
+    entries = []
+    for entry in profile.split(","):
+        start, _, rate = entry.partition("=")
+        hours, _, minutes = start.strip().partition(":")
+        entries.append((int(hours) * 60 + int(minutes or 0), parse_rate(rate)))
+    return sorted(entries)
+
+
+def parse_host_limits(limits):
+    host_limits = {}
+    for limit in limits:
+        host, _, count = limit.partition("=")
+        host_limits[host.strip().lower()] = int(count)
+    return host_limits
+
+
+NEXT_DATA_PATTERN = re.compile(r'<script[^>]*id="__NEXT_DATA__"[^>]*>(.*?)</script>', re.DOTALL)
+
+
+def extract_media_url(embed_html):
+    # The hotmart embed page ships its player configuration as JSON in the __NEXT_DATA__ script
+    match = NEXT_DATA_PATTERN.search(embed_html)
+    if not match:
+        raise ValueError("__NEXT_DATA__ not found in embed page")
+    json_text = json.loads(match.group(1))
+    # ["urlEncrypted"] some how cause some 404 here
+    return json_text["props"]["pageProps"]["applicationData"]["mediaAssets"][0]["url"]
+
+
+def probe_media(path):
+    ffprobe = shutil.which("ffprobe")
+    if ffprobe is None:
+        raise FileNotFoundError("ffprobe not found")
+    result = subprocess.run([ffprobe, "-v", "error", "-show_streams", "-show_format", "-of", "json", path],
+                            check=True, capture_output=True)
+    return json.loads(result.stdout)
+
+
+def postprocess_video(input_file, title):
+    # Runs in the postprocessing process pool. Replaces what yt-dlp's FFmpegVideoConvertor and FFmpegMetadata did
+    # inline: streams that already fit in mp4 are only remuxed, everything else is converted to h264/aac.
+    ffmpeg = shutil.which("ffmpeg")
+    if ffmpeg is None:
+        raise FileNotFoundError("ffmpeg not found")
+    codecs = {stream["codec_type"]: stream["codec_name"] for stream in probe_media(input_file)["streams"]
+              if stream.get("codec_type") in ("video", "audio")}
+    copy = codecs.get("video", "h264") == "h264" and codecs.get("audio", "aac") == "aac"
+
+    tmp_file = input_file + ".pp.mp4"
+    command = [ffmpeg, "-y", "-loglevel", "error", "-i", input_file, "-map", "0:v?", "-map", "0:a?",
+               "-metadata", "title=" + title]
+    command += ["-c", "copy"] if copy else ["-c:v", "libx264", "-c:a", "aac"]
+    command += ["-movflags", "+faststart", tmp_file]
+    try:
+        subprocess.run(command, check=True, capture_output=True)
+        os.replace(tmp_file, input_file)
+    finally:
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+    return "remux" if copy else "convert"
+
+
+def timed_postprocess_video(input_file, title):
+    # The time spent in the pool process, without the time the job waited for a free process
+    start = time.monotonic()
+    mode = postprocess_video(input_file, title)
+    return mode, time.monotonic() - start
+
+
+def curriculum_snapshot(video_list, course_path):
+    return [{"section": os.path.relpath(video["download_path"], course_path), "idx": video["idx"],
+             "link": video["link"], "title": video["title"]} for video in video_list]
+
+
+def lecture_file_suffix(name, prefix):
+    """
+    :return: str What follows the "NN-title" prefix of a lecture in the name of one of its files (".mp4", "-2.mp4",
+        ".en.vtt", "" for the attachment folder), or None if the file belongs to another lecture
+    """
+    match = re.match(re.escape(prefix) + r"((?:-\d+)?(?:\..*)?)$", name)
+    return match.group(1) if match else None
+
+
+def diff_curriculum(previous, current):
+    """
+    Compares two curriculum snapshots by lecture link.
+
+    :return: dict
+        "added" and "unchanged" hold entries of the current snapshot, "removed" entries of the previous one and
+        "moved" (previous, current) pairs of lectures whose chapter, index or title changed.
+    """
+    previous_by_link = {entry["link"]: entry for entry in previous}
+    current_links = {entry["link"] for entry in current}
+    diff = {"added": [], "removed": [], "moved": [], "unchanged": []}
+    for entry in current:
+        old = previous_by_link.get(entry["link"])
+        if old is None:
+            diff["added"].append(entry)
+        elif (old["section"], old["idx"], old["title"]) != (entry["section"], entry["idx"], entry["title"]):
+            diff["moved"].append((old, entry))
+        else:
+            diff["unchanged"].append(entry)
+    diff["removed"] = [entry for entry in previous if entry["link"] not in current_links]
+    return diff
+
+
+# Timeout for elements that are usually absent (cloudflare challenge, OTP form), kept short so a normal page
+# doesn't pay the full --timeout every time
+PROBE_TIMEOUT = 2
+
+BLOCK_TAGS = {"address", "article", "aside", "br", "div", "dl", "dt", "dd", "footer", "h1", "h2", "h3", "h4", "h5",
+              "h6", "header", "hr", "li", "main", "nav", "ol", "p", "section", "table", "tr", "ul"}
+
+
+def is_hidden(tag, hidden_class=True):
+    style = tag.get("style", "").replace(" ", "").lower()
+    return tag.has_attr("hidden") or "display:none" in style or "visibility:hidden" in style or \
+        (hidden_class and "hidden" in tag.get("class", []))
+
+
+def element_text(element, hidden_class=True):
+    """
+    Approximates selenium's WebElement.text: whitespace is collapsed, block elements start a new line and text the
+    page hides (hidden attribute, display:none, the "hidden" class) is left out.
+
+    :param hidden_class: bool
+        False includes elements that are only hidden by the "hidden" class, like WebElement.text did on the colossal
+        template after the class was removed from every element.
+    """
+    parts = []
+
+    def collect(tag):
+        for node in tag.children:
+            if isinstance(node, NavigableString):
+                if not isinstance(node, Comment):
+                    parts.append(str(node))
+            elif node.name not in ("script", "style") and not is_hidden(node, hidden_class):
+                if node.name in BLOCK_TAGS:
+                    parts.append("\n")
+                collect(node)
+
+    collect(element)
+    lines = "".join(parts).split("\n")
+    return "\n".join(" ".join(line.split()) for line in lines if line.strip())
+
+
+def parse_curriculum_colossal(page_source, base_url, course_path):
+    soup = BeautifulSoup(page_source, "html.parser")
+    chapter_idx = 1
+    video_list = []
+    for section in soup.select(".block__curriculum__section"):
+        chapter_title = element_text(section.select_one(".block__curriculum__section__title"), hidden_class=False)
+        chapter_title = clean_string(chapter_title)
+        chapter_title = "{:02d}-{}".format(chapter_idx, chapter_title)
+        logging.info("Found chapter: " + chapter_title)
+
+        download_path = os.path.join(course_path, chapter_title)
+        os.makedirs(download_path, exist_ok=True)
+
+        chapter_idx += 1
+        idx = 1
+
+        for section_item in section.select(".block__curriculum__section__list__item__link"):
+            lecture_link = urljoin(base_url, section_item.get("href"))
+
+            lecture_title = element_text(
+                section_item.select_one(".block__curriculum__section__list__item__lecture-name"), hidden_class=False)
+            lecture_title = clean_string(lecture_title)
+            lecture_title = ''.join(char for char in lecture_title if char in string.printable)
+            logging.info("Found lecture: " + lecture_title)
+
+            truncated_lecture_title = truncate_title_to_fit_file_name(lecture_title)
+
+            video_entity = {"link": lecture_link, "title": truncated_lecture_title, "idx": idx,
+                            "download_path": download_path}
+            video_list.append(video_entity)
+            idx += 1
+    return video_list
+
+
+def parse_curriculum_classic(page_source, base_url, course_path):
+    soup = BeautifulSoup(page_source, "html.parser")
+    chapter_idx = 1
+    video_list = []
+    for section in soup.select(".course-section"):
+        chapter_title = element_text(section.select_one(".section-title"))
+        chapter_title = "{:02d}-{}".format(chapter_idx, chapter_title)
+        logging.info("Found chapter: " + chapter_title)
+
+        download_path = os.path.join(course_path, chapter_title)
+        os.makedirs(download_path, exist_ok=True)
+
+        chapter_idx += 1
+        idx = 1
+
+        for section_item in section.select(".section-item"):
+            lecture_link = urljoin(base_url, section_item.select_one(".item").get("href"))
+
+            lecture_title = element_text(section_item.select_one(".lecture-name"))
+            logging.info("Found lecture: " + lecture_title)
+
+            video_entity = {"link": lecture_link, "title": lecture_title, "idx": idx,
+                            "download_path": download_path}
+            video_list.append(video_entity)
+            idx += 1
+    return video_list
+
+
+def parse_curriculum_simple(page_source, base_url, course_path):
+    soup = BeautifulSoup(page_source, "html.parser")
+    chapter_idx = 0
+    video_list = []
+    for slim_section in soup.select(".slim-section"):
+        chapter_idx += 1
+        chapter_title = element_text(slim_section.select_one(".heading"))
+        chapter_title = clean_string(chapter_title)
+        chapter_title = "{:02d}-{}".format(chapter_idx, chapter_title)
+        logging.info("Found chapter: " + chapter_title)
+
+        if slim_section.select_one(".drip-tag"):
+            logging.warning('Chapter "%s" not available, skipping', chapter_title)
+            continue
+
+        download_path = os.path.join(course_path, chapter_title)
+        os.makedirs(download_path, exist_ok=True)
+
+        idx = 1
+        for bar in slim_section.select(".bar"):
+            video = bar.select_one(".text")
+            # Locked lectures are rendered without a link. They keep their number, so file names don't change when
+            # they unlock and match the other parsers
+            if video is None or not video.get("href"):
+                logging.warning("Lecture not available, skipping: " + clean_string(element_text(bar)))
+                idx += 1
+                continue
+            link = urljoin(base_url, video.get("href"))
+            # Remove new line characters from the title and replace spaces with -
+            title = clean_string(element_text(video))
+            logging.info("Found lecture: " + title)
+            truncated_title = truncate_title_to_fit_file_name(title)
+            video_entity = {"link": link, "title": truncated_title, "idx": idx, "download_path": download_path}
+            video_list.append(video_entity)
+            idx += 1
+    return video_list
+
+
+class RunReport:
+    """
+    Times the phases of a run (login, enumeration, navigation, downloads, ...) and appends one JSON line per phase to
+    the report file, if one is set. Totals per phase are kept in memory for the summary written at the end of the run.
+    """
+
+    def __init__(self, path=None, top=10):
+        self.path = path
+        self.top = top
+        self.lock = threading.Lock()
+        self.phases = {}
+        self.lectures = []
+        self.downloaded_bytes = 0
+        self.totals = {}
+        self.started = time.time()
+        self.closed = False
+        if path:
+            with open(path, "a", encoding="utf-8") as f:
+                f.write(json.dumps({"type": "start", "time": self.started, "argv": sys.argv[1:]}) + "\n")
+
+    def _write(self, record):
+        if self.path:
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(json.dumps(record) + "\n")
+
+    def record(self, name, duration, write=True, **fields):
+        with self.lock:
+            totals = self.phases.setdefault(name, {"count": 0, "total": 0.0, "max": 0.0, "errors": 0})
+            totals["count"] += 1
+            totals["total"] += duration
+            totals["max"] = max(totals["max"], duration)
+            if fields.get("ok") is False:
+                totals["errors"] += 1
+            if name == "lecture":
+                self.lectures.append((duration, fields.get("lecture")))
+            self.downloaded_bytes += fields.get("bytes") or 0
+            if write:
+                self._write(dict(fields, type="phase", phase=name, time=time.time(), duration=round(duration, 3)))
+
+    def add_total(self, name, count):
+        # Expected number of courses or lectures, for the progress of the status endpoint
+        with self.lock:
+            self.totals[name] = self.totals.get(name, 0) + count
+
+    def progress(self, name, phase):
+        with self.lock:
+            totals = self.phases.get(phase, {"count": 0, "errors": 0})
+            skipped = self.phases.get(phase + "_skipped", {"count": 0})["count"]
+            done = totals["count"] - totals["errors"]
+            return {"total": self.totals.get(name, 0), "done": done, "failed": totals["errors"], "skipped": skipped,
+                    "pending": max(0, self.totals.get(name, 0) - totals["count"] - skipped)}
+
+    @contextlib.contextmanager
+    def phase(self, name, write=True, **fields):
+        """
+        Times the block as phase name. The yielded dict can be filled with more fields, like bytes.
+        """
+        start = time.monotonic()
+        try:
+            yield fields
+        except BaseException as e:
+            fields.update(ok=False, error=str(e))
+            raise
+        finally:
+            duration = time.monotonic() - start
+            if fields.get("bytes") and duration > 0:
+                fields["bytes_per_second"] = int(fields["bytes"] / duration)
+            self.record(name, duration, write=write, **fields)
+
+    def summary(self):
+        with self.lock:
+            phases = {name: dict(totals, total=round(totals["total"], 3), max=round(totals["max"], 3),
+                                 mean=round(totals["total"] / totals["count"], 3))
+                      for name, totals in self.phases.items()}
+            slowest = sorted(self.lectures, key=lambda lecture: lecture[0], reverse=True)[:self.top]
+            elapsed = time.time() - self.started
+            download_time = phases.get("download", {}).get("total", 0)
+            return {
+                "type": "summary",
+                "time": time.time(),
+                "elapsed": round(elapsed, 3),
+                "downloaded_bytes": self.downloaded_bytes,
+                "download_bytes_per_second": int(self.downloaded_bytes / download_time) if download_time else None,
+                "phases": dict(sorted(phases.items(), key=lambda phase: phase[1]["total"], reverse=True)),
+                "slowest_lectures": [{"lecture": lecture, "duration": round(duration, 3)}
+                                     for duration, lecture in slowest],
+            }
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        summary = self.summary()
+        self._write(summary)
+        logging.info("Run finished in {:.0f}s, downloaded {:.1f} MB".format(summary["elapsed"],
+                                                                           summary["downloaded_bytes"] / 1024 ** 2))
+        for name, totals in list(summary["phases"].items())[:self.top]:
+            logging.info("  {:<14} {:>6} x {:>9.1f}s total {:>8.2f}s mean {:>8.2f}s max".format(
+                name, totals["count"], totals["total"], totals["mean"], totals["max"]))
+        for lecture in summary["slowest_lectures"]:
+            logging.info("  slow lecture {:>8.1f}s {}".format(lecture["duration"], lecture["lecture"]))
+
+
+class SessionBridge:
+    """
+    Shares the authenticated browser session with requests and yt-dlp. The browser cookies of all domains are copied
+    into one keep-alive requests.Session and into a Netscape cookie file that is passed to yt-dlp. Failed responses
+    are retried by RetryPolicy, the session only retries connecting.
+    """
+
+    def __init__(self, driver, user_agent, cookie_file="cookies.txt", pool_size=16, retries=3):
+        self.driver = driver
+        self.cookie_file = os.path.abspath(cookie_file)
+        self.fingerprint = None
+        self.cookies = []
+        self.lock = threading.Lock()
+        self.session = requests.Session()
+        retry = Retry(total=None, connect=retries, read=0, status=0, other=0, backoff_factor=0.5,
+                      allowed_methods=("GET", "HEAD"))
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size, max_retries=retry)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.session.headers["User-Agent"] = user_agent
+
+    def get_browser_cookies(self):
+        # CDP returns the cookies of every domain, get_cookies only those of the current page
+        try:
+            return self.driver.execute_cdp_cmd("Network.getAllCookies", {})["cookies"]
+        except Exception as e:
+            logging.debug("Could not read all cookies over CDP: " + str(e))
+            return self.driver.get_cookies()
+
+    def refresh(self):
+        """
+        Copies the browser cookies into the session and cookie file if they changed since the last call.
+        Must be called from the thread that owns the driver.
+
+        :return: bool
+            True if the cookies changed.
+        """
+        if self.driver is None:
+            return False
+        cookies = self.get_browser_cookies()
+        fingerprint = hash(tuple(sorted((c["name"], c["value"], c.get("domain", ""), c.get("path", "/"))
+                                        for c in cookies)))
+        if fingerprint == self.fingerprint:
+            return False
+
+        self.load_cookies(cookies)
+        self.fingerprint = fingerprint
+        logging.debug("Refreshed session with " + str(len(cookies)) + " browser cookies")
+        return True
+
+    def load_cookies(self, cookies):
+        with self.lock:
+            self.cookies = cookies
+            self.session.cookies.clear()
+            for cookie in cookies:
+                self.session.cookies.set(cookie["name"], cookie["value"], domain=cookie.get("domain", ""),
+                                         path=cookie.get("path", "/"), secure=cookie.get("secure", False))
+            self.write_cookie_file(cookies)
+
+    def write_cookie_file(self, cookies):
+        lines = ["# Netscape HTTP Cookie File"]
+        for cookie in cookies:
+            domain = cookie.get("domain", "")
+            if cookie.get("httpOnly"):
+                domain = "#HttpOnly_" + domain
+            expires = cookie.get("expires", cookie.get("expiry", 0)) or 0
+            lines.append("\t".join([
+                domain,
+                "TRUE" if cookie.get("domain", "").startswith(".") else "FALSE",
+                cookie.get("path", "/"),
+                "TRUE" if cookie.get("secure") else "FALSE",
+                str(int(expires) if expires > 0 else 0),
+                cookie["name"],
+                cookie["value"],
+            ]))
+        # Download workers may be reading the file, so replace it atomically. It holds the live session, only the
+        # current user may read it; a .tmp left by an earlier run is tightened too.
+        tmp_file = self.cookie_file + ".tmp"
+        fd = os.open(tmp_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        os.chmod(tmp_file, 0o600)
+        with open(fd, "w", encoding="utf-8") as f:
+            f.write("\n".join(lines) + "\n")
+        os.replace(tmp_file, self.cookie_file)
+
+    @contextlib.contextmanager
+    def cookie_file_copy(self):
+        """
+        A private copy of the cookie file for one yt-dlp instance. yt-dlp writes its cookie jar back to the file when
+        it closes, concurrent downloads must not do that to the shared file.
+        """
+        fd, path = tempfile.mkstemp(prefix=os.path.basename(self.cookie_file) + ".",
+                                    dir=os.path.dirname(self.cookie_file))
+        os.close(fd)
+        try:
+            if os.path.isfile(self.cookie_file):
+                shutil.copyfile(self.cookie_file, path)
+            yield path
+        finally:
+            os.remove(path)
+
+    def remove_cookie_file(self):
+        if os.path.exists(self.cookie_file):
+            os.remove(self.cookie_file)
+
+
+class SessionProfile:
+    """
+    Encrypted store for the cookies and local storage of an authenticated browser, one file per school in
+    profiles/<host>.bin. Uses AES-GCM with a key derived from the passphrase with scrypt.
+    """
+    MAGIC = b"TDL1"
+
+    def __init__(self, school_url, passphrase, profile_dir="profiles"):
+        self.host = urlparse(school_url).netloc
+        self.path = os.path.join(os.path.abspath(profile_dir), clean_string(self.host) + ".bin")
+        self.passphrase = passphrase.encode("utf-8")
+
+    def _derive_key(self, salt):
+        return hashlib.scrypt(self.passphrase, salt=salt, n=2 ** 14, r=8, p=1, dklen=32)
+
+    def save(self, state):
+        salt = os.urandom(16)
+        cipher = AES.new(self._derive_key(salt), AES.MODE_GCM)
+        ciphertext, tag = cipher.encrypt_and_digest(json.dumps(state).encode("utf-8"))
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(self.MAGIC + salt + cipher.nonce + tag + ciphertext)
+        os.chmod(tmp_path, 0o600)
+        os.replace(tmp_path, self.path)
+        logging.info("Saved session profile: " + self.path)
+
+    def load(self):
+        if not os.path.isfile(self.path):
+            return None
+        with open(self.path, "rb") as f:
+            data = f.read()
+        if not data.startswith(self.MAGIC):
+            logging.warning("Ignoring unknown session profile format: " + self.path)
+            return None
+        salt, nonce, tag = data[4:20], data[20:36], data[36:52]
+        try:
+            cipher = AES.new(self._derive_key(salt), AES.MODE_GCM, nonce=nonce)
+            return json.loads(cipher.decrypt_and_verify(data[52:], tag))
+        except ValueError:
+            logging.warning("Could not decrypt session profile, wrong session key? " + self.path)
+            return None
+
+    def delete(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+class ConcurrencyController:
+    """
+    AIMD controller for fragment concurrency, shared by all active downloads. Every download gets a limit between
+    min_concurrency and max_concurrency that grows by one while its throughput keeps up and halves on errors or
+    throttling. The limits of all active downloads together never exceed the budget: a download registers once there
+    is room for min_concurrency fragments, unless it is the only one.
+    """
+
+    def __init__(self, min_concurrency=2, max_concurrency=16, budget=32, interval=2.0):
+        self.min_concurrency = min_concurrency
+        self.max_concurrency = max_concurrency
+        self.budget = budget
+        self.interval = interval
+        # Starting point for new downloads, follows what worked for the previous ones
+        self.preferred = min(max_concurrency, max(min_concurrency, 8))
+        self.condition = threading.Condition()
+        self.downloads = {}
+
+    def _headroom(self, download_id):
+        used = sum(state["limit"] for key, state in self.downloads.items() if key != download_id)
+        return self.budget - used
+
+    def register(self, download_id):
+        with self.condition:
+            while self.downloads and self._headroom(download_id) < self.min_concurrency:
+                self.condition.wait()
+            limit = max(self.min_concurrency, min(self.preferred, self._headroom(download_id)))
+            self.downloads[download_id] = {"limit": limit, "bytes": 0, "errors": 0, "throttled": 0,
+                                           "since": time.time(), "rate": 0.0}
+            logging.debug("Starting download with fragment concurrency " + str(limit))
+            return limit
+
+    def unregister(self, download_id, failed=False):
+        with self.condition:
+            state = self.downloads.pop(download_id, None)
+            if state is None:
+                return
+            self.condition.notify_all()
+            if failed:
+                self.preferred = max(self.min_concurrency, self.preferred // 2)
+            else:
+                self.preferred = state["limit"]
+
+    def limit(self, download_id):
+        with self.condition:
+            state = self.downloads.get(download_id)
+            return state["limit"] if state else self.min_concurrency
+
+    def report(self, download_id, nbytes=0, error=False, status=None):
+        with self.condition:
+            state = self.downloads.get(download_id)
+            if state is None:
+                return
+            state["bytes"] += nbytes
+            if status == 429:
+                state["throttled"] += 1
+            elif error:
+                state["errors"] += 1
+
+            elapsed = time.time() - state["since"]
+            if elapsed < self.interval:
+                return
+            rate = state["bytes"] / elapsed
+            limit = state["limit"]
+            if state["throttled"] or state["errors"]:
+                # Multiplicative decrease
+                limit = max(self.min_concurrency, limit // 2)
+            elif rate >= state["rate"] * 0.95:
+                # Additive increase while more parallelism still pays off
+                limit = max(self.min_concurrency, min(self.max_concurrency, limit + 1, self._headroom(download_id)))
+            if limit != state["limit"]:
+                logging.debug("Fragment concurrency {} -> {} ({:.0f} KiB/s, {} errors, {} throttled)".format(
+                    state["limit"], limit, rate / 1024, state["errors"], state["throttled"]))
+                if limit < state["limit"]:
+                    self.condition.notify_all()
+            state.update(limit=limit, bytes=0, errors=0, throttled=0, since=time.time(), rate=rate)
+
+
+class YtDlpLogger:
+    """
+    Sends yt-dlp's output to logging and reports the fragment retries it logs to the concurrency controller, so
+    errors and 429s of yt-dlp downloads also decrease their concurrency.
+    """
+
+    def __init__(self, controller, download_id):
+        self.controller = controller
+        self.download_id = download_id
+
+    def debug(self, message):
+        # yt-dlp passes its info messages to debug too, only the real debug messages carry the prefix
+        if message.startswith("[debug] "):
+            logging.debug(message)
+        else:
+            self.info(message)
+
+    def info(self, message):
+        if "Got error:" in message:
+            match = HTTP_STATUS_PATTERN.search(message)
+            self.controller.report(self.download_id, error=True, status=int(match.group(1)) if match else None)
+        logging.info(message)
+
+    def warning(self, message):
+        logging.warning(message)
+
+    def error(self, message):
+        logging.error(message)
+
+
+class BandwidthScheduler:
+    """
+    Shared limits for every transfer of the downloader: a global bytes per second cap that can change with the time
+    of day, split evenly between the courses that are downloading, and a maximum number of concurrent transfers per
+    host. Transfers register with transfer() and report what they receive through the returned consume function,
+    which blocks while their course is over its share.
+    """
+
+    def __init__(self, profile=None, host_limits=None, default_host_limit=0, idle_timeout=1.0):
+        self.profile = sorted(profile or [])
+        self.host_limits = host_limits or {}
+        self.default_host_limit = default_host_limit
+        self.idle_timeout = idle_timeout
+        self.condition = threading.Condition()
+        self.hosts = {}
+        self.courses = {}
+        self.updated = time.monotonic()
+        # Bytes received per thread, for the status endpoint
+        self.transferred = collections.Counter()
+        self.last_transfer = None
+
+    def count(self, nbytes):
+        # Called with the condition held
+        self.transferred[threading.current_thread().name] += nbytes
+        self.last_transfer = time.time()
+
+    def transferred_by_thread(self):
+        with self.condition:
+            return dict(self.transferred)
+
+    def rate(self):
+        """
+        :return: int The global cap in bytes per second at this time of day, 0 if unlimited.
+        """
+        if not self.profile:
+            return 0
+        now = time.localtime()
+        minute = now.tm_hour * 60 + now.tm_min
+        rate = self.profile[-1][1]  # Still the last rate of the previous day
+        for start, profile_rate in self.profile:
+            if start <= minute:
+                rate = profile_rate
+        return rate
+
+    def host_limit(self, host):
+        # host_limits is replaced, never changed, so it can be read without the lock
+        for suffix, limit in self.host_limits.items():
+            if host == suffix or host.endswith("." + suffix):
+                return limit
+        return self.default_host_limit
+
+    def add_host_limit(self, host, limit):
+        """
+        Limits host unless it already has a limit.
+        """
+        with self.condition:
+            if host not in self.host_limits:
+                self.host_limits = dict(self.host_limits, **{host: limit})
+
+    def share(self):
+        """
+        :return: int The bytes per second each downloading course may use, 0 if unlimited.
+        """
+        with self.condition:
+            active = sum(1 for state in self.courses.values() if state["transfers"])
+        return self.rate() // max(1, active)
+
+    def _refill(self):
+        now = time.monotonic()
+        elapsed = now - self.updated
+        self.updated = now
+        # Courses are kept for a moment after their last transfer so short gaps don't reset their debt
+        for course in [course for course, state in self.courses.items()
+                       if not state["transfers"] and now - state["idle_since"] > self.idle_timeout]:
+            del self.courses[course]
+        rate = self.rate()
+        if not rate:
+            return 0
+        active = [state for state in self.courses.values() if state["transfers"]]
+        share = rate / max(1, len(active))
+        for state in active:
+            # Bursts are limited to one second worth of the share
+            state["tokens"] = min(state["tokens"] + elapsed * share, share)
+        return share
+
+    @contextlib.contextmanager
+    def transfer(self, url, course=None, slot=True):
+        """
+        Holds a transfer slot of the host of url while the block runs.
+
+        :param url: str
+            The URL that is downloaded.
+        :param course: str
+            The course the transfer belongs to, bandwidth is shared evenly between courses.
+        :param slot: bool
+            False only counts the transfer for the share of its course. For downloads made of many requests that
+            can't be limited one by one (yt-dlp, Chrome), a slot would block the host for the whole download.
+        :return: function consume(nbytes) to call with the size of every received chunk
+        """
+        host = (urlparse(url).hostname or "").lower()
+        limit = self.host_limit(host) if slot else 0
+        with self.condition:
+            while limit and self.hosts.get(host, 0) >= limit:
+                self.condition.wait()
+            if slot:
+                self.hosts[host] = self.hosts.get(host, 0) + 1
+            self._refill()
+            state = self.courses.setdefault(course, {"tokens": 0.0, "transfers": 0, "idle_since": 0})
+            state["transfers"] += 1
+        try:
+            yield functools.partial(self.consume, course)
+        finally:
+            with self.condition:
+                if slot:
+                    self.hosts[host] -= 1
+                    if not self.hosts[host]:
+                        del self.hosts[host]
+                state["transfers"] -= 1
+                state["idle_since"] = time.monotonic()
+                self.condition.notify_all()
+
+    def consume(self, course, nbytes):
+        """
+        Takes nbytes from the share of course, waiting while the course is in debt.
+        """
+        with self.condition:
+            self.count(nbytes)
+            while True:
+                share = self._refill()
+                state = self.courses.get(course)
+                if not share or state is None:
+                    return
+                if state["tokens"] >= 0:
+                    # Chunks larger than the bucket are allowed and paid back before the next one
+                    state["tokens"] -= nbytes
+                    return
+                self.condition.wait(min(1.0, -state["tokens"] / share + 0.01))
+
+    def charge(self, course, nbytes):
+        """
+        Takes nbytes from the share of course without waiting, for transfers that limit themselves (yt-dlp, Chrome).
+        """
+        with self.condition:
+            self.count(nbytes)
+            self._refill()
+            state = self.courses.get(course)
+            if state is not None and self.rate():
+                state["tokens"] -= nbytes
+
+
+HTTP_STATUS_PATTERN = re.compile(r"HTTP Error (\d{3})")
+
+
+def classify_error(error):
+    """
+    Sorts an exception of requests or yt-dlp into the kinds of failure the retry policy handles differently.
+
+    :return: str "timeout", "connection", "expired" (signed URL or token no longer valid), "throttled" (429),
+        "server" (5xx), "client" (other 4xx) or "other"
+    """
+    status = getattr(getattr(error, "response", None), "status_code", None)
+    if status is None:
+        # yt-dlp only reports the status in its message
+        match = HTTP_STATUS_PATTERN.search(str(error))
+        status = int(match.group(1)) if match else None
+    if status is not None:
+        if status in (401, 403, 410):
+            return "expired"
+        if status == 429:
+            return "throttled"
+        if status >= 500:
+            return "server"
+        if status >= 400:
+            return "client"
+    if isinstance(error, requests.exceptions.RetryError) or \
+            (isinstance(error, MaxRetryError) and isinstance(error.reason, ResponseError)):
+        # A status that urllib3 retried until it gave up
+        return "server"
+    if isinstance(error, requests.Timeout) or "timed out" in str(error).lower():
+        return "timeout"
+    if isinstance(error, (requests.ConnectionError, ConnectionError)):
+        return "connection"
+    return "other"
+
+
+class CircuitBreaker:
+    """
+    Pauses all requests to a host after threshold consecutive failures. After the cooldown one request is let
+    through: if it succeeds the host is closed again, if it fails the host stays open for twice as long.
+    """
+
+    def __init__(self, threshold=5, cooldown=60, max_cooldown=600):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self.condition = threading.Condition()
+        self.hosts = {}
+
+    def _state(self, host):
+        return self.hosts.setdefault(host, {"failures": 0, "open_until": 0, "cooldown": self.cooldown,
+                                            "probing": False})
+
+    def wait(self, host):
+        """
+        Blocks while the circuit of host is open.
+        """
+        with self.condition:
+            state = self._state(host)
+            while True:
+                remaining = state["open_until"] - time.monotonic()
+                if state["failures"] < self.threshold or (remaining <= 0 and not state["probing"]):
+                    if state["failures"] >= self.threshold:
+                        # Half open, this request is the probe
+                        state["probing"] = True
+                    return
+                self.condition.wait(max(remaining, 1))
+
+    def success(self, host):
+        with self.condition:
+            state = self._state(host)
+            if state["failures"] >= self.threshold:
+                logging.info("Circuit closed for host: " + host)
+            state.update(failures=0, probing=False, cooldown=self.cooldown)
+            self.condition.notify_all()
+
+    def release(self, host):
+        """
+        Ends a request that neither closes nor reopens the circuit, e.g. a 404: the host answered, but the request
+        does not tell whether it is healthy again. A probe lets the next request through.
+        """
+        with self.condition:
+            state = self._state(host)
+            if state["probing"]:
+                state["probing"] = False
+                self.condition.notify_all()
+
+    def failure(self, host):
+        with self.condition:
+            state = self._state(host)
+            state["failures"] += 1
+            if state["probing"]:
+                state["cooldown"] = min(state["cooldown"] * 2, self.max_cooldown)
+                state["probing"] = False
+            if state["failures"] >= self.threshold:
+                state["open_until"] = time.monotonic() + state["cooldown"]
+                logging.warning("Circuit open for host: " + host + ", pausing for " + str(state["cooldown"]) + "s")
+            self.condition.notify_all()
+
+
+class RetryPolicy:
+    """
+    Retries HTTP and yt-dlp calls with exponential backoff and full jitter, honouring Retry-After on 429. Every
+    attempt goes through the circuit breaker of its host. An expired signed URL is not retried as is: the on_expired
+    callback is asked for a fresh URL instead.
+    """
+
+    RETRYABLE = {"timeout", "connection", "throttled", "server"}
+
+    def __init__(self, breaker, retries=3, base_delay=1.0, max_delay=60.0, refreshes=2):
+        self.breaker = breaker
+        self.retries = retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.refreshes = refreshes
+
+    def backoff(self, attempt, error=None):
+        delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+        retry_after = getattr(getattr(error, "response", None), "headers", {}).get("Retry-After")
+        if retry_after and retry_after.isdigit():
+            delay = max(delay, min(int(retry_after), self.max_delay))
+        return delay
+
+    def call(self, fn, url, on_expired=None, retries=None):
+        """
+        Calls fn(url) until it succeeds.
+
+        :param fn: function
+            Called with the URL to use.
+        :param url: str
+            The URL of the first attempt.
+        :param on_expired: function
+            Called with the expired URL, returns a fresh one or None.
+        :param retries: int
+            Overrides the number of retries, e.g. 0 for calls that already retry internally.
+        :return: the result of fn
+        """
+        retries = self.retries if retries is None else retries
+        attempt = 0
+        refreshes = 0
+        while True:
+            host = urlparse(url).hostname or ""
+            self.breaker.wait(host)
+            try:
+                result = fn(url)
+            except Exception as e:
+                kind = classify_error(e)
+                if kind in self.RETRYABLE:
+                    self.breaker.failure(host)
+                else:
+                    self.breaker.release(host)
+                if kind == "expired" and on_expired is not None and refreshes < self.refreshes:
+                    refreshes += 1
+                    fresh_url = on_expired(url)
+                    if fresh_url:
+                        logging.info("Refreshed expired URL of host: " + host)
+                        url = fresh_url
+                        continue
+                if kind not in self.RETRYABLE or attempt >= retries:
+                    raise
+                delay = self.backoff(attempt, e)
+                attempt += 1
+                logging.debug("Retrying " + url + " in {:.1f}s ({}, attempt {}) cause: {}".format(
+                    delay, kind, attempt, e))
+                time.sleep(delay)
+                continue
+            except BaseException:
+                self.breaker.release(host)
+                raise
+            self.breaker.success(host)
+            return result
+
+
+class NotHlsError(ValueError):
+    pass
+
+
+def hls_part_files(output_file):
+    # The segments of each rendition and a record of how many of them are complete, kept until the remux succeeds
+    parts = [output_file + ".video.part", output_file + ".audio.part"]
+    return parts + [part + ".progress" for part in parts]
+
+
+class HlsDownloader:
+    """
+    Downloads an HLS playlist without yt-dlp. Picks the best variant, fetches the segments concurrently over a pooled
+    session, decrypts AES-128 segments in-process and writes them in playlist order into one file per rendition,
+    which ffmpeg remuxes into the final mp4 in a single stream copy. An interrupted download continues after the last
+    segment that was written.
+    """
+
+    def __init__(self, session, headers, controller, scheduler, policy, course=None, timeout=30, verbose=False):
+        self.session = session
+        self.headers = headers
+        self.controller = controller
+        self.scheduler = scheduler
+        self.policy = policy
+        self.course = course
+        self.timeout = timeout
+        self.verbose = verbose
+        self.keys = {}
+        self.keys_lock = threading.Lock()
+
+    def get(self, url, byte_range=None, playlist=False):
+        """
+        :param playlist: bool
+            Stops reading as soon as the response turns out not to be an HLS playlist, so a link to a plain video
+            file is not downloaded here and again by the fallback.
+        """
+        headers = dict(self.headers)
+        if byte_range is not None:
+            headers["Range"] = "bytes={}-{}".format(byte_range[0], byte_range[0] + byte_range[1] - 1)
+
+        def fetch(url):
+            try:
+                with self.scheduler.transfer(url, self.course) as consume:
+                    with self.session.get(url, headers=headers, stream=True, timeout=self.timeout) as response:
+                        response.raise_for_status()
+                        content_type = response.headers.get("Content-Type", "").lower()
+                        if playlist and content_type.startswith(("video/", "audio/")) and "mpegurl" not in content_type:
+                            raise NotHlsError("Not an HLS playlist (" + content_type + "): " + url)
+                        chunks = []
+                        checked = not playlist
+                        for chunk in response.iter_content(chunk_size=64 * 1024 if playlist else 256 * 1024):
+                            consume(len(chunk))
+                            chunks.append(chunk)
+                            if not checked and sum(map(len, chunks)) >= 64:
+                                if not b"".join(chunks).lstrip(b"\xef\xbb\xbf \t\r\n").startswith(b"#EXTM3U"):
+                                    raise NotHlsError("Not an HLS playlist: " + url)
+                                checked = True
+            except NotHlsError:
+                raise
+            except Exception as e:
+                status = getattr(getattr(e, "response", None), "status_code", None)
+                self.controller.report(self, error=True, status=status)
+                raise
+            content = b"".join(chunks)
+            self.controller.report(self, nbytes=len(content))
+            return content
+
+        return self.policy.call(fetch, url)
+
+    def load_playlist(self, url):
+        text = self.get(url, playlist=True).decode("utf-8-sig")
+        if not text.lstrip().startswith("#EXTM3U"):
+            raise NotHlsError("Not an HLS playlist: " + url)
+        return m3u8.loads(text, uri=url)
+
+    def select_variant(self, master):
+        variant = max(master.playlists, key=lambda playlist: playlist.stream_info.bandwidth or 0)
+        audio = None
+        if variant.stream_info.audio:
+            renditions = [media for media in master.media
+                          if media.type == "AUDIO" and media.group_id == variant.stream_info.audio and media.uri]
+            if renditions:
+                audio = next((media for media in renditions if media.default == "YES"), renditions[0])
+        logging.debug("Selected HLS variant with bandwidth " + str(variant.stream_info.bandwidth))
+        return variant.absolute_uri, audio.absolute_uri if audio else None
+
+    def get_key(self, key):
+        with self.keys_lock:
+            if key.absolute_uri not in self.keys:
+                self.keys[key.absolute_uri] = self.get(key.absolute_uri)
+            return self.keys[key.absolute_uri]
+
+    def fetch_segment(self, segment, sequence, byte_range):
+        data = self.get(segment.absolute_uri, byte_range)
+        key = segment.key
+        if key is None or key.method in (None, "NONE"):
+            return data
+        if key.method != "AES-128":
+            raise ValueError("Unsupported HLS encryption: " + key.method)
+        if key.iv:
+            iv = bytes.fromhex(key.iv[2:] if key.iv.lower().startswith("0x") else key.iv).rjust(16, b"\0")
+        else:
+            # Without an explicit IV the media sequence number is used
+            iv = sequence.to_bytes(16, "big")
+        data = AES.new(self.get_key(key), AES.MODE_CBC, iv).decrypt(data)
+        padding = data[-1] if data else 0
+        if not 1 <= padding <= AES.block_size or data[-padding:] != bytes([padding]) * padding:
+            # Usually a wrong key, e.g. the key URL returned an error page
+            raise ValueError("Invalid padding in decrypted HLS segment: " + segment.absolute_uri)
+        return data[:-padding]
+
+    def load_progress(self, progress_file, output_file, state):
+        """
+        :return: dict The progress of an earlier attempt at the same playlist, or None to start over
+        """
+        try:
+            with open(progress_file, "r", encoding="utf-8") as f:
+                progress = json.load(f)
+        except (OSError, ValueError):
+            return None
+        # Signed playlist URLs change between runs, the path and the segment count identify the rendition
+        if any(progress.get(key) != value for key, value in state.items()):
+            return None
+        if not os.path.isfile(output_file) or os.path.getsize(output_file) < progress["bytes"]:
+            return None
+        return progress
+
+    def save_progress(self, progress_file, progress):
+        tmp_file = progress_file + ".tmp"
+        with open(tmp_file, "w", encoding="utf-8") as f:
+            json.dump(progress, f)
+        os.replace(tmp_file, progress_file)
+
+    def download_playlist(self, url, output_file):
+        playlist = self.load_playlist(url)
+        if playlist.is_variant:
+            raise ValueError("Nested variant playlist: " + url)
+
+        jobs = []
+        next_offset = 0
+        for i, segment in enumerate(playlist.segments):
+            byte_range = None
+            if segment.byterange:
+                length, _, offset = segment.byterange.partition("@")
+                offset = int(offset) if offset else next_offset
+                byte_range = (offset, int(length))
+                next_offset = offset + int(length)
+            jobs.append((segment, playlist.media_sequence + i, byte_range))
+
+        progress_file = output_file + ".progress"
+        progress = self.load_progress(progress_file, output_file, {"playlist": urlparse(url).path,
+                                                                   "segments": len(jobs)})
+        if progress is not None:
+            logging.info("Resuming HLS download after segment " + str(progress["completed"]) + " of " +
+                         str(len(jobs)) + ": " + output_file)
+        else:
+            progress = {"playlist": urlparse(url).path, "segments": len(jobs), "completed": 0, "bytes": 0}
+
+        first = progress["completed"]
+        written = 0
+        with open(output_file, "r+b" if progress["bytes"] else "wb") as f:
+            # Drops whatever was written after the last recorded segment
+            f.truncate(progress["bytes"])
+            f.seek(progress["bytes"])
+            try:
+                if not progress["bytes"] and playlist.segment_map and playlist.segment_map[0].uri:
+                    # fMP4 playlists start with an initialization section
+                    init_section = playlist.segment_map[0]
+                    written += f.write(self.get(init_section.absolute_uri))
+                    progress["bytes"] = f.tell()
+
+                # Segments finish out of order, keep up to the controller's limit in flight and write them in
+                # playlist order
+                saved = time.monotonic()
+                with ThreadPoolExecutor(max_workers=self.controller.max_concurrency) as executor:
+                    futures = {}
+                    next_job = progress["completed"]
+                    for i in range(progress["completed"], len(jobs)):
+                        while next_job < len(jobs) and (next_job <= i or len(futures) < self.controller.limit(self)):
+                            futures[next_job] = executor.submit(self.fetch_segment, *jobs[next_job])
+                            next_job += 1
+                        written += f.write(futures.pop(i).result())
+                        progress.update(completed=i + 1, bytes=f.tell())
+                        if time.monotonic() - saved >= 1:
+                            f.flush()
+                            self.save_progress(progress_file, progress)
+                            saved = time.monotonic()
+            finally:
+                f.flush()
+                self.save_progress(progress_file, progress)
+        logging.debug("Downloaded " + str(len(jobs) - first) + " HLS segments (" + str(written) + " bytes) from " + url)
+        return written
+
+    def remux(self, inputs, output_file, title):
+        ffmpeg = shutil.which("ffmpeg")
+        if ffmpeg is None:
+            raise FileNotFoundError("ffmpeg not found")
+        command = [ffmpeg, "-y", "-loglevel", "error"]
+        for input_file in inputs:
+            command += ["-i", input_file]
+        for i in range(len(inputs)):
+            command += ["-map", str(i)]
+        command += ["-c", "copy", "-metadata", "title=" + title, "-movflags", "+faststart", output_file]
+        subprocess.run(command, check=True, capture_output=not self.verbose)
+
+    def download(self, url, output_file, title):
+        """
+        Downloads an HLS stream into output_file.
+
+        :param url: str
+            Master or media playlist URL.
+        :param output_file: str
+            Path of the mp4 to write.
+        :param title: str
+            Written to the title metadata of the mp4.
+        :return: int
+            The number of bytes downloaded.
+        """
+        self.controller.register(self)
+        failed = True
+        parts = hls_part_files(output_file)[:2]
+        try:
+            playlist = self.load_playlist(url)
+            video_url, audio_url = self.select_variant(playlist) if playlist.is_variant else (url, None)
+            if not audio_url:
+                parts.pop()
+
+            size = self.download_playlist(video_url, parts[0])
+            if audio_url:
+                size += self.download_playlist(audio_url, parts[1])
+            tmp_file = output_file + ".remux.mp4"
+            self.remux(parts, tmp_file, title)
+            os.replace(tmp_file, output_file)
+            failed = False
+        finally:
+            self.controller.unregister(self, failed=failed)
+            # The segments are kept for the next attempt unless the mp4 is done
+            for part in (hls_part_files(output_file) if not failed else []) + [output_file + ".remux.mp4"]:
+                if os.path.exists(part):
+                    os.remove(part)
+        return size
+
+
+class BrowserDownloadTracker:
+    """
+    Follows Chrome downloads through the DevTools download events (downloadWillBegin / downloadProgress) that the
+    driver records in its performance log. Files are saved under their download GUID and renamed once Chrome reports
+    them complete, so several downloads can be in flight in the same directory.
+    """
+
+    def __init__(self, driver, stall_timeout=120, poll_interval=0.2, start_timeout=15):
+        self.driver = driver
+        self.stall_timeout = stall_timeout
+        self.poll_interval = poll_interval
+        self.start_timeout = start_timeout
+        self.downloads = {}
+
+    def start(self, output_path):
+        self.driver.execute_cdp_cmd("Browser.setDownloadBehavior", {
+            "behavior": "allowAndName",
+            "downloadPath": output_path,
+            "eventsEnabled": True,
+        })
+        self.downloads = {}
+        self.output_path = output_path
+        self.driver.get_log("performance")  # Drop events from before this download
+
+    def drain(self):
+        """
+        Drops the recorded events. The driver keeps logging every page load for the whole run, so the log is emptied
+        after each lecture instead of growing until the next browser download.
+        """
+        try:
+            self.driver.get_log("performance")
+        except Exception as e:
+            logging.debug("Could not drain the performance log: " + str(e))
+
+    def poll(self):
+        for entry in self.driver.get_log("performance"):
+            message = json.loads(entry["message"])["message"]
+            method = message.get("method", "")
+            params = message.get("params", {})
+            if method.endswith(".downloadWillBegin"):
+                self.downloads[params["guid"]] = {
+                    "guid": params["guid"], "url": params.get("url"),
+                    "suggested_filename": params.get("suggestedFilename", ""),
+                    "received": 0, "total": 0, "state": "inProgress", "updated": time.time(),
+                    "path": os.path.join(self.output_path, params["guid"]),
+                }
+            elif method.endswith(".downloadProgress") and params.get("guid") in self.downloads:
+                download = self.downloads[params["guid"]]
+                if params.get("receivedBytes", 0) != download["received"] or params.get("state") != download["state"]:
+                    download["updated"] = time.time()
+                download.update(received=params.get("receivedBytes", 0), total=params.get("totalBytes", 0),
+                                state=params.get("state", download["state"]))
+
+    def cancel(self, download):
+        try:
+            self.driver.execute_cdp_cmd("Browser.cancelDownload", {"guid": download["guid"]})
+        except Exception as e:
+            logging.debug("Could not cancel download: " + str(e))
+
+    def wait(self, expected, timeout=-1):
+        """
+        Waits for the downloads that were started since start().
+
+        :param expected: int
+            Number of downloads that were triggered.
+        :param timeout: int
+            Overall timeout in seconds, -1 to rely on the stall watchdog only.
+        :return: List[dict]
+            The completed downloads, in the order they started. Empty if any of them failed.
+        """
+        start_time = time.time()
+        last_report = start_time
+        while True:
+            self.poll()
+            downloads = list(self.downloads.values())
+            now = time.time()
+
+            if len(downloads) < expected and now - start_time > self.start_timeout:
+                logging.warning("Browser did not start the download")
+                return []
+            if any(download["state"] == "canceled" for download in downloads):
+                logging.warning("Browser download was canceled")
+                return []
+            if len(downloads) >= expected and all(download["state"] == "completed" for download in downloads):
+                return downloads
+
+            for download in downloads:
+                if download["state"] == "inProgress" and now - download["updated"] > self.stall_timeout:
+                    logging.warning("Download stalled for " + str(self.stall_timeout) + "s: " + str(download["url"]))
+                    for pending in downloads:
+                        self.cancel(pending)
+                    return []
+            if timeout > 0 and now - start_time > timeout:
+                for pending in downloads:
+                    self.cancel(pending)
+                return []
+
+            if now - last_report > 5:
+                last_report = now
+                for download in downloads:
+                    logging.info("Downloading {}: {:.1f}/{:.1f} MiB".format(
+                        download["suggested_filename"], download["received"] / 2 ** 20, download["total"] / 2 ** 20))
+            time.sleep(self.poll_interval)
+
+
+EMBED_URLS_SCRIPT = "return [...document.querySelectorAll(\"iframe[data-testid^='embed-player']\")].map(f => f.src)"
+
+
+class LecturePrefetcher:
+    """
+    Opens the next lectures in background tabs of the same browser, so their pages load while the current lecture is
+    handled. Once a tab has loaded, its HTML and embed URLs are read and the media URLs are resolved over HTTP in the
+    background. At most depth tabs are open besides the current one, to bound the memory used by Chrome.
+    """
+
+    def __init__(self, driver, depth, get_session, resolve):
+        self.driver = driver
+        self.depth = depth
+        self.get_session = get_session
+        self.resolve = resolve
+        self.tabs = {}
+        self.executor = ThreadPoolExecutor(max_workers=max(1, depth), thread_name_prefix="prefetch")
+
+    def schedule(self, links):
+        """
+        Opens a tab for each of the first depth links that does not have one yet.
+        """
+        for link in links[:self.depth]:
+            if link in self.tabs or len(self.tabs) >= self.depth:
+                continue
+            handles = set(self.driver.window_handles)
+            # window.open does not wait for the page to load, unlike driver.get
+            self.driver.execute_script("window.open(arguments[0], '_blank')", link)
+            opened = set(self.driver.window_handles) - handles
+            if not opened:
+                logging.debug("Could not open prefetch tab for: " + link)
+                return
+            self.tabs[link] = {"handle": opened.pop(), "html": None, "embed_urls": None, "media": None}
+            logging.debug("Prefetching lecture: " + link)
+
+    def harvest(self):
+        """
+        Reads the pages of the tabs that finished loading and show their players, and starts resolving their media
+        URLs.
+        """
+        current = self.driver.current_window_handle
+        session = None
+        try:
+            for link, tab in self.tabs.items():
+                if tab["html"] is not None:
+                    continue
+                self.driver.switch_to.window(tab["handle"])
+                if self.driver.execute_script("return document.readyState") != "complete":
+                    continue
+                # The players may still be rendering, look again on the next harvest. A tab that never shows one is
+                # left to the waiting read of the current lecture.
+                embed_urls = self.driver.execute_script(EMBED_URLS_SCRIPT)
+                if not embed_urls:
+                    continue
+                tab["html"] = self.driver.page_source
+                tab["embed_urls"] = embed_urls
+                if session is None:
+                    session = self.get_session()
+                tab["media"] = self.executor.submit(self.resolve, tab["embed_urls"], link, session)
+        finally:
+            self.driver.switch_to.window(current)
+
+    def take(self, link):
+        """
+        Makes the tab of link the current window and closes the previous one.
+
+        :return: dict with the prefetched html, embed_urls and media future (None until the tab was harvested),
+            or None if link was not prefetched
+        """
+        tab = self.tabs.pop(link, None)
+        if tab is None:
+            return None
+        self.driver.close()
+        self.driver.switch_to.window(tab["handle"])
+        return tab
+
+    def close(self):
+        current = self.driver.current_window_handle
+        for tab in self.tabs.values():
+            try:
+                self.driver.switch_to.window(tab["handle"])
+                self.driver.close()
+            except Exception as e:
+                logging.debug("Could not close prefetch tab: " + str(e))
+        self.tabs = {}
+        self.driver.switch_to.window(current)
+        self.executor.shutdown(wait=False)
+
+
+class AttachmentFetcher:
+    """
+    Downloads lecture attachments in the background over the shared session. Files are streamed to a .part file that
+    is resumed with a Range request, skipped on re-sync when the server reports them unchanged (ETag/Last-Modified
+    stored in the course manifest) and renamed into place once complete.
+    """
+
+    def __init__(self, session, scheduler, policy, report, store=None, workers=4, timeout=30,
+                 chunk_size=1024 * 1024):
+        self.session = session
+        self.scheduler = scheduler
+        self.policy = policy
+        self.report = report
+        self.store = store
+        self.timeout = timeout
+        self.chunk_size = chunk_size
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="attachment-worker")
+        self.futures = []
+
+    def submit(self, url, file_name, output_path, manifest):
+        self.futures.append(self.executor.submit(self._fetch, url, file_name, output_path, manifest))
+
+    def join(self):
+        for future in self.futures:
+            future.exception()
+        self.futures = []
+
+    def _fetch(self, url, file_name, output_path, manifest):
+        try:
+            with self.report.phase("attachment", file=file_name) as fields:
+                # A retry resumes from the .part file
+                fields["bytes"] = self.policy.call(lambda url: self.fetch(url, file_name, output_path, manifest), url)
+        except Exception as e:
+            logging.warning("Could not download attachment: " + file_name + " cause: " + str(e))
+            manifest.update("attachment:" + url, status="failed", error=str(e))
+
+    def fetch(self, url, file_name, output_path, manifest):
+        key = "attachment:" + url
+        target = os.path.join(output_path, file_name)
+        part_file = target + ".part"
+        entry = manifest.get(key) or {}
+        validators = {}
+        if entry.get("etag"):
+            validators["If-None-Match"] = entry["etag"]
+        if entry.get("last_modified"):
+            validators["If-Modified-Since"] = entry["last_modified"]
+
+        if self.store is not None and not os.path.isfile(target) and self.store.link(asset_id(url), target):
+            manifest.update(key, link=url, output_path=target, status="complete", size=os.path.getsize(target))
+            return 0
+
+        headers = {}
+        offset = os.path.getsize(part_file) if os.path.isfile(part_file) else 0
+        if os.path.isfile(target):
+            if not validators:
+                logging.info("Skipping existing attachment: " + file_name)
+                if entry.get("status") != "complete":
+                    manifest.update(key, link=url, output_path=target, status="complete",
+                                    size=os.path.getsize(target))
+                return 0
+            headers.update(validators)
+        elif offset and validators:
+            # Only resume if the file didn't change since the part was written
+            headers["Range"] = "bytes={}-".format(offset)
+            headers["If-Range"] = entry.get("etag") or entry["last_modified"]
+
+        with self.scheduler.transfer(url, manifest.course_path) as consume, \
+                self.session.get(url, headers=headers, stream=True, timeout=self.timeout) as response:
+            if response.status_code == 304:
+                logging.info("Attachment unchanged: " + file_name)
+                if entry.get("status") != "complete":
+                    manifest.update(key, status="complete")
+                return 0
+            response.raise_for_status()
+            resumed = response.status_code == 206
+            manifest.update(key, link=url, output_path=target, status="downloading",
+                            etag=response.headers.get("ETag"), last_modified=response.headers.get("Last-Modified"))
+            logging.info(("Resuming" if resumed else "Downloading") + " attachment: " + file_name)
+            received = 0
+            with open(part_file, "ab" if resumed else "wb") as f:
+                for chunk in response.iter_content(chunk_size=self.chunk_size):
+                    consume(len(chunk))
+                    received += f.write(chunk)
+
+        os.replace(part_file, target)
+        manifest.update(key, status="complete", size=os.path.getsize(target))
+        logging.info("Downloaded attachment: " + file_name)
+        if self.store is not None:
+            self.store.add(target, asset_id(url))
+        return received
+
+
+class PostprocessPool:
+    """
+    Runs the ffmpeg postprocessing of downloaded videos in a process pool sized to the cores, so the download workers
+    can start the next video while the CPUs mux the previous ones.
+    """
+
+    def __init__(self, report, workers=None):
+        self.report = report
+        self.executor = ProcessPoolExecutor(max_workers=workers or os.cpu_count(),
+                                            mp_context=multiprocessing.get_context("spawn"))
+        self.pending = []
+        self.lock = threading.Lock()
+
+    def submit(self, output_file, title, manifest, video_key, on_complete=None):
+        future = self.executor.submit(timed_postprocess_video, output_file, title)
+        # Set once the manifest is updated, the future itself resolves before its callbacks have run
+        finished = threading.Event()
+
+        def done(future):
+            try:
+                mode, duration = future.result()
+                self.report.record("postprocess", duration, video=title, mode=mode)
+                logging.info("Postprocessed video (" + mode + "): " + title)
+                manifest.update(video_key, status="complete", size=os.path.getsize(output_file))
+                if on_complete is not None:
+                    on_complete(output_file)
+            except Exception as e:
+                self.report.record("postprocess", 0, video=title, ok=False, error=str(e))
+                logging.error("Could not postprocess video: " + title + " cause: " + str(e))
+                manifest.update(video_key, status="failed", error=str(e))
+            finally:
+                finished.set()
+
+        future.add_done_callback(done)
+        with self.lock:
+            self.pending.append(finished)
+
+    def running(self):
+        # Finished jobs stay in pending until join()
+        with self.lock:
+            return sum(1 for finished in self.pending if not finished.is_set())
+
+    def join(self):
+        with self.lock:
+            pending, self.pending = self.pending, []
+        for finished in pending:
+            finished.wait()
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+
+class DownloadPipeline:
+    """
+    Bounded producer/consumer queue for video downloads. The browser thread only resolves lectures to media URLs
+    and submits jobs, a pool of worker threads drains the queue and runs the actual downloads.
+    """
+
+    def __init__(self, worker_fn, workers=2, queue_size=8):
+        self.worker_fn = worker_fn
+        self.workers = workers
+        self.jobs = queue.Queue(maxsize=queue_size)
+        self.threads = []
+
+    def start(self):
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._work, name="download-worker-{}".format(i + 1), daemon=True)
+            thread.start()
+            self.threads.append(thread)
+        logging.info("Started download pipeline with " + str(self.workers) + " workers")
+
+    def submit(self, **job):
+        # Blocks while the queue is full so the browser can't run too far ahead of the downloads
+        self.jobs.put(job)
+        logging.debug("Queued download: " + job.get("title", "") + " (queue size: " + str(self.jobs.qsize()) + ")")
+
+    def join(self):
+        for _ in self.threads:
+            self.jobs.put(None)
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+
+    def _work(self):
+        while True:
+            job = self.jobs.get()
+            try:
+                if job is None:
+                    return
+                self.worker_fn(**job)
+            except Exception as e:
+                logging.error("Download worker failed: " + job.get("title", "") + " cause: " + str(e))
+            finally:
+                self.jobs.task_done()
+
+
+class DownloadManifest:
+    """
+    Append-only JSON-lines record of every lecture and video of a course, stored in courses/<title>/manifest.jsonl.
+    The last line written for a key wins, so a crash can at most lose the entry that was being written.
+    """
+    # Runs that must find no player on a lecture before it is taken to have no video, a single look can miss
+    # players that render late
+    NO_VIDEO_CHECKS = 2
+
+    def __init__(self, course_path):
+        self.course_path = course_path
+        self.path = os.path.join(course_path, "manifest.jsonl")
+        self.lock = threading.Lock()
+        self.entries = {}
+        self._load()
+
+    def _load(self):
+        if not os.path.isfile(self.path):
+            return
+        with open(self.path, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    logging.warning("Skipping corrupt manifest line in " + self.path)
+                    continue
+                self.entries.setdefault(record["key"], {}).update(record)
+        logging.info("Loaded manifest with " + str(len(self.entries)) + " entries: " + self.path)
+
+    def reload(self):
+        # Picks up entries written by other processes sharing the course
+        with self.lock:
+            self.entries = {}
+            self._load()
+
+    def get(self, key):
+        return self.entries.get(key)
+
+    def update(self, key, **fields):
+        with self.lock:
+            entry = self.entries.setdefault(key, {"key": key})
+            entry.update(fields)
+            record = dict(fields, key=key, updated=time.time())
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(json.dumps(record) + "\n")
+            return entry
+
+    def video_key(self, output_file):
+        return "video:" + os.path.relpath(output_file, self.course_path)
+
+    def lecture_key(self, link):
+        return "lecture:" + link
+
+    def is_video_complete(self, output_file):
+        entry = self.get(self.video_key(output_file))
+        return entry is not None and entry.get("status") == "complete" and os.path.isfile(output_file)
+
+    def move_videos(self, moves):
+        """
+        Moves the entries of renamed video files. All entries are read before any is written, so files that swap
+        names keep their own entries.
+
+        :param moves: List[(str, str)] (old file, new file) pairs
+        """
+        entries = []
+        for old_file, new_file in moves:
+            entry = self.get(self.video_key(old_file))
+            if entry is not None:
+                entries.append((old_file, new_file, {key: value for key, value in entry.items()
+                                                     if key not in ("key", "updated")}))
+        new_keys = {self.video_key(new_file) for _, new_file, _ in entries}
+        for old_file, new_file, fields in entries:
+            self.update(self.video_key(new_file), **dict(fields, output_path=new_file))
+        for old_file, _, _ in entries:
+            if self.video_key(old_file) not in new_keys:
+                self.update(self.video_key(old_file), status="moved")
+
+    def is_lecture_complete(self, link):
+        entry = self.get(self.lecture_key(link))
+        if entry is None:
+            return False
+        if entry.get("status") == "no_video":
+            if entry.get("checks", 0) < self.NO_VIDEO_CHECKS:
+                return False
+        elif entry.get("status") != "complete":
+            return False
+        # Attachments are part of the lecture, a failed one is retried when the lecture is handled again
+        for key in entry.get("videos", []) + entry.get("attachments", []):
+            item = self.get(key)
+            if item is None or item.get("status") != "complete":
+                return False
+        return True
+
+
+@contextlib.contextmanager
+def sqlite_transaction(path):
+    # The rollback journal is used because WAL does not work on network filesystems
+    db = sqlite3.connect(path, timeout=60, isolation_level=None)
+    db.execute("BEGIN IMMEDIATE")
+    try:
+        yield db
+        db.execute("COMMIT")
+    except BaseException:
+        db.execute("ROLLBACK")
+        raise
+    finally:
+        db.close()
+
+
+def file_sha256(path, chunk_size=1024 * 1024):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def link_file(source, target):
+    """
+    Makes target a hardlink of source, or a reflink (copy on write) or plain copy where hardlinks are not possible,
+    e.g. across filesystems.
+
+    :return: str "hardlink", "reflink" or "copy"
+    """
+    tmp_file = target + ".link"
+    if os.path.exists(tmp_file):
+        os.remove(tmp_file)
+    try:
+        os.link(source, tmp_file)
+        mode = "hardlink"
+    except OSError:
+        cp = shutil.which("cp")
+        if cp and subprocess.run([cp, "--reflink=always", source, tmp_file], capture_output=True).returncode == 0:
+            mode = "reflink"
+        else:
+            shutil.copy2(source, tmp_file)
+            mode = "copy"
+    os.replace(tmp_file, target)
+    return mode
+
+
+HOTMART_ASSET_PATTERN = re.compile(r"hotmart\.com/(?:.*/)?video/([^/?#]+)")
+
+
+# Query parameters that sign a URL rather than select what it points to
+SIGNING_PARAMS = {"hdnts", "hdnea", "hdntl", "__token__", "token", "expires", "exp", "e", "signature", "sig",
+                  "policy", "key-pair-id", "hmac", "st", "md5"}
+
+
+def asset_id(url):
+    """
+    Identifies a media asset independently of the signature its URL carries, so the same Hotmart video resolved in
+    two courses gets the same ID. Other query parameters are kept, they may be what selects the media.
+    """
+    match = HOTMART_ASSET_PATTERN.search(url)
+    if match:
+        return "hotmart:" + match.group(1)
+    parsed = urlparse(url)
+    params = sorted((key, value) for key, value in parse_qsl(parsed.query, keep_blank_values=True)
+                    if key.lower() not in SIGNING_PARAMS and not key.lower().startswith("x-amz-"))
+    return parsed.netloc + parsed.path + ("?" + urlencode(params) if params else "")
+
+
+class ContentStore:
+    """
+    Index of downloaded files by media asset ID and sha256, in a SQLite database next to the courses. A file whose
+    asset or content is already on disk is linked to the existing copy instead of being downloaded or kept twice.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with sqlite_transaction(path) as db:
+            db.execute("""
+                CREATE TABLE IF NOT EXISTS files (
+                    path TEXT PRIMARY KEY,
+                    asset TEXT,
+                    sha256 TEXT NOT NULL,
+                    size INTEGER NOT NULL,
+                    updated REAL
+                )""")
+            db.execute("CREATE INDEX IF NOT EXISTS files_asset ON files (asset)")
+            db.execute("CREATE INDEX IF NOT EXISTS files_sha256 ON files (sha256)")
+
+    def _existing(self, db, rows):
+        # Files deleted or changed since they were indexed are dropped from the index
+        for path, size in rows:
+            if os.path.isfile(path) and os.path.getsize(path) == size:
+                return path
+            db.execute("DELETE FROM files WHERE path = ?", (path,))
+        return None
+
+    def lookup(self, asset):
+        """
+        :return: str Path of a downloaded copy of asset, or None
+        """
+        with sqlite_transaction(self.path) as db:
+            return self._existing(db, db.execute("SELECT path, size FROM files WHERE asset = ?", (asset,)).fetchall())
+
+    def link(self, asset, target):
+        """
+        Links target to a downloaded copy of asset.
+
+        :return: str The path of the copy, or None if the asset was not downloaded before
+        """
+        source = self.lookup(asset)
+        if source is None or os.path.abspath(source) == os.path.abspath(target):
+            return None
+        mode = link_file(source, target)
+        # target already is the link, add must not copy source over it a second time
+        self.add(target, asset, sha256=self.sha256_of(source), dedupe=False)
+        logging.info("Linked existing download (" + mode + "): " + target)
+        return source
+
+    def sha256_of(self, path):
+        with sqlite_transaction(self.path) as db:
+            row = db.execute("SELECT sha256 FROM files WHERE path = ?", (os.path.abspath(path),)).fetchone()
+        return row[0] if row else None
+
+    def add(self, path, asset=None, sha256=None, dedupe=True):
+        """
+        Indexes a downloaded file. If the same content is already on disk and dedupe is set, path is replaced by a
+        link to it.
+
+        :return: int The number of bytes saved by linking
+        """
+        path = os.path.abspath(path)
+        size = os.path.getsize(path)
+        sha256 = sha256 or file_sha256(path)
+        with sqlite_transaction(self.path) as db:
+            duplicate = None
+            if dedupe:
+                duplicate = self._existing(db, db.execute("SELECT path, size FROM files WHERE sha256 = ? AND path != ?",
+                                                          (sha256, path)).fetchall())
+            db.execute("INSERT OR REPLACE INTO files (path, asset, sha256, size, updated) VALUES (?, ?, ?, ?, ?)",
+                       (path, asset, sha256, size, time.time()))
+        if duplicate is None or os.path.samefile(duplicate, path):
+            return 0
+        mode = link_file(duplicate, path)
+        logging.info("Deduplicated (" + mode + "): " + path)
+        return size if mode != "copy" else 0
+
+    def dedupe(self, root, min_size=64 * 1024):
+        """
+        Indexes every file under root and links files with the same content together. Only files that share their
+        size with another file are hashed.
+
+        :return: (int, int) The number of files linked and the bytes saved
+        """
+        by_size = collections.defaultdict(list)
+        for directory, _, files in os.walk(root):
+            for name in files:
+                path = os.path.join(directory, name)
+                if name.endswith((".part", ".link")) or name == "manifest.jsonl" or os.path.islink(path):
+                    continue
+                size = os.path.getsize(path)
+                if size >= min_size:
+                    by_size[size].append(path)
+
+        linked = 0
+        saved = 0
+        for size, paths in by_size.items():
+            if len(paths) < 2:
+                continue
+            for path in paths:
+                freed = self.add(path)
+                if freed:
+                    linked += 1
+                    saved += freed
+        return linked, saved
+
+
+def split_chunks(data, min_size=4096, max_size=65536):
+    """
+    Splits a page into chunks at tag boundaries chosen by the content, so boilerplate shared by two pages yields the
+    same chunks even when the text before it differs in length.
+    """
+    chunks = []
+    current = []
+    size = 0
+    pieces = data.split(b">")
+    for i, piece in enumerate(pieces):
+        if i < len(pieces) - 1:
+            piece += b">"
+        current.append(piece)
+        size += len(piece)
+        if size >= max_size or (size >= min_size and zlib.crc32(piece) & 0xF == 0):
+            chunks.append(b"".join(current))
+            current = []
+            size = 0
+    if current:
+        chunks.append(b"".join(current))
+    return chunks
+
+
+class PageArchive:
+    """
+    Saved HTML pages of a course packed into one file, courses/<title>/pages.pack, with a SQLite index in pages.db.
+    Pages are split into chunks that are stored once per course and compressed with a dictionary taken from the
+    first page, so the boilerplate repeated on every lecture page costs almost nothing. Pages are written by a
+    background thread, the browser thread only hands them over.
+    """
+
+    def __init__(self, course_path, workers=True):
+        self.course_path = course_path
+        self.pack_file = os.path.join(course_path, "pages.pack")
+        self.index_file = os.path.join(course_path, "pages.db")
+        self.zdict = None
+        self.stats = collections.Counter()
+        with sqlite_transaction(self.index_file) as db:
+            db.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value BLOB)")
+            db.execute("CREATE TABLE IF NOT EXISTS chunks (sha1 TEXT PRIMARY KEY, offset INTEGER, length INTEGER)")
+            db.execute("CREATE TABLE IF NOT EXISTS pages (name TEXT PRIMARY KEY, chunks TEXT, size INTEGER, "
+                       "saved REAL)")
+        self.queue = queue.Queue()
+        self.writer = None
+        if workers:
+            self.writer = threading.Thread(target=self._write_pages, name="page-archive", daemon=True)
+            self.writer.start()
+
+    def save(self, name, html):
+        """
+        Queues a page for writing. name is the path of the page relative to the course.
+        """
+        self.queue.put((name, html))
+
+    def close(self):
+        if self.writer is None:
+            return
+        self.queue.put(None)
+        try:
+            self.writer.join()
+        finally:
+            # The writer is a daemon, whatever it did not get to before an interrupted join is written here
+            self.writer = None
+            self._drain()
+            if self.stats["pages"]:
+                logging.info("Archived {} pages of {}: {:.1f} MiB in {:.1f} MiB".format(
+                    self.stats["pages"], self.course_path, self.stats["size"] / 1024 / 1024,
+                    self.stats["stored"] / 1024 / 1024))
+
+    def _write_pages(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            self._write_item(item)
+
+    def _drain(self):
+        while True:
+            try:
+                item = self.queue.get_nowait()
+            except queue.Empty:
+                return
+            if item is not None:
+                self._write_item(item)
+
+    def _write_item(self, item):
+        name, html = item
+        try:
+            self.write(name, html)
+        except Exception as e:
+            logging.error("Could not archive page: " + name + " cause: " + str(e))
+
+    def _load_zdict(self, db):
+        if self.zdict is None:
+            row = db.execute("SELECT value FROM meta WHERE key = 'zdict'").fetchone()
+            self.zdict = row[0] if row else None
+        return self.zdict
+
+    def write(self, name, html):
+        data = html.encode("utf-8")
+        # The transaction also serializes the appends of other processes working on the same course
+        with sqlite_transaction(self.index_file) as db:
+            if self._load_zdict(db) is None:
+                # The head of the first page (styles, scripts, navigation) is what the other pages repeat
+                self.zdict = data[:32 * 1024]
+                db.execute("INSERT INTO meta (key, value) VALUES ('zdict', ?)", (self.zdict,))
+            hashes = []
+            stored = 0
+            with open(self.pack_file, "ab") as pack:
+                for chunk in split_chunks(data):
+                    sha1 = hashlib.sha1(chunk).hexdigest()
+                    hashes.append(sha1)
+                    if db.execute("SELECT 1 FROM chunks WHERE sha1 = ?", (sha1,)).fetchone():
+                        continue
+                    compressor = zlib.compressobj(9, zdict=self.zdict)
+                    compressed = compressor.compress(chunk) + compressor.flush()
+                    offset = pack.tell()
+                    pack.write(compressed)
+                    db.execute("INSERT INTO chunks (sha1, offset, length) VALUES (?, ?, ?)",
+                               (sha1, offset, len(compressed)))
+                    stored += len(compressed)
+                # The index must not point past the end of the pack
+                pack.flush()
+                os.fsync(pack.fileno())
+            db.execute("INSERT OR REPLACE INTO pages (name, chunks, size, saved) VALUES (?, ?, ?, ?)",
+                       (name, json.dumps(hashes), len(data), time.time()))
+        self.stats.update(pages=1, size=len(data), stored=stored)
+        logging.debug("Archived page: " + name)
+
+    def rename(self, moves):
+        """
+        Renames archived pages. moves holds (old name, new name) pairs, pages may swap names.
+
+        :return: int The number of pages renamed
+        """
+        with sqlite_transaction(self.index_file) as db:
+            renamed = []
+            for old, new in moves:
+                row = db.execute("SELECT chunks, size, saved FROM pages WHERE name = ?", (old,)).fetchone()
+                if row is not None:
+                    db.execute("DELETE FROM pages WHERE name = ?", (old,))
+                    renamed.append((new,) + tuple(row))
+            db.executemany("INSERT OR REPLACE INTO pages (name, chunks, size, saved) VALUES (?, ?, ?, ?)", renamed)
+        for new, _, _, _ in renamed:
+            logging.info("Renamed archived page to " + new)
+        return len(renamed)
+
+    def names(self):
+        with sqlite_transaction(self.index_file) as db:
+            return [row[0] for row in db.execute("SELECT name FROM pages ORDER BY name")]
+
+    def read(self, name):
+        """
+        :return: str The page, or None if it is not in the archive
+        """
+        with sqlite_transaction(self.index_file) as db:
+            row = db.execute("SELECT chunks FROM pages WHERE name = ?", (name,)).fetchone()
+            if row is None:
+                return None
+            zdict = self._load_zdict(db)
+            locations = [db.execute("SELECT offset, length FROM chunks WHERE sha1 = ?", (sha1,)).fetchone()
+                         for sha1 in json.loads(row[0])]
+        data = []
+        with open(self.pack_file, "rb") as pack:
+            for offset, length in locations:
+                pack.seek(offset)
+                decompressor = zlib.decompressobj(zdict=zdict)
+                data.append(decompressor.decompress(pack.read(length)) + decompressor.flush())
+        return b"".join(data).decode("utf-8")
+
+
+def extract_pages(path):
+    """
+    Restores pages saved with --page-archive. path is either the file a page would have been saved to, or a course
+    directory to restore all of its pages.
+
+    :return: int The number of pages restored
+    """
+    path = os.path.abspath(path)
+    course_path = path
+    while not os.path.isfile(os.path.join(course_path, "pages.db")):
+        parent = os.path.dirname(course_path)
+        if parent == course_path:
+            raise FileNotFoundError("No page archive found for " + path)
+        course_path = parent
+    archive = PageArchive(course_path, workers=False)
+    if path == course_path:
+        names = archive.names()
+    else:
+        names = [os.path.relpath(path, course_path).replace(os.sep, "/")]
+    for name in names:
+        html = archive.read(name)
+        if html is None:
+            raise KeyError("Page not in archive: " + name)
+        output_file = os.path.join(course_path, *name.split("/"))
+        os.makedirs(os.path.dirname(output_file), exist_ok=True)
+        with open(output_file, "w", encoding="utf-8") as f:
+            f.write(html)
+        logging.info("Extracted page: " + output_file)
+    return len(names)
+
+
+SIGNED_EXPIRY_PATTERN = re.compile(r"(?:^|[~&])exp=(\d+)")
+
+
+def signed_url_expiry(url):
+    """
+    :return: float The time a signed URL stops working, from its Expires/exp/X-Amz-Expires parameters or an Akamai
+        token (hdnts=exp=...), or None if the URL carries no expiry
+    """
+    params = {key.lower(): values[0] for key, values in parse_qs(urlparse(url).query).items()}
+    for key in ("expires", "exp", "e"):
+        if params.get(key, "").isdigit():
+            return float(params[key])
+    for key in ("hdnts", "hdnea", "__token__"):
+        match = SIGNED_EXPIRY_PATTERN.search(params.get(key, ""))
+        if match:
+            return float(match.group(1))
+    if "x-amz-date" in params and params.get("x-amz-expires", "").isdigit():
+        try:
+            signed = calendar.timegm(time.strptime(params["x-amz-date"], "%Y%m%dT%H%M%SZ"))
+        except ValueError:
+            return None
+        return float(signed + int(params["x-amz-expires"]))
+    return None
+
+
+class ExtractionCache:
+    """
+    yt-dlp extraction results (formats and subtitles, before any format selection) by media asset, in a SQLite
+    database, or only in memory for the current run if path is None. An entry is kept for ttl seconds, or until
+    shortly before the first signed URL in it expires.
+    """
+
+    def __init__(self, path=None, ttl=6 * 3600, margin=300):
+        self.path = path
+        self.ttl = ttl
+        self.margin = margin
+        self.entries = {}
+        self.lock = threading.Lock()
+        if path is None:
+            return
+        # The signed URLs and the cookies yt-dlp keeps per format work like a login. The file is created private
+        # before SQLite opens it, and tightened if an earlier run left it readable. SQLite gives its journal the
+        # same mode.
+        os.close(os.open(path, os.O_WRONLY | os.O_CREAT, 0o600))
+        os.chmod(path, 0o600)
+        with sqlite_transaction(path) as db:
+            db.execute("CREATE TABLE IF NOT EXISTS info (asset TEXT PRIMARY KEY, info TEXT, expires REAL)")
+            db.execute("DELETE FROM info WHERE expires < ?", (time.time(),))
+
+    def get(self, url):
+        if self.path is None:
+            with self.lock:
+                row = self.entries.get(asset_id(url))
+        else:
+            with sqlite_transaction(self.path) as db:
+                row = db.execute("SELECT info, expires FROM info WHERE asset = ?", (asset_id(url),)).fetchone()
+        if row is None or row[1] < time.time():
+            return None
+        return json.loads(row[0])
+
+    def put(self, url, info):
+        urls = [url, info.get("url") or ""]
+        for media_format in info.get("formats") or []:
+            urls += [media_format.get("url") or "", media_format.get("manifest_url") or ""]
+        for tracks in (info.get("subtitles") or {}).values():
+            urls += [track.get("url") or "" for track in tracks]
+        expiries = [expiry for expiry in map(signed_url_expiry, urls) if expiry is not None]
+        expires = min([time.time() + self.ttl] + [expiry - self.margin for expiry in expiries])
+        if self.path is None:
+            # Stored serialized like in the database, so callers never share one mutable result
+            with self.lock:
+                self.entries[asset_id(url)] = (json.dumps(info), expires)
+            return
+        with sqlite_transaction(self.path) as db:
+            db.execute("INSERT OR REPLACE INTO info (asset, info, expires) VALUES (?, ?, ?)",
+                       (asset_id(url), json.dumps(info), expires))
+
+    def invalidate(self, url):
+        if self.path is None:
+            with self.lock:
+                self.entries.pop(asset_id(url), None)
+            return
+        with sqlite_transaction(self.path) as db:
+            db.execute("DELETE FROM info WHERE asset = ?", (asset_id(url),))
+
+
+class JobQueue:
+    """
+    Durable queue of course and lecture jobs in a SQLite database, shared by any number of processes on one host or
+    over a shared filesystem. A claimed job is leased to its worker, which renews the lease with heartbeats while it
+    works on it. Jobs of workers that stop sending heartbeats go back to the queue once their lease expires, and jobs
+    that failed max_attempts times are given up.
+    """
+
+    def __init__(self, path, lease_seconds=300, max_attempts=3):
+        self.path = path
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        with self.connect() as db:
+            db.execute("""
+                CREATE TABLE IF NOT EXISTS jobs (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    kind TEXT NOT NULL,
+                    url TEXT NOT NULL,
+                    payload TEXT,
+                    priority INTEGER NOT NULL DEFAULT 0,
+                    status TEXT NOT NULL DEFAULT 'pending',
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    worker TEXT,
+                    lease_expires REAL,
+                    error TEXT,
+                    updated REAL,
+                    UNIQUE (kind, url)
+                )""")
+            db.execute("CREATE INDEX IF NOT EXISTS jobs_claim ON jobs (status, priority DESC, id)")
+
+    def connect(self):
+        # A connection per operation keeps the queue usable from the heartbeat threads
+        return sqlite_transaction(self.path)
+
+    def add(self, kind, url, payload=None, priority=0):
+        """
+        Queues a job. A job that is already queued or finished is left as it is, a failed one is queued again.
+        Every process joining the queue adds its --url, so a finished job must not be reset here.
+        """
+        with self.connect() as db:
+            db.execute("""
+                INSERT INTO jobs (kind, url, payload, priority, updated) VALUES (?, ?, ?, ?, ?)
+                ON CONFLICT (kind, url) DO UPDATE SET
+                    payload = excluded.payload, priority = excluded.priority, status = 'pending', attempts = 0,
+                    worker = NULL, lease_expires = NULL, error = NULL, updated = excluded.updated
+                WHERE status = 'failed'""",
+                       (kind, url, json.dumps(payload) if payload is not None else None, priority, time.time()))
+
+    def claim(self, worker):
+        """
+        Leases the pending job with the highest priority to worker.
+
+        :return: dict or None if no job is pending
+        """
+        now = time.time()
+        with self.connect() as db:
+            self._expire_leases(db, now)
+            row = db.execute("SELECT id, kind, url, payload, priority, attempts FROM jobs WHERE status = 'pending' "
+                             "ORDER BY priority DESC, id LIMIT 1").fetchone()
+            if row is None:
+                return None
+            db.execute("UPDATE jobs SET status = 'leased', attempts = attempts + 1, worker = ?, lease_expires = ?, "
+                       "updated = ? WHERE id = ?", (worker, now + self.lease_seconds, now, row[0]))
+        job_id, kind, url, payload, priority, attempts = row
+        return {"id": job_id, "kind": kind, "url": url, "payload": json.loads(payload) if payload else None,
+                "priority": priority, "attempt": attempts + 1, "worker": worker}
+
+    def _expire_leases(self, db, now):
+        expired = db.execute("SELECT id, worker FROM jobs WHERE status = 'leased' AND lease_expires < ?",
+                             (now,)).fetchall()
+        for job_id, worker in expired:
+            logging.warning("Lease of job " + str(job_id) + " held by " + str(worker) + " expired")
+        db.execute("UPDATE jobs SET status = CASE WHEN attempts < ? THEN 'pending' ELSE 'failed' END, worker = NULL, "
+                   "lease_expires = NULL, error = 'lease expired', updated = ? "
+                   "WHERE status = 'leased' AND lease_expires < ?", (self.max_attempts, now, now))
+
+    def heartbeat(self, job):
+        """
+        Renews the lease of job.
+
+        :return: bool False if the lease was lost to another worker
+        """
+        now = time.time()
+        with self.connect() as db:
+            cursor = db.execute("UPDATE jobs SET lease_expires = ?, updated = ? "
+                                "WHERE id = ? AND status = 'leased' AND worker = ?",
+                                (now + self.lease_seconds, now, job["id"], job["worker"]))
+            return cursor.rowcount == 1
+
+    @contextlib.contextmanager
+    def lease(self, job):
+        """
+        Sends heartbeats for job while the block runs.
+        """
+        stop = threading.Event()
+
+        def beat():
+            while not stop.wait(self.lease_seconds / 3):
+                try:
+                    if not self.heartbeat(job):
+                        logging.warning("Lost the lease of job " + str(job["id"]))
+                        return
+                except sqlite3.Error as e:
+                    logging.warning("Could not renew the lease of job " + str(job["id"]) + ": " + str(e))
+
+        thread = threading.Thread(target=beat, name="job-heartbeat-" + str(job["id"]), daemon=True)
+        thread.start()
+        try:
+            yield job
+        finally:
+            stop.set()
+            thread.join()
+
+    def complete(self, job):
+        with self.connect() as db:
+            db.execute("UPDATE jobs SET status = 'done', worker = NULL, lease_expires = NULL, error = NULL, "
+                       "updated = ? WHERE id = ? AND worker = ?", (time.time(), job["id"], job["worker"]))
+
+    def fail(self, job, error):
+        """
+        Returns job to the queue, or gives it up after max_attempts.
+        """
+        with self.connect() as db:
+            db.execute("UPDATE jobs SET status = CASE WHEN attempts < ? THEN 'pending' ELSE 'failed' END, "
+                       "worker = NULL, lease_expires = NULL, error = ?, updated = ? WHERE id = ? AND worker = ?",
+                       (self.max_attempts, str(error), time.time(), job["id"], job["worker"]))
+
+    def first_url(self, kind="course"):
+        with self.connect() as db:
+            row = db.execute("SELECT url FROM jobs WHERE kind = ? ORDER BY id LIMIT 1", (kind,)).fetchone()
+        return row[0] if row else None
+
+    def counts(self):
+        with self.connect() as db:
+            return dict(db.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall())
+
+
+class StatusServer:
+    """
+    Optional HTTP endpoint with the live progress of a run: /metrics in the Prometheus text format and /status as
+    JSON. Throughput is sampled every interval seconds from the byte counters of the bandwidth scheduler.
+    """
+
+    def __init__(self, downloader, port, host="127.0.0.1", interval=5.0):
+        self.downloader = downloader
+        self.interval = interval
+        self.throughput = {}
+        self.started = time.time()
+        self.errors = collections.deque(maxlen=20)
+        status = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, format, *args):
+                logging.debug("status: " + format % args)
+
+            def do_GET(self):
+                path = urlparse(self.path).path
+                if path == "/metrics":
+                    body, content_type = status.prometheus(), "text/plain; version=0.0.4"
+                elif path in ("/", "/status"):
+                    body, content_type = json.dumps(status.snapshot(), indent=2), "application/json"
+                else:
+                    self.send_error(404)
+                    return
+                body = body.encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        class ErrorHandler(logging.Handler):
+            def emit(self, record):
+                status.errors.append({"time": record.created, "level": record.levelname,
+                                      "thread": record.threadName, "message": record.getMessage()})
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        self.error_handler = ErrorHandler(logging.WARNING)
+
+    def start(self):
+        logging.getLogger().addHandler(self.error_handler)
+        threading.Thread(target=self.server.serve_forever, name="status-server", daemon=True).start()
+        threading.Thread(target=self._sample, name="status-sampler", daemon=True).start()
+        logging.info("Serving status on http://{}:{}/status and /metrics".format(*self.server.server_address))
+
+    def stop(self):
+        logging.getLogger().removeHandler(self.error_handler)
+        self.server.shutdown()
+
+    def _sample(self):
+        previous, previous_time = self.downloader.bandwidth.transferred_by_thread(), time.monotonic()
+        while True:
+            time.sleep(self.interval)
+            current, now = self.downloader.bandwidth.transferred_by_thread(), time.monotonic()
+            self.throughput = {worker: (nbytes - previous.get(worker, 0)) / (now - previous_time)
+                               for worker, nbytes in current.items()}
+            previous, previous_time = current, now
+
+    def snapshot(self):
+        report = self.downloader.report
+        lectures = report.progress("lectures", "lecture")
+        uptime = time.time() - self.started
+        # Lectures finished per second over the whole run, so a stall shows up as a growing ETA
+        rate = (lectures["done"] + lectures["failed"]) / uptime if uptime else 0
+        return {
+            "time": time.time(),
+            "uptime_seconds": uptime,
+            "courses": report.progress("courses", "course"),
+            "lectures": lectures,
+            "bytes_downloaded": sum(self.downloader.bandwidth.transferred_by_thread().values()),
+            "throughput_bytes_per_second": sum(self.throughput.values()),
+            "worker_throughput_bytes_per_second": dict(self.throughput),
+            "last_transfer": self.downloader.bandwidth.last_transfer,
+            "queues": self.downloader.queue_depths(),
+            "eta_seconds": lectures["pending"] / rate if rate else None,
+            "recent_errors": list(self.errors),
+        }
+
+    def prometheus(self):
+        snapshot = self.snapshot()
+        lines = []
+
+        def metric(name, kind, help_text, samples):
+            lines.append("# HELP teachable_dl_{} {}".format(name, help_text))
+            lines.append("# TYPE teachable_dl_{} {}".format(name, kind))
+            for labels, value in samples:
+                label_text = ",".join('{}="{}"'.format(key, str(label).replace('"', "'"))
+                                      for key, label in labels.items())
+                lines.append("teachable_dl_{}{} {}".format(name, "{" + label_text + "}" if label_text else "",
+                                                           value))
+
+        for unit in ("courses", "lectures"):
+            metric(unit, "gauge", "Number of " + unit + " by state",
+                   [({"state": state}, count) for state, count in snapshot[unit].items()])
+        metric("downloaded_bytes_total", "counter", "Bytes received by all transfers",
+               [({}, snapshot["bytes_downloaded"])])
+        metric("throughput_bytes_per_second", "gauge", "Receive rate of each worker thread",
+               [({"worker": worker}, round(rate, 1))
+                for worker, rate in snapshot["worker_throughput_bytes_per_second"].items()])
+        metric("last_transfer_timestamp_seconds", "gauge", "Time data was last received",
+               [({}, snapshot["last_transfer"] or 0)])
+        metric("queue_depth", "gauge", "Work waiting in each queue",
+               [({"queue": name}, depth) for name, depth in snapshot["queues"].items()])
+        metric("eta_seconds", "gauge", "Estimated time until all known lectures are done",
+               [({}, round(snapshot["eta_seconds"], 1))] if snapshot["eta_seconds"] is not None else [])
+        metric("recent_errors", "gauge", "Warnings and errors logged recently (last 20 kept)",
+               [({}, len(snapshot["recent_errors"]))])
+        metric("uptime_seconds", "gauge", "Seconds since the run started", [({}, round(snapshot["uptime_seconds"]))])
+        return "\n".join(lines) + "\n"
+
+
 class TeachableDownloader:
-    def __init__(self, verbose_arg=False, complete_lecture_arg=False, user_agent_arg=None, timeout_arg=3):
-        self.driver = Driver(uc=True, headed=True)
+    def __init__(self, verbose_arg=False, complete_lecture_arg=False, user_agent_arg=None, timeout_arg=3,
+                 download_workers_arg=0, download_queue_arg=8, session_key_arg=None, profile_dir_arg="profiles",
+                 browser_workers_arg=1, headed_workers_arg=False, max_downloads_arg=0, headless_arg=False,
+                 cookie_file_arg="cookies.txt", hls_engine_arg="native", min_fragments_arg=2, max_fragments_arg=16,
+                 fragment_budget_arg=32, attachments_arg=False, sync_arg=False, subtitles_arg=False,
+                 plan_arg=False, browser_arg=True, prefetch_arg=0, bandwidth_profile_arg=None,
+                 host_limits_arg=None, school_host_limit_arg=4, retries_arg=3, breaker_threshold_arg=5,
+                 breaker_cooldown_arg=60, report_arg=None, content_store_arg=None, page_archive_arg=False,
+                 extraction_cache_arg=None, extraction_ttl_arg=6 * 3600, parent_arg=None):
+        # parent_arg is the downloader a browser worker belongs to, the worker shares its download components
+        # log_cdp_events records the DevTools download events used by BrowserDownloadTracker
+        if not browser_arg:
+            # Executing a plan only needs HTTP
+            self.driver = None
+        elif headless_arg:
+            self.driver = Driver(uc=True, headless=True, log_cdp_events=True)
+        else:
+            self.driver = Driver(uc=True, headed=True, log_cdp_events=True)
         self.headers = {
             "User-Agent": user_agent_arg,
             "Origin": "https://player.hotmart.com",
@@ -64,12 +2488,169 @@ class TeachableDownloader:
         self.verbose = verbose_arg
         self._complete_lecture = complete_lecture_arg
         self.global_timeout = timeout_arg
+        self.download_workers = download_workers_arg
+        self.download_queue_size = download_queue_arg
+        self.pipeline = None
+        self.manifests = parent_arg.manifests if parent_arg else {}
+        self.manifest_lock = parent_arg.manifest_lock if parent_arg else threading.Lock()
+        # Set on Ctrl-C, the browser workers stop before their next lecture
+        self.stop_event = parent_arg.stop_event if parent_arg else threading.Event()
+        self.wait_time = 0.0
+        self.implicit_wait = 0
+        self.session_bridge = SessionBridge(self.driver, user_agent_arg, cookie_file=cookie_file_arg)
+        self.download_tracker = BrowserDownloadTracker(self.driver)
+        self.download_attachments_enabled = attachments_arg
+        self.report = parent_arg.report if parent_arg else RunReport(report_arg)
+        self.is_worker = parent_arg is not None
+        self.browser_list = [self]
+        self.course_started = None
+        self.postprocessor = parent_arg.postprocessor if parent_arg else PostprocessPool(self.report)
+        self.sync = sync_arg
+        self.prefetch = prefetch_arg
+        # Shared by every download path and every browser worker
+        self.bandwidth = parent_arg.bandwidth if parent_arg else BandwidthScheduler(bandwidth_profile_arg,
+                                                                                    host_limits_arg)
+        self.school_host_limit = parent_arg.school_host_limit if parent_arg else school_host_limit_arg
+        self.retry_policy = parent_arg.retry_policy if parent_arg else RetryPolicy(
+            CircuitBreaker(breaker_threshold_arg, breaker_cooldown_arg), retries=retries_arg)
+        self.download_subtitles_enabled = subtitles_arg
+        # Downloaded files by media asset and content, so assets shared by several courses are only fetched once
+        if parent_arg:
+            self.content_store = parent_arg.content_store
+        else:
+            self.content_store = ContentStore(content_store_arg) if content_store_arg else None
+        # yt-dlp extractions shared by the video and subtitle downloads, kept across runs only with --extraction-cache
+        if parent_arg:
+            self.extraction_cache = parent_arg.extraction_cache
+        else:
+            self.extraction_cache = ExtractionCache(extraction_cache_arg, extraction_ttl_arg) \
+                if extraction_ttl_arg > 0 else None
+        # In plan mode every download is recorded here instead of being run
+        if parent_arg:
+            self.plan = parent_arg.plan
+        else:
+            self.plan = [] if plan_arg else None
+        # Set while working on a durable job queue
+        self.jobs = None
+        self.current_job = None
+        self.attachment_fetcher = None
+        # Saved pages go to one compressed archive per course instead of separate files
+        if parent_arg:
+            self.page_archives = parent_arg.page_archives
+        else:
+            self.page_archives = {} if page_archive_arg else None
+        self.page_archive_lock = parent_arg.page_archive_lock if parent_arg else threading.Lock()
+        self.session_key = session_key_arg
+        self.profile_dir = profile_dir_arg
+        self.browser_workers = browser_workers_arg
+        self.headed_workers = headed_workers_arg
+        self.hls_engine = hls_engine_arg
+        if parent_arg:
+            self.fragment_controller = parent_arg.fragment_controller
+        else:
+            self.fragment_controller = ConcurrencyController(min_fragments_arg, max_fragments_arg,
+                                                             fragment_budget_arg)
+        # Shared by all browser workers so together they never run more than max_downloads videos at once
+        if parent_arg:
+            self.download_slots = parent_arg.download_slots
+        else:
+            self.download_slots = threading.BoundedSemaphore(max_downloads_arg) if max_downloads_arg > 0 else None
+
+    def wait_for(self, condition, timeout=None):
+        # All explicit waits go through here so the time spent waiting can be reported
+        start = time.time()
+        try:
+            return WebDriverWait(self.driver, self.global_timeout if timeout is None else timeout).until(condition)
+        finally:
+            self.wait_time += time.time() - start
+            self.report.record("wait", time.time() - start, write=False)
+
+    def log_wait_time(self):
+        logging.info("Time spent in explicit waits: {:.1f}s".format(self.wait_time))
+
+    def find_elements_now(self, by, selector):
+        # find_elements without the implicit wait, for elements that are usually absent
+        self.driver.implicitly_wait(0)
+        try:
+            return self.driver.find_elements(by, selector)
+        finally:
+            self.driver.implicitly_wait(self.implicit_wait)
+
+    def set_implicit_wait(self, timeout):
+        self.implicit_wait = timeout
+        self.driver.implicitly_wait(timeout)
+
+    def get_http_session(self):
+        # Picks up cookies the browser received since the last call, only call this from the browser thread
+        self.session_bridge.refresh()
+        return self.session_bridge.session
+
+    def http_get(self, session, url, course=None, **kwargs):
+        """
+        GET for small requests made outside the download workers. Retried by the retry policy and counted against
+        the bandwidth and host limits.
+
+        :return: requests.Response
+            The successful response, errors are raised.
+        """
+        def get(url):
+            with self.bandwidth.transfer(url, course) as consume:
+                response = session.get(url, timeout=self.global_timeout, **kwargs)
+                consume(len(response.content))
+            response.raise_for_status()
+            return response
+
+        return self.retry_policy.call(get, url)
+
+    def fetch_media_url(self, session, embed_url, referer):
+        response = self.http_get(session, embed_url, headers={"Referer": referer})
+        response.raise_for_status()
+        return extract_media_url(response.text)
+
+    def resolve_media_urls(self, embed_urls, referer, session=None):
+        """
+        Resolves the media URL of every embed player of a lecture concurrently over HTTP.
+
+        :param embed_urls: List[str]
+            The src of every embed-player iframe on the lecture page.
+        :param referer: str
+            The lecture URL, sent as referer like the browser does.
+        :param session: requests.Session
+            Session to use when called outside the browser thread, defaults to the current browser session.
+        :return: List[str]
+            The media URL for each embed, None where it could not be resolved over HTTP.
+        """
+        if not embed_urls:
+            return []
+        if session is None:
+            session = self.get_http_session()
+
+        def resolve(embed_url):
+            try:
+                return self.fetch_media_url(session, embed_url, referer)
+            except Exception as e:
+                logging.debug("Could not resolve media url over http: " + str(embed_url) + " cause: " + str(e))
+                return None
+
+        with ThreadPoolExecutor(max_workers=min(8, len(embed_urls))) as executor:
+            return list(executor.map(resolve, embed_urls))
+
+    def resolve_media_url_in_frame(self, iframe):
+        # Fallback for embeds that can't be fetched over HTTP, reads __NEXT_DATA__ through the browser
+        logging.info("Switching to video frame")
+        self.driver.switch_to.frame(iframe)
+        try:
+            script_text = self.driver.find_element(By.ID, "__NEXT_DATA__")
+            json_text = json.loads(script_text.get_attribute("innerHTML"))
+            return json_text["props"]["pageProps"]["applicationData"]["mediaAssets"][0]["url"]
+        finally:
+            self.driver.switch_to.default_content()  # Switch back to main content before the next iteration
 
     def check_elem_exists(self, by, selector, timeout):
+        if timeout <= 0:
+            return len(self.find_elements_now(by, selector)) > 0
         try:
-            WebDriverWait(self.driver, timeout=self.global_timeout).until(
-                EC.presence_of_element_located((by, selector))
-            )
+            self.wait_for(EC.presence_of_element_located((by, selector)), timeout=timeout)
         except NoSuchElementException:
             return False
         except TimeoutException:
@@ -82,38 +2663,42 @@ class TeachableDownloader:
     def bypass_cloudflare(self):
         if self.driver.capabilities["browserVersion"].split(".")[0] < "115":
             return
-        logging.info("Bypassing cloudflare")
-        time.sleep(1)
-        if self.check_elem_exists(By.ID, "challenge-stage", timeout=self.global_timeout):
-            try:
-                self.driver.find_element(
-                    By.ID, "challenge-stage"
-                ).click()  # make sure the challenge is focused
-                self.driver.execute_script(
-                    '''window.open("''' + self.driver.current_url + """","_blank");"""
-                )  # open page in new tab
-                input(
-                    "\033[93mWarning: Bypassing Cloudflare\nplease click on the captcha checkbox if not done already "
-                    "and press enter to continue (do not close any of the tabs)\033[0m"
-                )
-                self.driver.switch_to.window(
-                    window_name=self.driver.window_handles[0]
-                )  # switch to first tab
-                self.driver.close()  # close first tab
-                self.driver.switch_to.window(
-                    window_name=self.driver.window_handles[0]
-                )  # switch back to new tab
-            except Exception as e:
-                logging.error("Could not bypass cloudflare: " + str(e))
+        with self.report.phase("cloudflare"):
+            logging.info("Bypassing cloudflare")
+            time.sleep(1)
+            # Callers already waited for the challenge, so only check that it is still there
+            if self.check_elem_exists(By.ID, "challenge-stage", timeout=0):
+                try:
+                    self.driver.find_element(
+                        By.ID, "challenge-stage"
+                    ).click()  # make sure the challenge is focused
+                    self.driver.execute_script(
+                        '''window.open("''' + self.driver.current_url + """","_blank");"""
+                    )  # open page in new tab
+                    input(
+                        "\033[93mWarning: Bypassing Cloudflare\nplease click on the captcha checkbox if not done already "
+                        "and press enter to continue (do not close any of the tabs)\033[0m"
+                    )
+                    self.driver.switch_to.window(
+                        window_name=self.driver.window_handles[0]
+                    )  # switch to first tab
+                    self.driver.close()  # close first tab
+                    self.driver.switch_to.window(
+                        window_name=self.driver.window_handles[0]
+                    )  # switch back to new tab
+                except Exception as e:
+                    logging.error("Could not bypass cloudflare: " + str(e))
+                    return
+            else:
+                logging.info("No need to bypass cloudflare")
                 return
-        else:
-            logging.info("No need to bypass cloudflare")
-            return
 
     def run(self, course_url, email, password, login_url, man_login_url):
         logging.info("Starting login")
 
-        if man_login_url is None:
+        if self.restore_session(course_url):
+            logging.info("Skipping login")
+        elif man_login_url is None:
             # Check if login_url is not set
             if login_url is None:
                 try:
@@ -124,23 +2709,30 @@ class TeachableDownloader:
                 self.driver.get(login_url)
 
             try:
-                self.login(email, password)
+                with self.report.phase("login"):
+                    if self.login(email, password) is False:
+                        return
             except Exception as e:
                 logging.error("Could not login: " + str(e), exc_info=self.verbose)
                 return
+            self.save_session(course_url)
         else:
             self.driver.get(course_url)
             while self.driver.current_url != man_login_url:
                 time.sleep(3)
                 logging.info("Waiting for user to navigate to url: " + man_login_url)
                 logging.info("Current url: " + self.driver.current_url)
+            self.save_session(course_url)
 
         logging.info("Starting download of course: " + course_url)
+        self.report.add_total("courses", 1)
         try:
             self.pick_course_downloader(course_url)
         except Exception as e:
             logging.error("Could not download course: " + course_url + " cause: " + str(e))
 
+        self.wait_for_downloads()
+
     def run_batch(self, url_array, email, password, login_url, man_login_url):
         """
         This method handles batch downloading of courses. It navigates to the given URLs, logs in if necessary,
@@ -160,34 +2752,290 @@ class TeachableDownloader:
             before starting the download process.
         :return: None
         """
+        if not self.batch_login(url_array[0], email, password, login_url, man_login_url):
+            return
+
+        logging.info("Running batch download of courses ")
+        self.report.add_total("courses", len(url_array))
+        urls = queue.Queue()
+        for url in url_array:
+            urls.put(url)
+
+        if self.browser_workers > 1:
+            self.download_courses_parallel(urls)
+        else:
+            self.download_courses_from_queue(urls)
+
+    def batch_login(self, course_url, email, password, login_url, man_login_url):
         logging.info("Starting login")
 
-        if man_login_url is None:
+        if self.restore_session(course_url):
+            logging.info("Skipping login")
+        elif man_login_url is None:
             # Check if login_url is not set
             if login_url is not None:
                 self.driver.get(login_url)
             else:
                 logging.error("Login url is not set")
-                return
+                return False
+
+            try:
+                with self.report.phase("login"):
+                    if self.login(email, password) is False:
+                        return False
+            except Exception as e:
+                logging.error("Could not login: " + str(e), exc_info=self.verbose)
+                return False
+            self.save_session(course_url)
+        else:
+            self.driver.get(course_url)
+            while self.driver.current_url != man_login_url:
+                time.sleep(3)
+                logging.info("Waiting for user to navigate to url: " + man_login_url)
+                logging.info("Current url: " + self.driver.current_url)
+            self.save_session(course_url)
+        return True
+
+    def run_jobs(self, jobs, email, password, login_url, man_login_url):
+        """
+        Works on the jobs of a durable job queue until it is empty. Any number of processes can run this on the same
+        queue. A course job queues a lecture job for every lecture that is not downloaded yet, so the lectures of a
+        course are spread over all workers.
+
+        :param jobs: JobQueue
+            The queue to take jobs from.
+        :return: None
+        """
+        course_url = jobs.first_url()
+        if course_url is None:
+            logging.error("The job queue has no courses")
+            return
+        if not self.batch_login(course_url, email, password, login_url, man_login_url):
+            return
+
+        self.jobs = jobs
+        if self.browser_workers > 1:
+            self.download_courses_parallel(jobs=jobs)
+        else:
+            self.download_jobs(jobs)
+
+    def download_jobs(self, jobs, poll_interval=10):
+        worker = "{}:{}:{}".format(socket.gethostname(), os.getpid(), threading.current_thread().name)
+        while not self.stop_event.is_set():
+            job = jobs.claim(worker)
+            if job is None:
+                counts = jobs.counts()
+                if not counts.get("leased"):
+                    break
+                # Other workers may still queue lectures, or die and leave their jobs behind
+                time.sleep(poll_interval)
+                continue
+
+            logging.info("Claimed " + job["kind"] + " job " + str(job["id"]) + " (attempt " + str(job["attempt"]) +
+                         "): " + job["url"])
+            self.current_job = job
+            try:
+                with jobs.lease(job):
+                    if job["kind"] == "course":
+                        self.pick_course_downloader(job["url"])
+                        done = True
+                    else:
+                        done = self.download_lecture_job(job)
+                if done:
+                    jobs.complete(job)
+                else:
+                    jobs.fail(job, "lecture did not complete")
+            except Exception as e:
+                if self.stop_event.is_set():
+                    # Not the job's fault, its lease expires and another worker takes it over
+                    logging.info("Stopped during job " + str(job["id"]))
+                    break
+                logging.error("Job " + str(job["id"]) + " failed: " + str(e), exc_info=self.verbose)
+                jobs.fail(job, e)
+            finally:
+                self.current_job = None
+
+        self.wait_for_downloads()
+        logging.info("Job queue is empty: " + str(jobs.counts()))
+
+    def queue_lecture_jobs(self, video_list, manifest):
+        # Lectures rank above courses so that started courses are finished first
+        manifest.reload()
+        queued = 0
+        for video in video_list:
+            if manifest.is_lecture_complete(video["link"]):
+                continue
+            payload = dict(video, download_path=os.path.relpath(video["download_path"]))
+            self.jobs.add("lecture", video["link"], payload, priority=self.current_job["priority"] + 1)
+            queued += 1
+        logging.info("Queued " + str(queued) + " of " + str(len(video_list)) + " lectures")
+
+    def download_lecture_job(self, job):
+        video = dict(job["payload"], download_path=os.path.abspath(job["payload"]["download_path"]))
+        os.makedirs(video["download_path"], exist_ok=True)
+        manifest = self.get_manifest(os.path.dirname(video["download_path"]))
+        manifest.reload()
+        self.report.add_total("lectures", 1)
+        try:
+            self.download_lecture(video, manifest)
+            # The job is only done once the videos of the lecture are on disk
+            self.wait_for_downloads()
+        finally:
+            # Other workers may take the next lectures of the course, its page must be written before the job is done
+            self.close_page_archive(os.path.dirname(video["download_path"]))
+        return manifest.is_lecture_complete(video["link"])
+
+    def download_courses_from_queue(self, urls):
+        while not self.stop_event.is_set():
+            try:
+                url = urls.get_nowait()
+            except queue.Empty:
+                break
+            try:
+                self.pick_course_downloader(url)
+            except Exception as e:
+                logging.error("Could not download course: " + url + " cause: " + str(e))
+
+        self.wait_for_downloads()
+
+    def spawn_browser_worker(self, worker_idx):
+        worker = TeachableDownloader(verbose_arg=self.verbose, complete_lecture_arg=self._complete_lecture,
+                                     user_agent_arg=self.headers["User-Agent"], timeout_arg=self.global_timeout,
+                                     download_workers_arg=self.download_workers,
+                                     download_queue_arg=self.download_queue_size,
+                                     headless_arg=not self.headed_workers,
+                                     cookie_file_arg="cookies-{}.txt".format(worker_idx),
+                                     hls_engine_arg=self.hls_engine,
+                                     attachments_arg=self.download_attachments_enabled, sync_arg=self.sync,
+                                     subtitles_arg=self.download_subtitles_enabled, prefetch_arg=self.prefetch,
+                                     parent_arg=self)
+        return worker
+
+    def download_courses_parallel(self, urls=None, jobs=None):
+        """
+        Downloads the queued courses with several browsers. The extra browsers reuse the session of this one
+        instead of logging in again, and every browser takes the next course from the shared queue.
+
+        :param urls: queue.Queue
+            The course URLs to download.
+        :param jobs: JobQueue
+            Durable job queue to take the work from instead of urls.
+        :return: None
+        """
+        state = self.export_browser_state()
+        workers = [self]
+        self.browser_list = workers
+        for worker_idx in range(2, self.browser_workers + 1):
+            worker = None
+            try:
+                logging.info("Starting browser worker " + str(worker_idx))
+                worker = self.spawn_browser_worker(worker_idx)
+                worker.import_browser_state(state)
+                workers.append(worker)
+            except Exception as e:
+                logging.error("Could not start browser worker: " + str(e), exc_info=self.verbose)
+                if worker is not None:
+                    worker.clean_up()
+
+        threads = []
+        for worker_idx, worker in enumerate(workers):
+            if jobs is not None:
+                worker.jobs = jobs
+                target, args = worker.download_jobs, (jobs,)
+            else:
+                target, args = worker.download_courses_from_queue, (urls,)
+            # Daemon threads, a worker stuck in a browser call must not keep the process alive after Ctrl-C
+            thread = threading.Thread(target=target, args=args, name="browser-worker-{}".format(worker_idx + 1),
+                                      daemon=True)
+            thread.start()
+            threads.append(thread)
+        try:
+            for thread in threads:
+                thread.join()
+        except BaseException:
+            # Workers stop before their next lecture, quitting their browsers ends the calls they are in
+            self.stop_event.set()
+            raise
+        finally:
+            for worker in workers[1:]:
+                worker.clean_up()
+
+    def get_session_profile(self, course_url):
+        if not self.session_key:
+            return None
+        return SessionProfile(course_url, self.session_key, self.profile_dir)
+
+    def export_browser_state(self):
+        return {
+            "cookies": self.session_bridge.get_browser_cookies(),
+            "origin": urlunparse(urlparse(self.driver.current_url)[:2] + ('', '', '', '')),
+            "local_storage": self.driver.execute_script("return Object.assign({}, window.localStorage)"),
+            "saved": time.time(),
+        }
+
+    def import_browser_state(self, state):
+        # Network.setCookies only accepts the CookieParam fields
+        cookie_fields = ("name", "value", "domain", "path", "secure", "httpOnly", "sameSite", "expires")
+        cookies = []
+        for cookie in state["cookies"]:
+            cookie = {key: value for key, value in cookie.items() if key in cookie_fields}
+            if cookie.get("expires", -1) <= 0:
+                cookie.pop("expires", None)
+            cookies.append(cookie)
+        self.driver.execute_cdp_cmd("Network.setCookies", {"cookies": cookies})
+
+        if state.get("local_storage"):
+            # Local storage can only be written from a page of the same origin
+            self.driver.get(state["origin"])
+            self.driver.execute_script(
+                "for (const [key, value] of Object.entries(arguments[0])) { window.localStorage.setItem(key, value) }",
+                state["local_storage"])
+
+    def is_logged_in(self):
+        if "sign_in" in self.driver.current_url:
+            return False
+        return not (self.find_elements_now(By.ID, "email") or self.find_elements_now(By.LINK_TEXT, "Login"))
+
+    def restore_session(self, course_url):
+        """
+        Reuses the login saved by a previous run, if there is one and it is still valid.
+
+        :param course_url: str
+            The course to open with the restored session, the school is taken from its host.
+        :return: bool
+            True if the browser is logged in and on the course page.
+        """
+        profile = self.get_session_profile(course_url)
+        if profile is None:
+            return False
+        state = profile.load()
+        if state is None:
+            return False
+
+        logging.info("Restoring saved session for " + profile.host)
+        try:
+            self.import_browser_state(state)
+            self.driver.get(course_url)
+            self.wait_for(EC.presence_of_element_located((By.TAG_NAME, 'body')))
+        except Exception as e:
+            logging.warning("Could not restore saved session: " + str(e), exc_info=self.verbose)
+            return False
 
-            try:
-                self.login(email, password)
-            except Exception as e:
-                logging.error("Could not login: " + str(e), exc_info=self.verbose)
-                return
-        else:
-            self.driver.get(url_array[0])
-            while self.driver.current_url != man_login_url:
-                time.sleep(3)
-                logging.info("Waiting for user to navigate to url: " + man_login_url)
-                logging.info("Current url: " + self.driver.current_url)
+        if not self.is_logged_in():
+            logging.warning("Saved session expired, logging in again")
+            profile.delete()
+            return False
+        logging.info("Restored saved session")
+        return True
 
-        logging.info("Running batch download of courses ")
-        for url in url_array:
-            try:
-                self.pick_course_downloader(url)
-            except Exception as e:
-                logging.error("Could not download course: " + url + " cause: " + str(e))
+    def save_session(self, course_url):
+        profile = self.get_session_profile(course_url)
+        if profile is None:
+            return
+        try:
+            profile.save(self.export_browser_state())
+        except Exception as e:
+            logging.warning("Could not save session: " + str(e), exc_info=self.verbose)
 
     def construct_sign_in_url(self, course_url):
         parsed_url = urlparse(course_url)
@@ -199,13 +3047,11 @@ class TeachableDownloader:
     def find_login(self, course_url):
         logging.info("Trying to find login")
 
-        self.driver.implicitly_wait(self.global_timeout)
+        self.set_implicit_wait(self.global_timeout)
         self.driver.get(course_url)
 
         try:
-            login_element = WebDriverWait(self.driver, self.global_timeout).until(
-                EC.presence_of_element_located((By.LINK_TEXT, "Login"))
-            )
+            login_element = self.wait_for(EC.presence_of_element_located((By.LINK_TEXT, "Login")))
         except TimeoutException:
             logging.warning("Login button not found, navigating to fallback URL")
             fallback_url = self.construct_sign_in_url(course_url)
@@ -216,18 +3062,14 @@ class TeachableDownloader:
     def login(self, email, password):
         logging.info("Logging in")
 
-        if self.check_elem_exists(By.ID, "challenge-stage", timeout=self.global_timeout):
+        if self.check_elem_exists(By.ID, "challenge-stage", timeout=PROBE_TIMEOUT):
             self.bypass_cloudflare()
 
-        WebDriverWait(self.driver, timeout=5).until(
-            EC.presence_of_element_located((By.TAG_NAME, 'body')))
+        self.wait_for(EC.presence_of_element_located((By.TAG_NAME, 'body')), timeout=5)
 
-        email_element = WebDriverWait(self.driver, self.global_timeout).until(
-            EC.presence_of_element_located((By.ID, "email")))
-        password_element = WebDriverWait(self.driver, self.global_timeout).until(
-            EC.presence_of_element_located((By.ID, "password")))
-        commit_element = WebDriverWait(self.driver, self.global_timeout).until(
-            EC.presence_of_element_located((By.NAME, "commit")))
+        email_element = self.wait_for(EC.presence_of_element_located((By.ID, "email")))
+        password_element = self.wait_for(EC.presence_of_element_located((By.ID, "password")))
+        commit_element = self.wait_for(EC.presence_of_element_located((By.NAME, "commit")))
 
         logging.debug("Filling in login form")
         email_element.click()
@@ -238,25 +3080,27 @@ class TeachableDownloader:
         password_element.clear()
         self.driver.execute_script("document.getElementById('password').value='" + password + "'")
 
+        sign_in_url = self.driver.current_url
         commit_element.click()
 
         # Check for login error due to incorrect credentials
+        # Stop waiting as soon as the browser leaves the sign in page instead of waiting for a toast that never comes
         logging.debug("Checking for login error")
         try:
-            error_elements = WebDriverWait(self.driver, self.global_timeout).until(
-                EC.presence_of_all_elements_located((By.CSS_SELECTOR, "div.toast, span.text-with-icon"))
-            )
-            for element in error_elements:
-                if "Your email or password is incorrect" in element.text:
-                    logging.error("Login failed: Incorrect email or password.")
-                    return False
+            error_texts = self.wait_for(lambda driver: driver.current_url != sign_in_url or driver.execute_script(
+                "return [...document.querySelectorAll('div.toast, span.text-with-icon')].map(e => e.innerText)"))
+            if isinstance(error_texts, list):
+                for text in error_texts:
+                    if "Your email or password is incorrect" in text:
+                        logging.error("Login failed: Incorrect email or password.")
+                        return False
         except TimeoutException:
             # No error message found, continue
             pass
 
         # Check for new device challenge
         # input with name otp_code
-        if self.check_elem_exists(By.NAME, "otp_code", timeout=self.global_timeout):
+        if self.check_elem_exists(By.NAME, "otp_code", timeout=PROBE_TIMEOUT):
             # wait for user to enter code
             input(
                 "\033[93mWarning: New device challenge\nplease enter the code sent to your email and press enter to "
@@ -266,37 +3110,39 @@ class TeachableDownloader:
         time.sleep(3)
 
     def pick_course_downloader(self, course_url):
-        # Check if we are already on the course page
-        if not self.driver.current_url == course_url:
-            logging.info("Switching to course page")
-            self.driver.get(course_url)
-            if self.check_elem_exists(By.ID, "challenge-stage", timeout=self.global_timeout):
-                self.bypass_cloudflare()
-
-        WebDriverWait(self.driver, timeout=self.global_timeout).until(
-            EC.presence_of_element_located((By.TAG_NAME, 'body')))
-
-        # https://support.teachable.com/hc/en-us/articles/360058715732-Course-Design-Templates
-        logging.info("Picking course downloader")
-        if self.driver.find_elements(By.ID, "__next"):
-            logging.info('Choosing __next format')
-            self.download_course_simple(course_url)
-        elif self.driver.find_elements(By.CLASS_NAME, "course-mainbar"):
-            logging.info('Choosing course-mainbar format')
-            self.download_course_classic(course_url)
-        elif self.driver.find_elements(By.CSS_SELECTOR, ".block__curriculum"):
-            logging.info('Choosing .block__curriculum format')
-            self.download_course_colossal(course_url)
-        else:
-            logging.error("Downloader does not support this course template. Please open an issue on github.")
+        self.course_started = time.monotonic()
+        with self.report.phase("course", course=course_url):
+            # Check if we are already on the course page
+            if not self.driver.current_url == course_url:
+                logging.info("Switching to course page")
+                self.driver.get(course_url)
+                if self.check_elem_exists(By.ID, "challenge-stage", timeout=PROBE_TIMEOUT):
+                    self.bypass_cloudflare()
+
+            self.wait_for(EC.presence_of_element_located((By.TAG_NAME, 'body')))
+            if self.school_host_limit:
+                self.bandwidth.add_host_limit(urlparse(course_url).hostname.lower(), self.school_host_limit)
+
+            # https://support.teachable.com/hc/en-us/articles/360058715732-Course-Design-Templates
+            logging.info("Picking course downloader")
+            if self.driver.find_elements(By.ID, "__next"):
+                logging.info('Choosing __next format')
+                self.download_course_simple(course_url)
+            elif self.driver.find_elements(By.CLASS_NAME, "course-mainbar"):
+                logging.info('Choosing course-mainbar format')
+                self.download_course_classic(course_url)
+            elif self.driver.find_elements(By.CSS_SELECTOR, ".block__curriculum"):
+                logging.info('Choosing .block__curriculum format')
+                self.download_course_colossal(course_url)
+            else:
+                logging.error("Downloader does not support this course template. Please open an issue on github.")
+            self.log_wait_time()
 
     def download_course_colossal(self, course_url):
         logging.info("Detected block course format")
         try:
             logging.info("Getting course title")
-            course_title = WebDriverWait(self.driver, self.global_timeout).until(
-                EC.presence_of_element_located((By.CSS_SELECTOR, ".lecture_heading"))
-            ).text
+            course_title = self.wait_for(EC.presence_of_element_located((By.CSS_SELECTOR, ".lecture_heading"))).text
         except Exception as e:
             logging.warning("Could not get course title, using tab title instead")
             course_title = self.driver.title
@@ -304,53 +3150,17 @@ class TeachableDownloader:
         # course_title = clean_string(course_title)
         course_path = create_folder(course_title)
 
+        # Wait for the curriculum to render, then parse it from a single copy of the page source
+        self.wait_for(EC.presence_of_all_elements_located((By.CSS_SELECTOR, ".block__curriculum__section")))
+        page_source = self.driver.page_source
+
         logging.info("Saving course html")
         try:
-            output_file = os.path.join(course_path, "course.html")
-            with open(output_file, 'w+') as f:
-                f.write(self.driver.page_source)
+            self.save_html(os.path.join(course_path, "course.html"), page_source, course_path)
         except Exception as e:
             logging.error("Could not save course html: " + str(e), exc_info=self.verbose)
 
-        # Unhide all elements
-        logging.info("Unhiding all elements")
-        self.driver.execute_script('[...document.querySelectorAll(".hidden")].map(e=>e.classList.remove("hidden"))')
-
-        chapter_idx = 1
-        video_list = []
-        sections = WebDriverWait(self.driver, self.global_timeout).until(
-            EC.presence_of_all_elements_located((By.CSS_SELECTOR, ".block__curriculum__section"))
-        )
-
-        for section in sections:
-            chapter_title = section.find_element(By.CSS_SELECTOR, ".block__curriculum__section__title").text
-            chapter_title = clean_string(chapter_title)
-            chapter_title = "{:02d}-{}".format(chapter_idx, chapter_title)
-            logging.info("Found chapter: " + chapter_title)
-
-            download_path = os.path.join(course_path, chapter_title)
-            os.makedirs(download_path, exist_ok=True)
-
-            chapter_idx += 1
-            idx = 1
-
-            section_items = section.find_elements(By.CSS_SELECTOR, ".block__curriculum__section__list__item__link")
-            for section_item in section_items:
-                lecture_link = section_item.get_attribute("href")
-
-                lecture_title = section_item.find_element(By.CSS_SELECTOR,
-                                                          ".block__curriculum__section__list__item__lecture-name").text
-                lecture_title = clean_string(lecture_title)
-                lecture_title = ''.join(char for char in lecture_title if char in string.printable)
-                logging.info("Found lecture: " + lecture_title)
-
-                truncated_lecture_title = truncate_title_to_fit_file_name(lecture_title)
-
-                video_entity = {"link": lecture_link, "title": truncated_lecture_title, "idx": idx,
-                                "download_path": download_path}
-                video_list.append(video_entity)
-                idx += 1
-
+        video_list = parse_curriculum_colossal(page_source, self.driver.current_url, course_path)
         self.download_videos_from_links(video_list)
 
     def download_course_classic(self, course_url):
@@ -359,7 +3169,7 @@ class TeachableDownloader:
         print("Detected _mainbar course format")
         try:
             logging.debug("Getting course title")
-            course_title = WebDriverWait(self.driver, self.global_timeout).until(
+            course_title = self.wait_for(
                 EC.presence_of_element_located((By.CSS_SELECTOR, "body > section > div.course-sidebar > div > h2"))
             ).text
         except Exception as e:
@@ -374,87 +3184,52 @@ class TeachableDownloader:
         course_path = create_folder(course_title)
         print("course_path: ", course_path)
 
+        # Wait for the curriculum to render, then parse it from a single copy of the page source
+        self.wait_for(EC.presence_of_all_elements_located((By.CSS_SELECTOR, ".course-section")), timeout=10)
+        page_source = self.driver.page_source
+
         try:
             logging.debug("Saving course html")
-            output_file = os.path.join(course_path, "course.html")
-            with open(output_file, 'w+', encoding="utf-8") as f:
-                f.write(self.driver.page_source)
+            self.save_html(os.path.join(course_path, "course.html"), page_source, course_path)
         except Exception as e:
             logging.error("Could not save course html: " + str(e), exc_info=self.verbose)
 
         # Get course image
 
-        try:
-            image_element = self.driver.find_elements(By.CLASS_NAME, "course-image")
-            logging.info("Found course image")
-            image_link = image_element[0].get_attribute("src")
-            image_link_hd = re.sub(r"/resize=.+?/", "/", image_link)
-            # try to download the image using the modified link first
-            response = requests.get(image_link_hd)
-            if response.ok:
+        if os.path.isfile(os.path.join(course_path, "course-image.jpg")):
+            logging.info("Skipping existing course image")
+        else:
+            try:
+                image_element = self.driver.find_elements(By.CLASS_NAME, "course-image")
+                logging.info("Found course image")
+                image_link = image_element[0].get_attribute("src")
+                image_link_hd = re.sub(r"/resize=.+?/", "/", image_link)
+                # try to download the image using the modified link first
+                session = self.get_http_session()
+                try:
+                    response = self.http_get(session, image_link_hd, course_path)
+                except requests.RequestException as e:
+                    # try to download the image using the original link
+                    logging.debug("Could not download HD image: " + str(e))
+                    response = self.http_get(session, image_link, course_path)
                 # save the image to disk
                 image_path = os.path.join(course_path, "course-image.jpg")
                 with open(image_path, "wb") as f:
                     f.write(response.content)
                 logging.info("Image downloaded successfully.")
-            else:
-                # try to download the image using the original link
-                response = requests.get(image_link)
-                if response.ok:
-                    # save the image to disk
-                    image_path = os.path.join(course_path, "course-image.jpg")
-                    with open(image_path, "wb") as f:
-                        f.write(response.content)
-                    logging.info("Image downloaded successfully.")
-                else:
-                    # print a message indicating that the image download failed
-                    logging.warning("Failed to download image.")
-        except Exception as e:
-            logging.warning("Could not find course image: " + str(e))
-            pass
-
-        chapter_idx = 1
-        video_list = []
-        sections = WebDriverWait(self.driver, 10).until(
-            EC.presence_of_all_elements_located((By.CSS_SELECTOR, ".course-section"))
-        )
-        for section in sections:
-            chapter_title = section.find_element(By.CSS_SELECTOR, ".section-title").text
-            # chapter_title = clean_string(chapter_title)
-            chapter_title = chapter_title = "{:02d}-{}".format(chapter_idx, chapter_title)
-            logging.info("Found chapter: " + chapter_title)
-
-            download_path = os.path.join(course_path, chapter_title)
-            os.makedirs(download_path, exist_ok=True)
-
-            chapter_idx += 1
-            idx = 1
-
-            section_items = section.find_elements(By.CSS_SELECTOR, ".section-item")
-            for section_item in section_items:
-                lecture_link = section_item.find_element(By.CLASS_NAME, "item").get_attribute("href")
-
-                lecture_title = section_item.find_element(By.CLASS_NAME, "lecture-name").text
-                # lecture_title = clean_string(lecture_title)
-                logging.info("Found lecture: " + lecture_title)
-                # truncated_lecture_title = truncate_title_to_fit_file_name(lecture_title)
-
-                
-                video_entity = {"link": lecture_link, "title": lecture_title, "idx": idx,
-                                "download_path": download_path}
-                video_list.append(video_entity)
-                idx += 1
+            except Exception as e:
+                logging.warning("Could not find course image: " + str(e))
+                pass
 
+        video_list = parse_curriculum_classic(page_source, self.driver.current_url, course_path)
         self.download_videos_from_links(video_list)
 
     def get_course_title_next(self, course_url):
         if self.driver.current_url != course_url:
             self.driver.get(course_url)
 
-        wrap = WebDriverWait(self.driver, self.global_timeout).until(
-            EC.presence_of_element_located((By.CSS_SELECTOR, ".wrap")))
-        heading = WebDriverWait(self.driver, self.global_timeout).until(
-            EC.presence_of_element_located((By.CSS_SELECTOR, ".heading")))
+        wrap = self.wait_for(EC.presence_of_element_located((By.CSS_SELECTOR, ".wrap")))
+        heading = self.wait_for(EC.presence_of_element_located((By.CSS_SELECTOR, ".heading")))
         course_title = heading.text
 
         course_title = clean_string(course_title)
@@ -462,155 +3237,399 @@ class TeachableDownloader:
 
     def download_course_simple(self, course_url):
         print("download_course_simple")
-        self.driver.implicitly_wait(2)
+        self.set_implicit_wait(2)
         logging.info("Detected next course format")
         course_title = self.get_course_title_next(course_url)
         logging.info("Found course title: " + course_title)
         course_path = create_folder(course_title)
 
-        output_file = os.path.join(course_path, "course.html")
+        page_source = self.driver.page_source
         try:
-            with open(output_file, 'w+', encoding='utf-8') as f:
-                f.write(self.driver.page_source)
+            self.save_html(os.path.join(course_path, "course.html"), page_source, course_path)
         except Exception as e:
             logging.error("Could not save course html: " + str(e), exc_info=self.verbose)
 
         # Download course image
-        try:
-            logging.info("Downloading course image")
-            image_element = self.driver.find_element(By.XPATH, "//*[@id=\"__next\"]/div/div/div[2]/div/div[1]/img")
-            logging.info("Found course image")
-            image_link = image_element.get_attribute("src")
-            # Save image
-            image_path = os.path.join(course_path, "course-image.jpg")
-            # send a GET request to the image link
+        if os.path.isfile(os.path.join(course_path, "course-image.jpg")):
+            logging.info("Skipping existing course image")
+        else:
             try:
-                response = requests.get(image_link)
-                # write the image data to a file
-                with open(image_path, "wb") as f:
-                    f.write(response.content)
-                # print a message indicating that the image was downloaded
-                logging.info("Image downloaded successfully.")
+                logging.info("Downloading course image")
+                image_element = self.driver.find_element(By.XPATH, "//*[@id=\"__next\"]/div/div/div[2]/div/div[1]/img")
+                logging.info("Found course image")
+                image_link = image_element.get_attribute("src")
+                # Save image
+                image_path = os.path.join(course_path, "course-image.jpg")
+                # send a GET request to the image link
+                try:
+                    response = self.http_get(self.get_http_session(), image_link, course_path)
+                    # write the image data to a file
+                    with open(image_path, "wb") as f:
+                        f.write(response.content)
+                    # print a message indicating that the image was downloaded
+                    logging.info("Image downloaded successfully.")
+                except Exception as e:
+                    # print a message indicating that the image download failed
+                    logging.warning("Failed to download image:" + str(e))
             except Exception as e:
-                # print a message indicating that the image download failed
-                logging.warning("Failed to download image:" + str(e))
-        except Exception as e:
-            logging.warning("Could not find course image: " + str(e))
-            pass
+                logging.warning("Could not find course image: " + str(e))
+                pass
 
-        chapter_idx = 0
-        video_list = []
-        slim_sections = self.driver.find_elements(By.CSS_SELECTOR, ".slim-section")
-        for slim_section in slim_sections:
-            chapter_idx += 1
-            bars = slim_section.find_elements(By.CSS_SELECTOR, ".bar")
-            chapter_title = slim_section.find_element(By.CSS_SELECTOR, ".heading").text
-            chapter_title = clean_string(chapter_title)
-            chapter_title = "{:02d}-{}".format(chapter_idx, chapter_title)
-            logging.info("Found chapter: " + chapter_title)
+        video_list = parse_curriculum_simple(page_source, self.driver.current_url, course_path)
+        self.download_videos_from_links(video_list)
 
-            try:
-                not_available_element = WebDriverWait(slim_section, self.global_timeout).until(
-                    EC.presence_of_element_located((By.CSS_SELECTOR, ".drip-tag")))
-                logging.warning('Chapter "%s" not available, skipping', chapter_title)
+    def get_manifest(self, course_path):
+        # One manifest per course, shared by the browser threads and the download workers
+        with self.manifest_lock:
+            if course_path not in self.manifests:
+                self.manifests[course_path] = DownloadManifest(course_path)
+            return self.manifests[course_path]
+
+    def move_lecture_files(self, course_path, moves, manifest):
+        # Two passes through a staging directory, so lectures that swap places don't overwrite each other
+        staging_path = os.path.join(course_path, ".sync-staging")
+        staged = []
+        for n, (old, new) in enumerate(moves):
+            old_path = os.path.join(course_path, old["section"])
+            old_prefix = "{:02d}-{}".format(old["idx"], old["title"])
+            if not os.path.isdir(old_path):
                 continue
-            except TimeoutException:
-                logging.info("Chapter is available")
-                pass  # Element wasn't found so the chapter is available
-
-            download_path = os.path.join(course_path, chapter_title)
-            os.makedirs(download_path, exist_ok=True)
-
-            idx = 1
-            for bar in bars:
-                video = bar.find_element(By.CSS_SELECTOR, ".text")
-                link = video.get_attribute("href")
-                # Remove new line characters from the title and replace spaces with -
-                title = clean_string(video.text)
-                logging.info("Found lecture: " + title)
-                truncated_title = truncate_title_to_fit_file_name(title)
-                video_entity = {"link": link, "title": truncated_title, "idx": idx, "download_path": download_path}
-                video_list.append(video_entity)
-                idx += 1
-    
-        self.download_videos_from_links(video_list)
+            for name in os.listdir(old_path):
+                if lecture_file_suffix(name, old_prefix) is not None:
+                    staged_file = os.path.join(staging_path, str(n), name)
+                    os.makedirs(os.path.dirname(staged_file), exist_ok=True)
+                    os.replace(os.path.join(old_path, name), staged_file)
+                    staged.append((old, new, old_prefix, name, staged_file))
+
+        moved_files = []
+        for old, new, old_prefix, name, staged_file in staged:
+            new_path = os.path.join(course_path, new["section"])
+            new_name = "{:02d}-{}".format(new["idx"], new["title"]) + lecture_file_suffix(name, old_prefix)
+            os.makedirs(new_path, exist_ok=True)
+            os.replace(staged_file, os.path.join(new_path, new_name))
+            moved_files.append((os.path.join(course_path, old["section"], name), os.path.join(new_path, new_name)))
+            logging.info("Moved " + os.path.join(old["section"], name) + " to " + os.path.join(new["section"], new_name))
+        shutil.rmtree(staging_path, ignore_errors=True)
+        manifest.move_videos(moved_files)
+
+        # Pages saved with --page-archive are not files of their own, they are renamed in the index
+        if os.path.isfile(os.path.join(course_path, "pages.db")):
+            page_names = [tuple(os.path.relpath(os.path.join(course_path, entry["section"], "{:02d}-{}.html".format(
+                entry["idx"], entry["title"])), course_path).replace(os.sep, "/") for entry in (old, new))
+                for old, new in moves]
+            PageArchive(course_path, workers=False).rename(page_names)
+
+        # Drop chapter folders that were left empty by renumbering
+        for old, new in moves:
+            old_path = os.path.join(course_path, old["section"])
+            if os.path.isdir(old_path) and not os.listdir(old_path):
+                os.rmdir(old_path)
+
+        for old, new in moves:
+            lecture = manifest.get(manifest.lecture_key(new["link"]))
+            if lecture is None:
+                continue
+            old_prefix = "video:" + os.path.join(old["section"], "{:02d}-{}".format(old["idx"], old["title"]))
+            new_prefix = "video:" + os.path.join(new["section"], "{:02d}-{}".format(new["idx"], new["title"]))
+            videos = []
+            for key in lecture.get("videos", []):
+                suffix = lecture_file_suffix(key, old_prefix)
+                videos.append(new_prefix + suffix if suffix is not None else key)
+            manifest.update(lecture["key"], idx=new["idx"], title=new["title"],
+                            output_path=os.path.join(course_path, new["section"]), videos=videos)
+
+    def sync_curriculum(self, video_list, course_path, manifest):
+        """
+        Compares the curriculum with the one stored by the previous run, moves the files of renumbered or renamed
+        lectures and returns only the lectures that still need to be downloaded.
+
+        :param video_list: List[dict]
+            The lectures found by the course downloader.
+        :return: List[dict]
+            The added lectures and the ones that aren't complete in the manifest yet.
+        """
+        if not self.sync:
+            # The snapshot is only replaced by sync runs, so the next one still sees where the files are
+            return video_list
+
+        snapshot_file = os.path.join(course_path, "curriculum.json")
+        current = curriculum_snapshot(video_list, course_path)
+        previous = []
+        if os.path.isfile(snapshot_file):
+            with open(snapshot_file, "r", encoding="utf-8") as f:
+                previous = json.load(f)
+
+        diff = diff_curriculum(previous, current)
+        if diff["moved"]:
+            self.move_lecture_files(course_path, diff["moved"], manifest)
+
+        tmp_file = snapshot_file + ".tmp"
+        with open(tmp_file, "w", encoding="utf-8") as f:
+            json.dump(current, f, indent=2)
+        os.replace(tmp_file, snapshot_file)
+
+        pending = [video for video in video_list if not manifest.is_lecture_complete(video["link"])]
+        report = {
+            "added": [entry["link"] for entry in diff["added"]],
+            "moved": [{"link": new["link"], "from": os.path.join(old["section"], old["title"]),
+                       "to": os.path.join(new["section"], new["title"])} for old, new in diff["moved"]],
+            "removed": [entry["link"] for entry in diff["removed"]],
+            "unchanged": len(diff["unchanged"]),
+            "to_download": [video["link"] for video in pending],
+        }
+        with open(os.path.join(course_path, "sync-report.json"), "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+        summary = "Sync {}: {} added, {} moved, {} removed, {} unchanged, {} to download".format(
+            os.path.basename(course_path), len(diff["added"]), len(diff["moved"]), len(diff["removed"]),
+            len(diff["unchanged"]), len(pending))
+        logging.info(summary)
+        print(summary)
+        return pending
 
     def download_videos_from_links(self, video_list):
+        if not video_list:
+            return
+        course_path = os.path.dirname(video_list[0]["download_path"])
+        if self.course_started is not None:
+            self.report.record("enumerate", time.monotonic() - self.course_started, course=course_path,
+                               lectures=len(video_list))
+            self.course_started = None
+        manifest = self.get_manifest(course_path)
+        try:
+            self.download_course_lectures(video_list, course_path, manifest)
+        finally:
+            # Flushes the pages of the course and stops its writer thread
+            self.close_page_archive(course_path)
+
+    def download_course_lectures(self, video_list, course_path, manifest):
+        try:
+            video_list = self.sync_curriculum(video_list, course_path, manifest)
+        except Exception as e:
+            logging.error("Could not compare curriculum with the previous run: " + str(e), exc_info=self.verbose)
+        # Lectures count towards the total of the status endpoint once they reach download_lecture, the ones filtered
+        # out before are never recorded as done or skipped
+        if self.jobs is not None and self.current_job is not None and self.current_job["kind"] == "course":
+            # Counted by the workers that take the lecture jobs
+            self.queue_lecture_jobs(video_list, manifest)
+            return
+        if self.prefetch <= 0 or self.plan is not None:
+            self.report.add_total("lectures", len(video_list))
+            for video in video_list:
+                self.download_lecture(video, manifest)
+            return
+
+        pending = [video for video in video_list if not manifest.is_lecture_complete(video["link"])]
+        self.report.add_total("lectures", len(pending))
+        prefetcher = LecturePrefetcher(self.driver, self.prefetch, self.get_http_session, self.resolve_media_urls)
+        try:
+            for i, video in enumerate(pending):
+                prefetched = prefetcher.take(video["link"])
+                # Start loading the next lectures before this one is handled
+                prefetcher.schedule([upcoming["link"] for upcoming in pending[i + 1:]])
+                self.download_lecture(video, manifest, prefetched)
+                prefetcher.harvest()
+        finally:
+            prefetcher.close()
+
+    def download_lecture(self, video, manifest, prefetched=None):
+        if self.stop_event.is_set():
+            raise InterruptedError("Stopped")
+        print(video["title"])
+        if manifest.is_lecture_complete(video["link"]):
+            logging.info("Skipping completed lecture: " + video["title"])
+            self.report.record("lecture_skipped", 0, write=False)
+            return
+        with self.report.phase("lecture", lecture=video["title"], link=video["link"]) as fields:
+            try:
+                self.handle_lecture(video, manifest, prefetched)
+            finally:
+                self.download_tracker.drain()
+            entry = manifest.get(manifest.lecture_key(video["link"])) or {}
+            if entry.get("status") == "failed":
+                fields.update(ok=False, error="Not all videos of the lecture were found")
+
+    def handle_lecture(self, video, manifest, prefetched):
         timeout = 15
-        for video in video_list:
-            print(video["title"])
-            if self.driver.current_url != video["link"]:
-                logging.info("Navigating to lecture: " + video["title"])
+        if prefetched is not None:
+            logging.info("Using prefetched lecture: " + video["title"])
+            self.wait_for(lambda driver: driver.execute_script("return document.readyState") == "complete", timeout)
+            self.set_implicit_wait(timeout)
+        elif self.driver.current_url != video["link"]:
+            logging.info("Navigating to lecture: " + video["title"])
+            with self.report.phase("navigate", lecture=video["title"]):
                 self.driver.get(video["link"])
-                self.driver.implicitly_wait(timeout)
-            logging.info("Downloading lecture: " + video["title"])
+            self.set_implicit_wait(timeout)
+        logging.info("Downloading lecture: " + video["title"])
+
+        # logging.info("Disabling autoplay")
+        # self.driver.execute_script('var checkbox = document.getElementById("custom-toggle-autoplay");'
+        #                            'if (checkbox.checked) {checkbox.click();}')
 
-            # logging.info("Disabling autoplay")
-            # self.driver.execute_script('var checkbox = document.getElementById("custom-toggle-autoplay");'
-            #                            'if (checkbox.checked) {checkbox.click();}')
+        try:
+            logging.info("Saving html")
+            self.save_webpage_as_html(video["title"], video["idx"], video["download_path"],
+                                      html=prefetched["html"] if prefetched else None)
+        except Exception as e:
+            logging.error("Could not save html: " + video["title"] + " cause: " + str(e), exc_info=self.verbose)
 
+        attachment_keys = []
+        if self.download_attachments_enabled:
             try:
-                logging.info("Saving html")
-                self.save_webpage_as_html(video["title"], video["idx"], video["download_path"])
+                logging.info("Downloading attachments")
+                attachment_keys = self.download_attachments(video["link"], video["title"], video["idx"],
+                                                            video["download_path"])
             except Exception as e:
-                logging.error("Could not save html: " + video["title"] + " cause: " + str(e), exc_info=self.verbose)
-
-            # try:
-            #     logging.info("Downloading attachments")
-            #     self.download_attachments(video["link"], video["title"], video["idx"], video["download_path"])
-            # except Exception as e:
-            #     logging.warning("Could not download attachments: " + video["title"] + " cause: " + str(e))
-            
-            try:
-                logging.debug("Trying to download video as an attachment")
-                if self.download_video_file(video["title"], video["idx"], video["download_path"]):
-                    continue
+                logging.warning("Could not download attachments: " + video["title"] + " cause: " + str(e))
 
-            except Exception as e:
-                logging.debug("Could not download video as an attachment: " + video["title"] + " cause: " + str(e))
+        # In plan mode nothing is downloaded yet, the manifest and the school must not record the lecture as done
+        planning = self.plan is not None
+        lecture_key = manifest.lecture_key(video["link"])
+        if not planning:
+            manifest.update(lecture_key, link=video["link"], idx=video["idx"], title=video["title"],
+                            output_path=video["download_path"], status="started", attachments=attachment_keys)
+
+        try:
+            logging.debug("Trying to download video as an attachment")
+            if self.download_video_file(video["title"], video["idx"], video["download_path"]):
+                if not planning:
+                    manifest.update(lecture_key, status="complete", videos=[])
+                return
 
-            video_iframes = self.driver.find_elements(By.XPATH, "//iframe[starts-with(@data-testid, 'embed-player')]")
+        except Exception as e:
+            logging.debug("Could not download video as an attachment: " + video["title"] + " cause: " + str(e))
 
-            for i, iframe in enumerate(video_iframes):
-                try:
-                    logging.info("Switching to video frame")
-                    self.driver.switch_to.frame(iframe)
-
-                    script_text = self.driver.find_element(By.ID, "__NEXT_DATA__")
-                    json_text = json.loads(script_text.get_attribute("innerHTML"))
-                    # ["urlEncrypted"] some how cause some 404 here
-                    link = json_text["props"]["pageProps"]["applicationData"]["mediaAssets"][0]["url"]
-                    # Append -n to the video title if there are multiple iframes
-                    video_title = video["title"] + ("-" + str(i + 1) if len(video_iframes) > 1 else "")
-
-                    # try:
-                    #     logging.info("Downloading subtitle")
-                    #     self.download_subtitle(link, video_title, video["idx"], video["download_path"])
-                    # except Exception as e:
-                    #     logging.warning("Could not download subtitle: " + video_title + " cause: " + str(e))
+        # Read all embed urls in one call and resolve them over HTTP, the browser is only used as a fallback
+        with self.report.phase("resolve", lecture=video["title"]) as fields:
+            if prefetched is not None and prefetched["media"] is not None:
+                embed_urls = prefetched["embed_urls"]
+                media_links = prefetched["media"].result()
+            else:
+                embed_urls = self.read_embed_urls(timeout)
+                media_links = self.resolve_media_urls(embed_urls, video["link"])
+            fields.update(embeds=len(embed_urls), unresolved=media_links.count(None))
+        video_iframes = None
+
+        video_keys = []
+        resolved = True
+        for i, link in enumerate(media_links):
+            try:
+                if link is None:
+                    if video_iframes is None:
+                        video_iframes = self.driver.find_elements(
+                            By.XPATH, "//iframe[starts-with(@data-testid, 'embed-player')]")
+                    with self.report.phase("resolve_frame", lecture=video["title"]):
+                        link = self.resolve_media_url_in_frame(video_iframes[i])
+                # Append -n to the video title if there are multiple iframes
+                video_title = video["title"] + ("-" + str(i + 1) if len(media_links) > 1 else "")
 
+                if self.download_subtitles_enabled:
                     try:
-                        logging.info("Downloading video")
-                        self.download_video(link, video_title, video["idx"], video["download_path"])
+                        logging.info("Downloading subtitle")
+                        self.queue_subtitle_download(link, video_title, video["idx"], video["download_path"])
                     except Exception as e:
-                        logging.warning("Could not download video: " + video_title + " cause: " + str(e))
-
-                    self.driver.switch_to.default_content()  # Switch back to main content before the next iteration
+                        logging.warning("Could not download subtitle: " + video_title + " cause: " + str(e))
 
+                video_keys.append(manifest.video_key(self.video_output_file(video_title, video["idx"],
+                                                                            video["download_path"])))
+                try:
+                    self.queue_video_download(link, video_title, video["idx"], video["download_path"],
+                                              embed_url=embed_urls[i], referer=video["link"])
                 except Exception as e:
-                    logging.warning("Could not find video: " + video["title"])
-                    continue
+                    logging.warning("Could not download video: " + video_title + " cause: " + str(e))
+
+            except Exception as e:
+                logging.warning("Could not find video: " + video["title"])
+                resolved = False
+                continue
 
+        if planning:
+            return
+        if not media_links:
+            # Either a lecture without video or players that did not render in time, it is looked at again on the
+            # next run
+            checks = (manifest.get(lecture_key) or {}).get("checks", 0) + 1
+            manifest.update(lecture_key, status="no_video", checks=checks, videos=[])
+            logging.warning("No video found for lecture: " + video["title"])
+        else:
+            # Videos are tracked by their own entries, the lecture is complete once all of them are
+            manifest.update(lecture_key, status="complete" if resolved else "failed", videos=video_keys)
             logging.info("Downloaded video: " + video["title"])
 
-            if self._complete_lecture:
-                try:
-                    logging.info("Completing lecture")
-                    self.complete_lecture()
-                except Exception as e:
-                    logging.warning("Could not complete lecture: " + video["title"] + " cause: " + str(e))
+        if self._complete_lecture:
+            try:
+                logging.info("Completing lecture")
+                self.complete_lecture()
+            except Exception as e:
+                logging.warning("Could not complete lecture: " + video["title"] + " cause: " + str(e))
+
+    def read_embed_urls(self, timeout):
+        # The players are rendered by scripts after the page has loaded, wait for them as long as find_elements did
+        # under the implicit wait
+        try:
+            return self.wait_for(lambda driver: driver.execute_script(EMBED_URLS_SCRIPT), timeout)
+        except TimeoutException:
+            return []
+
+    def add_plan_item(self, item_type, url, output_path, **fields):
+        # Paths are stored relative to the working directory so the plan can be executed on another host
+        item = dict(fields, type=item_type, url=url, output_path=os.path.relpath(output_path))
+        self.plan.append(item)
+        logging.info("Planned " + item_type + ": " + url)
+        return item
+
+    def queue_subtitle_download(self, link, title, video_index, output_path):
+        if self.plan is not None:
+            self.add_plan_item("subtitle", link, output_path, title=title, idx=video_index)
+            return
+        self.download_subtitle(link, title, video_index, output_path)
+
+    def queue_video_download(self, link, title, video_index, output_path, embed_url=None, referer=None):
+        if self.plan is not None:
+            self.add_plan_item("video", link, output_path, title=title, idx=video_index, embed_url=embed_url,
+                               referer=referer,
+                               target=os.path.relpath(self.video_output_file(title, video_index, output_path)),
+                               expected_size=None)
+            return
+
+        # Without workers the video is downloaded inline, as before
+        if self.download_workers <= 0:
+            logging.info("Downloading video")
+            self.download_video(link, title, video_index, output_path, embed_url=embed_url, referer=referer)
+            return
+
+        if self.pipeline is None:
+            self.pipeline = DownloadPipeline(self.download_video, workers=self.download_workers,
+                                             queue_size=self.download_queue_size)
+            self.pipeline.start()
+        logging.info("Queueing video for download")
+        self.pipeline.submit(link=link, title=title, video_index=video_index, output_path=output_path,
+                             embed_url=embed_url, referer=referer)
 
-        return
+    def queue_depths(self):
+        depths = collections.Counter()
+        for browser in self.browser_list:
+            # Read once, the browser threads reset these while the status endpoint reads them
+            pipeline = browser.pipeline
+            attachment_fetcher = browser.attachment_fetcher
+            if pipeline is not None:
+                depths["videos"] += pipeline.jobs.qsize()
+            if attachment_fetcher is not None:
+                depths["attachments"] += sum(1 for future in list(attachment_fetcher.futures) if not future.done())
+        depths["postprocessing"] = self.postprocessor.running()
+        if self.jobs is not None:
+            for state, count in self.jobs.counts().items():
+                depths["jobs_" + state] = count
+        return dict(depths)
+
+    def wait_for_downloads(self):
+        if self.attachment_fetcher is not None:
+            logging.info("Waiting for attachment downloads to finish")
+            self.attachment_fetcher.join()
+        if self.pipeline is not None:
+            logging.info("Waiting for queued downloads to finish")
+            self.pipeline.join()
+            self.pipeline = None
+        self.postprocessor.join()
 
     def complete_lecture(self):
         # Complete lecture
@@ -622,32 +3641,142 @@ class TeachableDownloader:
             logging.info("Completed lecture")
             time.sleep(3)
 
-    def download_video(self, link, title, video_index, output_path):
+    def video_output_file(self, title, video_index, output_path):
+        return os.path.join(output_path, "{:02d}-{}.mp4".format(video_index, title))
+
+    def download_video(self, link, title, video_index, output_path, embed_url=None, referer=None):
+        output_file = self.video_output_file(title, video_index, output_path)
+        manifest = self.get_manifest(os.path.dirname(output_path))
+        video_key = manifest.video_key(output_file)
+        if manifest.is_video_complete(output_file):
+            logging.info("Skipping completed video: " + title)
+            return True
+
+        # The asset is identified by the URL resolved first, a refreshed URL points to the same asset
+        asset = asset_id(link)
+        if self.content_store is not None and self.content_store.link(asset, output_file):
+            manifest.update(video_key, title=title, idx=video_index, media_url=link, output_path=output_file,
+                            status="complete", size=os.path.getsize(output_file))
+            self.report.record("download", 0, video=title, engine="link")
+            return True
+
+        def refresh_media_url(expired_url):
+            # Signed media URLs expire, the embed page hands out a new one. This runs on a download worker, so it
+            # uses the session as it is instead of asking the browser for cookies.
+            if not embed_url:
+                return None
+            try:
+                media_url = self.fetch_media_url(self.session_bridge.session, embed_url, referer or embed_url)
+            except Exception as e:
+                logging.warning("Could not refresh media url: " + title + " cause: " + str(e))
+                return None
+            manifest.update(video_key, media_url=media_url)
+            return media_url
+
+        # Conversion and metadata run afterwards in the postprocessing pool
         ydl_opts = {
             "format": "bestvideo[ext=mp4]+bestaudio[ext=m4a]/best[ext=mp4]/best",
             "merge_output_format": "mp4",
-            "postprocessors": [
-                {
-                    "key": "FFmpegVideoConvertor",
-                    "preferedformat": "mp4",
-                },
-                {
-                    "key": "FFmpegMetadata",
-                },
-            ],
             "http_headers": self.headers,
-            "concurrentfragments": 15,
-            "outtmpl": os.path.join(output_path, "{:02d}-{}.mp4".format(video_index, title)),
+            # Partially downloaded fragments are picked up again on the next run
+            "continuedl": True,
+            "outtmpl": output_file,
             "verbose": self.verbose,
         }
         print("download_video link: ", link)
+        manifest.update(video_key, title=title, idx=video_index, media_url=link, output_path=output_file,
+                        status="downloading")
+
+        if self.hls_engine == "native":
+            try:
+                hls = HlsDownloader(self.session_bridge.session, self.headers, self.fragment_controller,
+                                    self.bandwidth, self.retry_policy, course=os.path.dirname(output_path),
+                                    timeout=max(self.global_timeout, 30), verbose=self.verbose)
+                with self.download_slots or contextlib.nullcontext(), \
+                        self.report.phase("download", video=title, engine="native") as fields:
+                    # Segments are retried one by one, this level only replaces an expired playlist URL
+                    size, link = self.retry_policy.call(
+                        lambda url: (hls.download(url, output_file, title), url), link,
+                        on_expired=refresh_media_url, retries=0)
+                    fields["bytes"] = size
+                manifest.update(video_key, status="complete", size=os.path.getsize(output_file))
+                logging.info("Downloaded video: " + title + " (" + str(size) + " bytes)")
+                if self.content_store is not None:
+                    self.content_store.add(output_file, asset)
+                return True
+            except Exception as e:
+                logging.warning("Native HLS download failed, falling back to yt-dlp: " + title + " cause: " + str(e))
+
+        # yt-dlp can't change its fragment concurrency mid-download, it starts with what the controller learned from
+        # the previous downloads and its throughput feeds back into the next ones
+        downloaded = {"bytes": 0}
+
+        course = os.path.dirname(output_path)
+
+        def progress_hook(progress):
+            nbytes = progress.get("downloaded_bytes") or 0
+            self.fragment_controller.report(output_file, nbytes=max(0, nbytes - downloaded["bytes"]))
+            self.bandwidth.charge(course, max(0, nbytes - downloaded["bytes"]))
+            downloaded["bytes"] = nbytes
+
         try:
-            with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-                # ydl.download([link])
-                ydl.download(link)
+            with self.download_slots or contextlib.nullcontext(), self.bandwidth.transfer(link, course, slot=False):
+                ydl_opts["concurrent_fragment_downloads"] = self.fragment_controller.register(output_file)
+                ydl_opts["progress_hooks"] = [progress_hook]
+                ydl_opts["logger"] = YtDlpLogger(self.fragment_controller, output_file)
+                # yt-dlp paces itself, it gets the share of the course at the time it starts
+                ydl_opts["ratelimit"] = self.bandwidth.share() or None
+
+                def run_yt_dlp(url):
+                    with self.session_bridge.cookie_file_copy() as cookie_file, \
+                            yt_dlp.YoutubeDL(dict(ydl_opts, cookiefile=cookie_file)) as ydl:
+                        try:
+                            ydl.process_ie_result(self.extract_media_info(ydl, url, title), download=True)
+                        except Exception:
+                            # The formats may have expired before the cache entry, extract them again on retry
+                            if self.extraction_cache is not None:
+                                self.extraction_cache.invalidate(url)
+                            raise
+
+                # yt-dlp retries fragments itself, a failing CDN still trips the circuit breaker
+                with self.report.phase("download", video=title, engine="yt-dlp") as fields:
+                    try:
+                        self.retry_policy.call(run_yt_dlp, link, on_expired=refresh_media_url, retries=0)
+                    finally:
+                        fields["bytes"] = downloaded["bytes"]
 
         except Exception as e:
             logging.error("Could not download video: " + title + " cause: " + str(e))
+            manifest.update(video_key, status="failed", error=str(e))
+            self.fragment_controller.unregister(output_file, failed=True)
+            return False
+
+        self.fragment_controller.unregister(output_file)
+        # Segments a failed native attempt kept for resuming are not needed anymore
+        for part in hls_part_files(output_file):
+            if os.path.exists(part):
+                os.remove(part)
+        manifest.update(video_key, status="postprocessing")
+        self.postprocessor.submit(output_file, title, manifest, video_key,
+                                  on_complete=functools.partial(self.content_store.add, asset=asset)
+                                  if self.content_store is not None else None)
+        return True
+
+    def extract_media_info(self, ydl, link, title):
+        """
+        Runs the yt-dlp extraction of link without format or subtitle selection, so the video and the subtitle
+        downloads can each select from the same result. The result is taken from the extraction cache if possible.
+        """
+        info = self.extraction_cache.get(link) if self.extraction_cache is not None else None
+        if info is not None:
+            logging.debug("Using cached extraction: " + title)
+            self.report.record("extract", 0, write=False)
+            return info
+        with self.report.phase("extract", video=title):
+            info = ydl.sanitize_info(ydl.extract_info(link, download=False, process=False))
+        if self.extraction_cache is not None:
+            self.extraction_cache.put(link, info)
+        return info
 
     # This function is needed because yt-dlp subtitle downloader is not working
     def download_subtitle(self, link, title, video_index, output_path):
@@ -673,18 +3802,21 @@ class TeachableDownloader:
         }
 
         try:
-            with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-                info = ydl.extract_info(link, download=False)
+            with self.session_bridge.cookie_file_copy() as cookie_file, \
+                    yt_dlp.YoutubeDL(dict(ydl_opts, cookiefile=cookie_file)) as ydl:
+                # Shares the extraction with the video download, only the selection runs here
+                info = ydl.process_ie_result(self.extract_media_info(ydl, link, title), download=False)
                 info_json = ydl.sanitize_info(info)
         except Exception as e:
             logging.warning("Could not download subtitle: " + title + " cause: " + str(e))
+            return
 
         subtitle_links = {}
         for lang, sub_info in info_json["requested_subtitles"].items():
             subtitle_links[lang] = {"url": sub_info["url"], "ext": sub_info["ext"]}
 
         # Print the subtitle links and language names
-        req = None
+        session = self.get_http_session()
         for lang, sub in subtitle_links.items():
             subtitle_filename = "{:02d}-{}.{}.{}".format(video_index, title, lang, sub["ext"])
             file_path = os.path.join(output_path, subtitle_filename)
@@ -693,106 +3825,216 @@ class TeachableDownloader:
             else:
                 base_url = sub["url"]
                 try:
-                    req = requests.get(sub["url"], headers=self.headers)
-                except Exception as e:
-                    logging.warning("Could not download subtitle: " + title + " cause: " + str(e))
-                relative_path = req.text.split("\n")[5]
-                full_url = urljoin(base_url, relative_path)
-                try:
-                    response = requests.get(full_url, headers=self.headers)
+                    req = self.http_get(session, sub["url"], os.path.dirname(output_path), headers=self.headers)
+                    relative_path = req.text.split("\n")[5]
+                    full_url = urljoin(base_url, relative_path)
+                    response = self.http_get(session, full_url, os.path.dirname(output_path), headers=self.headers)
                     with open(file_path, "wb") as f:
                         f.write(response.content)
                 except Exception as e:
                     logging.warning("Could not download subtitle: " + title + " cause: " + str(e))
+                    continue
                 logging.info("Downloaded subtitle: " + subtitle_filename)
                 
     def download_video_file(self, title, video_index, output_path, timeout=-1):
-        # video_title = "{:02d}-{}".format(video_index, title)
-        video_title = video_index, title
+        video_title = "{:02d}-{}".format(video_index, title)
         # Grab the video attachments type video
-        video_attachment = self.driver.find_element(By.CLASS_NAME, "lecture-attachment-type-video")
-        if not video_attachment:
+        video_attachments = self.find_elements_now(By.CLASS_NAME, "lecture-attachment-type-video")
+        if not video_attachments:
             logging.debug(f"No video attachment found for lecture: {title}")
             return False
 
-        video_link = video_attachment.find_element(By.TAG_NAME, "a")
-        print(video_link)
-        if not video_link:
+        video_links = video_attachments[0].find_elements(By.TAG_NAME, "a")
+        if not video_links:
             logging.debug(f"No video link found for lecture: {title}")
             return False
 
-        # Set the download directory for this file
-        self.driver.execute_cdp_cmd("Page.setDownloadBehavior", {
-            "behavior": "allow",
-            "downloadPath": output_path
-        })
-        # Get list of files before download
-        files_before_download = set(os.listdir(output_path))
+        if self.plan is not None:
+            # The file name suggested by the browser is unknown without downloading, use the one in the link
+            manifest = self.get_manifest(os.path.dirname(output_path))
+            for i, video_link in enumerate(video_links):
+                link = video_link.get_attribute("href")
+                _, extension = os.path.splitext(urlparse(link).path)
+                file_name = video_title + ("-" + str(i + 1) if len(video_links) > 1 else "") + extension
+                self.queue_attachment_download(link, file_name, output_path, manifest)
+            return True
 
-        # Click the link to trigger download
-        video_link.click()
+        # Chrome is throttled to the share of the course while it downloads, the bytes are charged afterwards
+        course = os.path.dirname(output_path)
+        with self.bandwidth.transfer(video_links[0].get_attribute("href"), course, slot=False):
+            share = self.bandwidth.share()
+            if share:
+                self.driver.execute_cdp_cmd("Network.emulateNetworkConditions", {
+                    "offline": False, "latency": 0, "downloadThroughput": share, "uploadThroughput": -1})
+            try:
+                # Set the download directory for these files and start all of them
+                self.download_tracker.start(output_path)
+                for video_link in video_links:
+                    video_link.click()
 
-        # Wait for download to complete
-        start_time = time.time()
-        while True:
-            files_after_download = set(os.listdir(output_path))
+                downloads = self.download_tracker.wait(len(video_links), timeout=timeout)
+            finally:
+                if share:
+                    self.driver.execute_cdp_cmd("Network.emulateNetworkConditions", {
+                        "offline": False, "latency": 0, "downloadThroughput": -1, "uploadThroughput": -1})
+            for download in downloads or []:
+                self.bandwidth.charge(course, os.path.getsize(download["path"]))
+        if not downloads:
+            logging.warning(f"Could not download video file for lecture: {title}")
+            return False
 
-            # Find new files
-            new_files = files_after_download - files_before_download
+        for i, download in enumerate(downloads):
+            # Determine the file extension
+            _, extension = os.path.splitext(download["suggested_filename"])
 
-            if len(new_files) == 1 and not list(new_files)[0].endswith('.crdownload'):
-                break
-            
-            if timeout > 0 and (time.time() - start_time) > timeout:
-                logging.warning(f"Download timeout for lecture: {title}")
-                return False
-        
-            time.sleep(1)
+            # Create the new filename, append -n if there are multiple files
+            new_filename = video_title + ("-" + str(i + 1) if len(downloads) > 1 else "") + extension
+            new_filepath = os.path.join(output_path, new_filename)
 
-        latest_file = os.path.join(output_path, list(new_files)[0])
-                
-        # Determine the file extension
-        _, extension = os.path.splitext(latest_file)
-        
-        # Create the new filename
-        new_filename = f"{video_title}{extension}"
-        new_filepath = os.path.join(output_path, new_filename)
-        
-        # Rename the file
-        os.rename(latest_file, new_filepath)
-        logging.info(f"Downloaded video file {new_filename}")
+            # Rename the file
+            os.replace(download["path"], new_filepath)
+            logging.info(f"Downloaded video file {new_filename}")
         return True
-    
+
     def download_attachments(self, link, title, video_index, output_path):
         video_title = "{:02d}-{}".format(video_index, title)
 
-        # Grab the video attachments type file
-        video_attachments = self.driver.find_elements(By.CLASS_NAME, "lecture-attachment-type-file")
-        # Get all links from the video attachments
-
-        if video_attachments:
-            video_links = video_attachments[0].find_elements(By.TAG_NAME, "a")
+        # Grab the links of all attachments of type file in one call
+        video_links = self.driver.execute_script(
+            "return [...document.querySelectorAll('.lecture-attachment-type-file a')]"
+            ".map(a => ({href: a.href, text: a.innerText}))")
 
+        if video_links:
+            manifest = self.get_manifest(os.path.dirname(output_path))
             output_path = os.path.join(output_path, video_title)
             os.makedirs(output_path, exist_ok=True)
 
-            # Get href attribute from the first link
-            if video_links:
-                for video_link in video_links:
-                    link = video_link.get_attribute("href")
-                    file_name = video_link.text
-                    logging.info("Downloading attachment: " + file_name + " for video: " + title)
-                    # Download file and save the file in output_path directory
-                    wget.download(link, out=output_path)
+            self.get_http_session()  # Make sure the session has the current cookies
+            names = collections.Counter()
+            for video_link in video_links:
+                link = video_link["href"]
+                file_name = video_link["text"].strip() or os.path.basename(urlparse(link).path)
+                file_name = file_name.replace("/", "-").replace("\\", "-")
+                # Append -n to attachments with the same name, they would be written to the same file
+                names[file_name] += 1
+                if names[file_name] > 1:
+                    stem, extension = os.path.splitext(file_name)
+                    file_name = stem + "-" + str(names[file_name]) + extension
+                self.queue_attachment_download(link, file_name, output_path, manifest)
+            return ["attachment:" + video_link["href"] for video_link in video_links]
         else:
             logging.warning("No attachments found for video: " + title)
+        return []
+
+    def queue_attachment_download(self, link, file_name, output_path, manifest):
+        if self.plan is not None:
+            # Attachments of a lecture go to a folder below the chapter, the course is taken from the manifest
+            self.add_plan_item("attachment", link, output_path, file_name=file_name,
+                               course_path=os.path.relpath(manifest.course_path),
+                               target=os.path.relpath(os.path.join(output_path, file_name)),
+                               expected_size=self.get_content_length(link))
+            return
+
+        if self.attachment_fetcher is None:
+            self.attachment_fetcher = AttachmentFetcher(self.session_bridge.session, self.bandwidth,
+                                                        self.retry_policy, self.report, store=self.content_store,
+                                                        timeout=max(self.global_timeout, 30))
+        logging.info("Queueing attachment: " + file_name)
+        # Downloads in the background into the output_path directory
+        self.attachment_fetcher.submit(link, file_name, output_path, manifest)
+
+    def get_content_length(self, link):
+        try:
+            response = self.session_bridge.session.head(link, allow_redirects=True, timeout=self.global_timeout)
+            return int(response.headers["Content-Length"]) if response.ok else None
+        except Exception as e:
+            logging.debug("Could not get size of " + link + " cause: " + str(e))
+            return None
+
+    def write_plan(self, plan_file):
+        """
+        Writes the downloads recorded in plan mode to a JSON file that execute_plan can run without a browser.
+        The file contains the session cookies, keep it private.
+        """
+        self.get_http_session()  # Make sure the cookies are the current ones
+        plan = {
+            "version": 1,
+            "created": time.time(),
+            "headers": self.headers,
+            "cookies": self.session_bridge.cookies,
+            "items": self.plan,
+        }
+        with open(plan_file, "w", encoding="utf-8") as f:
+            json.dump(plan, f, indent=2)
+        os.chmod(plan_file, 0o600)
+        logging.info("Wrote plan with " + str(len(self.plan)) + " items: " + plan_file)
+
+    def execute_plan(self, plan_file, shard_index=0, shard_count=1):
+        """
+        Downloads the items of a plan written by --plan-only, without a browser.
+
+        :param plan_file: str
+            Path of the plan.
+        :param shard_index: int
+            Which share of the items this host downloads, from 0 to shard_count - 1.
+        :param shard_count: int
+            Number of hosts the plan is split across.
+        :return: None
+        """
+        with open(plan_file, "r", encoding="utf-8") as f:
+            plan = json.load(f)
+        self.headers.update(plan["headers"])
+        self.session_bridge.session.headers["User-Agent"] = self.headers["User-Agent"]
+        self.session_bridge.load_cookies(plan["cookies"])
+
+        items = [item for n, item in enumerate(plan["items"]) if n % shard_count == shard_index]
+        logging.info("Executing " + str(len(items)) + " of " + str(len(plan["items"])) + " plan items")
+        for item in items:
+            output_path = os.path.abspath(item["output_path"])
+            try:
+                os.makedirs(output_path, exist_ok=True)
+                if item["type"] == "video":
+                    self.queue_video_download(item["url"], item["title"], item["idx"], output_path,
+                                              embed_url=item.get("embed_url"), referer=item.get("referer"))
+                elif item["type"] == "subtitle":
+                    self.download_subtitle(item["url"], item["title"], item["idx"], output_path)
+                elif item["type"] == "attachment":
+                    # Plans written before items had course_path only held attachments saved next to the lecture
+                    course_path = os.path.abspath(item.get("course_path") or os.path.dirname(output_path))
+                    manifest = self.get_manifest(course_path)
+                    self.queue_attachment_download(item["url"], item["file_name"], output_path, manifest)
+                else:
+                    logging.warning("Unknown plan item type: " + item["type"])
+            except Exception as e:
+                logging.error("Could not execute plan item: " + item["url"] + " cause: " + str(e))
+        self.wait_for_downloads()
 
-    def save_webpage_as_html(self, title, video_index, output_path):
+    def save_webpage_as_html(self, title, video_index, output_path, html=None):
         output_file = os.path.join(output_path, "{:02d}-{}.html".format(video_index, title))
-        with open(output_file, 'w+', encoding='utf-8') as f:
-            f.write(self.driver.page_source)
+        with self.report.phase("save_html", lecture=title):
+            self.save_html(output_file, html if html is not None else self.driver.page_source,
+                           os.path.dirname(output_path))
         logging.info("Saved webpage as html: " + output_file)
 
+    def save_html(self, output_file, html, course_path):
+        if self.page_archives is None:
+            with open(output_file, 'w+', encoding='utf-8') as f:
+                f.write(html)
+            return
+        with self.page_archive_lock:
+            if course_path not in self.page_archives:
+                self.page_archives[course_path] = PageArchive(course_path)
+            # Queued under the lock, so close_page_archive can't close the archive in between
+            self.page_archives[course_path].save(os.path.relpath(output_file, course_path).replace(os.sep, "/"), html)
+
+    def close_page_archive(self, course_path):
+        if self.page_archives is None:
+            return
+        with self.page_archive_lock:
+            archive = self.page_archives.pop(course_path, None)
+        if archive is not None:
+            archive.close()
+
     def save_webpage_as_pdf(self, title, video_index, output_path):
         output_file_pdf = os.path.join(output_path, "{:02d}-{}.pdf".format(video_index, title))
         self.driver.save_print_page(output_file_pdf)
@@ -800,10 +4042,18 @@ class TeachableDownloader:
 
     def clean_up(self):
         logging.info("Cleaning up")
-        self.driver.quit()
+        if not self.is_worker:
+            try:
+                for course_path in list(self.page_archives or {}):
+                    self.close_page_archive(course_path)
+            finally:
+                self.report.close()
+            # The pool is shared with the browser workers, one of them failing must not cancel the others' jobs
+            self.postprocessor.shutdown()
+        if self.driver is not None:
+            self.driver.quit()
         # Delete cookies.txt
-        if os.path.exists("cookies.txt"):
-            os.remove("cookies.txt")
+        self.session_bridge.remove_cookie_file()
 
 
 def read_urls_from_file(file_path):
@@ -850,8 +4100,113 @@ if __name__ == "__main__":
     parser.add_argument("--user-agent", required=False, help='User agent to use when downloading videos',
                         default="Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) "
                                 "Chrome/116.0.0.0 Safari/537.36")
-    parser.add_argument("-t", "--timeout", required=False, help='Timeout for selenium driver', default=10)
+    parser.add_argument("-t", "--timeout", required=False, type=int, help='Timeout for selenium driver', default=10)
+    parser.add_argument("--download-workers", required=False, type=int, default=0,
+                        help='Number of parallel video downloads. The browser keeps resolving lectures while the '
+                             'workers download (0 downloads each video inline)')
+    parser.add_argument("--session-key", required=False, default=os.getenv("SESSION_KEY"),
+                        help='Passphrase used to encrypt the saved login session. When set, the session is saved after '
+                             'login and reused by later runs instead of logging in again')
+    parser.add_argument("--profile-dir", required=False, default="profiles",
+                        help='Directory for the saved login sessions')
+    parser.add_argument("--workers", required=False, type=int, default=1,
+                        help='Number of browsers downloading courses of a batch (-f) in parallel. The extra browsers '
+                             'reuse the login of the first one')
+    parser.add_argument("--headed-workers", action='store_true', default=False,
+                        help='Show the windows of the extra browsers started by --workers instead of running headless')
+    parser.add_argument("--max-downloads", required=False, type=int, default=0,
+                        help='Maximum number of videos downloading at the same time across all workers (0 = no limit)')
+    parser.add_argument("--hls-engine", required=False, choices=["native", "yt-dlp"], default="native",
+                        help='Download HLS videos with the built-in segment downloader (falls back to yt-dlp on '
+                             'errors) or always with yt-dlp')
+    parser.add_argument("--min-fragments", required=False, type=int, default=2,
+                        help='Lowest number of concurrent fragment downloads per video')
+    parser.add_argument("--max-fragments", required=False, type=int, default=16,
+                        help='Highest number of concurrent fragment downloads per video')
+    parser.add_argument("--fragment-budget", required=False, type=int, default=32,
+                        help='Maximum number of concurrent fragment downloads across all videos')
+    parser.add_argument("--download-attachments", action='store_true', default=False,
+                        help='Download the file attachments of each lecture')
+    parser.add_argument("--sync", action='store_true', default=False,
+                        help='Only download lectures that were added or not finished since the last run, and move the '
+                             'files of renumbered or renamed lectures instead of downloading them again')
+    parser.add_argument("--download-queue", required=False, type=int, default=8,
+                        help='Maximum number of resolved videos waiting for a download worker')
+    parser.add_argument("--download-subtitles", action='store_true', default=False,
+                        help='Download the subtitles of each video')
+    parser.add_argument("--plan-only", required=False, metavar="PLAN",
+                        help='Log in and walk the courses, but write the downloads to this plan file instead of '
+                             'running them. The plan contains the session cookies')
+    parser.add_argument("--execute", required=False, metavar="PLAN",
+                        help='Download the items of a plan file written by --plan-only, without a browser')
+    parser.add_argument("--shard", required=False, default="0/1", metavar="I/N",
+                        help='With --execute, only download every N-th item starting at item I (e.g. 1/4), to split '
+                             'a plan across hosts')
+    parser.add_argument("--max-rate", required=False, default="0",
+                        help='Cap on the total download rate in bytes per second, e.g. 2M (0 = no limit). The rate is '
+                             'shared evenly between the courses that are downloading')
+    parser.add_argument("--bandwidth-profile", required=False, metavar="HH:MM=RATE,...",
+                        help='Download rate by time of day instead of --max-rate, e.g. "08:00=1M,18:00=0" limits '
+                             'office hours and runs at full speed overnight')
+    parser.add_argument("--host-limit", required=False, action='append', metavar="HOST=N",
+                        help='Maximum number of concurrent transfers to a host and its subdomains, can be repeated '
+                             '(default: hotmart.com=8 teachablecdn.com=8)')
+    parser.add_argument("--school-host-limit", required=False, type=int, default=4,
+                        help='Maximum number of concurrent transfers to the host of the course (0 = no limit)')
+    parser.add_argument("--retries", required=False, type=int, default=3,
+                        help='Retries of a failed request (timeouts, connection errors, 429 and 5xx), with '
+                             'exponential backoff')
+    parser.add_argument("--breaker-threshold", required=False, type=int, default=5,
+                        help='Consecutive failures after which all requests to a host are paused')
+    parser.add_argument("--breaker-cooldown", required=False, type=int, default=60,
+                        help='Seconds requests to a failing host are paused before trying it again')
+    parser.add_argument("--report", required=False, metavar="FILE",
+                        help='Append the timing of every phase (login, navigation, downloads, postprocessing, ...) '
+                             'and a summary of the run to this JSON-lines file')
+    parser.add_argument("--status-port", required=False, type=int,
+                        help='Serve the progress of the run as Prometheus metrics on /metrics and as JSON on /status')
+    parser.add_argument("--status-host", required=False, default="127.0.0.1",
+                        help='Address the status endpoint listens on')
+    parser.add_argument("--content-store", required=False, metavar="DB",
+                        help='SQLite index of downloaded files by media asset and content. Videos and attachments '
+                             'already downloaded for another course are hardlinked (or reflinked/copied) instead of '
+                             'downloaded again')
+    parser.add_argument("--dedupe", action="store_true",
+                        help='Link identical files that already exist under courses/ together and exit. Uses '
+                             '--content-store or content.db')
+    parser.add_argument("--extraction-cache", required=False, default=None, metavar="DB",
+                        help='Keep the yt-dlp extraction of every media URL in this SQLite database so later runs '
+                             'reuse it. Without it the extractions are only shared within the run. Contains signed '
+                             'URLs and cookies, the file is only readable by the current user on POSIX systems')
+    parser.add_argument("--extraction-ttl", required=False, type=int, default=6 * 3600,
+                        help='Seconds an extraction is reused, entries also expire with the signed URLs in them '
+                             '(0 disables the cache)')
+    parser.add_argument("--page-archive", action="store_true",
+                        help='Save the html of the course and lecture pages compressed and deduplicated in one '
+                             'archive per course (pages.pack and pages.db) instead of separate files')
+    parser.add_argument("--extract-page", required=False, metavar="PATH",
+                        help='Restore a page from the archive of its course to PATH and exit. If PATH is a course '
+                             'directory, all of its pages are restored')
+    parser.add_argument("--prefetch", required=False, type=int, default=0, metavar="K",
+                        help='Load the next K lectures in background tabs while the current one is handled. Each tab '
+                             'costs browser memory (0 disables prefetching)')
+    parser.add_argument("--job-queue", required=False, metavar="DB",
+                        help='SQLite job queue shared by several processes or hosts. The courses of --url or -f are '
+                             'added to it, then the queue is worked on until it is empty. Run more processes with the '
+                             'same --job-queue (and without --url/-f) to help. Finished courses are not queued again')
+    parser.add_argument("--job-priority", required=False, type=int, default=0,
+                        help='Priority of the courses added to --job-queue, higher runs first')
+    parser.add_argument("--lease-seconds", required=False, type=int, default=300,
+                        help='Seconds without a heartbeat before a job of a dead worker is handed to another one')
+    parser.add_argument("--max-attempts", required=False, type=int, default=3,
+                        help='Number of times a job of --job-queue is tried before it is given up')
     args = parser.parse_args()
+    try:
+        bandwidth_profile = parse_bandwidth_profile(args.bandwidth_profile) if args.bandwidth_profile else \
+            [(0, parse_rate(args.max_rate))]
+        host_limits = parse_host_limits(args.host_limit or ["hotmart.com=8", "teachablecdn.com=8"])
+    except ValueError as e:
+        parser.error(str(e))
     verbose = False
     if args.verbose == 0:
         log_level = logging.WARNING
@@ -863,16 +4218,106 @@ if __name__ == "__main__":
 
     logging.basicConfig(level=log_level, format='%(levelname)s: %(message)s')
 
+    if args.extract_page:
+        try:
+            print("Extracted {} pages".format(extract_pages(args.extract_page)))
+        except (OSError, KeyError) as e:
+            logging.error("Could not extract page: " + str(e))
+            sys.exit(1)
+        sys.exit(0)
+
+    if args.dedupe:
+        store = ContentStore(args.content_store or "content.db")
+        linked, saved = store.dedupe(os.path.join(os.getcwd(), "courses"))
+        print("Linked {} duplicate files, saved {:.1f} MiB".format(linked, saved / 1024 / 1024))
+        sys.exit(0)
+
+    if args.execute:
+        try:
+            shard_index, shard_count = (int(n) for n in args.shard.split("/"))
+            if not 0 <= shard_index < shard_count:
+                raise ValueError
+        except ValueError:
+            logging.error("Invalid shard: " + args.shard + ", expected I/N with 0 <= I < N")
+            sys.exit(1)
+        downloader = TeachableDownloader(verbose_arg=verbose, complete_lecture_arg=False,
+                                         user_agent_arg=args.user_agent, timeout_arg=args.timeout,
+                                         download_workers_arg=args.download_workers,
+                                         download_queue_arg=args.download_queue,
+                                         max_downloads_arg=args.max_downloads, hls_engine_arg=args.hls_engine,
+                                         min_fragments_arg=args.min_fragments, max_fragments_arg=args.max_fragments,
+                                         fragment_budget_arg=args.fragment_budget, browser_arg=False,
+                                         bandwidth_profile_arg=bandwidth_profile, host_limits_arg=host_limits,
+                                         retries_arg=args.retries, breaker_threshold_arg=args.breaker_threshold,
+                                         breaker_cooldown_arg=args.breaker_cooldown, report_arg=args.report,
+                                         content_store_arg=args.content_store,
+                                         extraction_cache_arg=args.extraction_cache,
+                                         extraction_ttl_arg=args.extraction_ttl)
+        if args.status_port:
+            StatusServer(downloader, args.status_port, args.status_host).start()
+        try:
+            downloader.execute_plan(args.execute, shard_index, shard_count)
+            downloader.clean_up()
+            sys.exit(0)
+        except KeyboardInterrupt:
+            logging.error("Interrupted by user")
+            downloader.clean_up()
+            sys.exit(1)
+        except Exception as e:
+            logging.error("Error: " + str(e))
+            downloader.clean_up()
+            sys.exit(1)
+
     if not check_required_args(args):
         logging.error("Required arguments are missing. Choose email/password or manual login (man_login_url).")
         exit(1)
 
     downloader = TeachableDownloader(verbose_arg=verbose, complete_lecture_arg=args.complete_lecture,
-                                     user_agent_arg=args.user_agent, timeout_arg=args.timeout)
-    if args.file:
+                                     user_agent_arg=args.user_agent, timeout_arg=args.timeout,
+                                     download_workers_arg=args.download_workers,
+                                     download_queue_arg=args.download_queue,
+                                     session_key_arg=args.session_key, profile_dir_arg=args.profile_dir,
+                                     browser_workers_arg=args.workers, headed_workers_arg=args.headed_workers,
+                                     max_downloads_arg=args.max_downloads, hls_engine_arg=args.hls_engine,
+                                     min_fragments_arg=args.min_fragments, max_fragments_arg=args.max_fragments,
+                                     fragment_budget_arg=args.fragment_budget,
+                                     attachments_arg=args.download_attachments, sync_arg=args.sync,
+                                     subtitles_arg=args.download_subtitles, plan_arg=bool(args.plan_only),
+                                     prefetch_arg=args.prefetch, bandwidth_profile_arg=bandwidth_profile,
+                                     host_limits_arg=host_limits, school_host_limit_arg=args.school_host_limit,
+                                     retries_arg=args.retries, breaker_threshold_arg=args.breaker_threshold,
+                                     breaker_cooldown_arg=args.breaker_cooldown, report_arg=args.report,
+                                     content_store_arg=args.content_store, page_archive_arg=args.page_archive,
+                                     extraction_cache_arg=args.extraction_cache,
+                                     extraction_ttl_arg=args.extraction_ttl)
+    if args.status_port:
+        StatusServer(downloader, args.status_port, args.status_host).start()
+    if args.job_queue:
+        jobs = JobQueue(args.job_queue, lease_seconds=args.lease_seconds, max_attempts=args.max_attempts)
+        if args.file:
+            urls = read_urls_from_file(args.file)
+        else:
+            urls = [args.url] if args.url else []
+        for url in urls:
+            jobs.add("course", url, priority=args.job_priority)
+        try:
+            downloader.run_jobs(jobs, args.email, args.password, args.login_url, args.man_login_url)
+            downloader.clean_up()
+            sys.exit(0)
+        except KeyboardInterrupt:
+            logging.error("Interrupted by user")
+            downloader.clean_up()
+            sys.exit(1)
+        except Exception as e:
+            logging.error("Error: " + str(e))
+            downloader.clean_up()
+            sys.exit(1)
+    elif args.file:
         urls = read_urls_from_file(args.file)
         try:
             downloader.run_batch(urls, args.email, args.password, args.login_url, args.man_login_url)
+            if args.plan_only:
+                downloader.write_plan(args.plan_only)
             downloader.clean_up()
             sys.exit(0)
         except KeyboardInterrupt:
@@ -891,6 +4336,8 @@ if __name__ == "__main__":
         try:
             downloader.run(course_url=args.url, email=args.email, password=args.password, login_url=args.login_url,
                            man_login_url=args.man_login_url)
+            if args.plan_only:
+                downloader.write_plan(args.plan_only)
             downloader.clean_up()
             sys.exit(0)
         except KeyboardInterrupt:
@@ -0,0 +1,69 @@
+import os
+import sys
+import threading
+import unittest
+
+import requests
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from main import CircuitBreaker, RetryPolicy  # noqa: E402
+
+
+def http_error(status):
+    response = requests.Response()
+    response.status_code = status
+    return requests.HTTPError(str(status), response=response)
+
+
+def run_with_timeout(fn, timeout=5):
+    result = {}
+
+    def target():
+        try:
+            result["value"] = fn()
+        except Exception as e:
+            result["error"] = e
+
+    thread = threading.Thread(target=target, daemon=True)
+    thread.start()
+    thread.join(timeout)
+    if thread.is_alive():
+        raise AssertionError("call did not return")
+    return result
+
+
+class HalfOpenProbeTest(unittest.TestCase):
+    def setUp(self):
+        self.breaker = CircuitBreaker(threshold=1, cooldown=0)
+        self.policy = RetryPolicy(self.breaker, retries=0)
+        self.url = "https://cdn.example.com/video.m3u8"
+        # Open the circuit, the cooldown is over at once so the next request is the probe
+        self.breaker.failure("cdn.example.com")
+
+    def test_non_retryable_probe_releases_host(self):
+        def not_found(url):
+            raise http_error(404)
+
+        result = run_with_timeout(lambda: self.policy.call(not_found, self.url))
+        self.assertIsInstance(result["error"], requests.HTTPError)
+        result = run_with_timeout(lambda: self.policy.call(lambda url: "ok", self.url))
+        self.assertEqual(result["value"], "ok")
+
+    def test_expired_probe_refreshes_on_same_host(self):
+        urls = []
+
+        def expired_once(url):
+            urls.append(url)
+            if len(urls) == 1:
+                raise http_error(403)
+            return url
+
+        result = run_with_timeout(lambda: self.policy.call(expired_once, self.url,
+                                                           on_expired=lambda url: self.url + "?fresh"))
+        self.assertEqual(result["value"], self.url + "?fresh")
+        self.assertEqual(len(urls), 2)
+
+
+if __name__ == "__main__":
+    unittest.main()